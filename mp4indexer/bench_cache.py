@@ -0,0 +1,240 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+bench_cache.py:
+大きなファイルのコピーとチェックサムがページキャッシュに残す量のベンチマーク（Linux）
+
+コピー元のディレクトリに大きなファイルを作ってキャッシュから追い出し、方式ごとに
+コピー（あるいはチェックサムの計算）をして、前後のページキャッシュの占有（mincore）を
+コピー元・コピー先・別に読んでおいたファイル（--hot、データベースや再生の代わり）について
+表示し、JSONに保存する。--hot をメモリより大きいコピーと組み合わせると、以前の方法で
+使っていたキャッシュが追い出されるのが分かる。
+
+    shutil.copy         以前の方法（キャッシュに全部残る）
+    transfer            mp4copy と同じ（verify、読んだところと書いたところを捨てる）
+    transfer-direct     transfer を O_DIRECT で読む（mp4copy --direct-io）
+    hash                open().read() でチェックサムを計算する（以前の verify_checksum）
+    verify_checksum     mp4core.streamio で読む
+
+    python bench_cache.py -s x:/tmp -d m:/tmp --size 4000 --hot 1000
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from mp4core import streamio
+from mp4core.fileops import CHUNK_SIZE, sidecar_of, transfer, verify_checksum
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = [
+    "shutil.copy",
+    "transfer",
+    "transfer-direct",
+    "hash",
+    "verify_checksum",
+]
+
+PROT_READ = 1
+MAP_SHARED = 1
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = [
+    ctypes.c_void_p,
+    ctypes.c_size_t,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_long,
+]
+_libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+
+
+def cached_mb(path: Path) -> float:
+    """path のうちページキャッシュにある大きさ（MB）"""
+    try:
+        size = os.stat(path).st_size
+    except FileNotFoundError:
+        return 0.0
+    if size == 0:
+        return 0.0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        addr = _libc.mmap(None, size, PROT_READ, MAP_SHARED, fd, 0)
+        if addr in (None, ctypes.c_void_p(-1).value):
+            raise OSError(ctypes.get_errno(), "mmap failed", str(path))
+        try:
+            pages = -(-size // mmap.PAGESIZE)
+            vec = ctypes.create_string_buffer(pages)
+            if _libc.mincore(addr, size, vec) != 0:
+                raise OSError(ctypes.get_errno(), "mincore failed", str(path))
+            resident = sum(b & 1 for b in vec.raw)
+        finally:
+            _libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+    return resident * mmap.PAGESIZE / (1 << 20)
+
+
+def make_file(path: Path, size: int):
+    """size バイトのファイルを作り、ディスクに書いてキャッシュから追い出す"""
+    chunk = os.urandom(1 << 20)
+    with open(path, "wb") as f:
+        for _ in range(size >> 20):
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+        streamio.drop_cache(f.fileno())
+
+
+def warm(path: Path):
+    """path を読んでキャッシュに載せる"""
+    with open(path, "rb") as f:
+        while f.read(CHUNK_SIZE):
+            pass
+
+
+def run_once(strategy: str, src: Path, dstdir: Path):
+    """一度実行して (経過時間[秒], コピー先のファイル) を返す"""
+    dst = dstdir / src.name
+    time_start = time.perf_counter()
+    if strategy == "shutil.copy":
+        shutil.copy(src, dst)
+    elif strategy == "transfer":
+        transfer(src, dst, verify=True)
+    elif strategy == "transfer-direct":
+        transfer(src, dst, verify=True, direct=True)
+    elif strategy == "hash":
+        with open(src, "rb") as f:
+            while data := f.read(CHUNK_SIZE):
+                hashlib.sha256(data).hexdigest()
+        dst = None
+    elif strategy == "verify_checksum":
+        if not verify_checksum(src):
+            raise RuntimeError(f"checksum mismatch: {src}")
+        dst = None
+    return time.perf_counter() - time_start, dst
+
+
+def main():
+    parser = argparse.ArgumentParser(description="コピーがページキャッシュに残す量を計測する")
+    parser.add_argument(
+        "-s",
+        "--src",
+        type=Path,
+        default=None,
+        help="directory for the source file (default: temp dir)",
+    )
+    parser.add_argument(
+        "-d",
+        "--dest",
+        type=Path,
+        default=None,
+        help="destination directory, ideally on another drive (default: temp dir)",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=1000,
+        help="size of the test file in MB",
+    )
+    parser.add_argument(
+        "--hot",
+        type=int,
+        default=200,
+        help="size in MB of a file kept warm in the cache (stands in for the DB or playback)",
+    )
+    parser.add_argument(
+        "--strategy",
+        choices=STRATEGIES,
+        action="append",
+        help="strategies to run (default: all)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        default=Path(time.strftime("bench_cache-%Y%m%d-%H%M%S.json")),
+        help="JSON file to save the results",
+    )
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir=args.src) as srcdir, tempfile.TemporaryDirectory(
+        dir=args.dest
+    ) as dstdir:
+        src = Path(srcdir) / "recording.m2ts"
+        hot = Path(srcdir) / "hot.dat"
+        logger.info(f"creating {args.size} MB file and {args.hot} MB hot file in {srcdir}")
+        make_file(src, args.size << 20)
+        make_file(hot, args.hot << 20)
+        # verify_checksum の比べる相手
+        transfer(src, Path(dstdir) / "checksum", verify=True)
+        shutil.copy(sidecar_of(Path(dstdir) / "checksum"), sidecar_of(src))
+        for strategy in args.strategy or STRATEGIES:
+            streamio.drop_file_cache(src)
+            warm(hot)
+            before = {"src_mb": cached_mb(src), "hot_mb": cached_mb(hot)}
+            try:
+                elapsed, dst = run_once(strategy, src, Path(dstdir))
+            except OSError as e:
+                logger.info(f"{strategy:16} not supported: {e}")
+                results[strategy] = None
+                continue
+            after = {
+                "src_mb": cached_mb(src),
+                "dst_mb": cached_mb(dst) if dst else 0.0,
+                "hot_mb": cached_mb(hot),
+            }
+            if dst:
+                dst.unlink()
+                sidecar_of(dst).unlink(missing_ok=True)
+            results[strategy] = {
+                "seconds": round(elapsed, 3),
+                "mb_per_s": round(args.size / elapsed, 1) if elapsed else None,
+                "before": {k: round(v, 1) for k, v in before.items()},
+                "after": {k: round(v, 1) for k, v in after.items()},
+            }
+            logger.info(
+                f"{strategy:16} {results[strategy]['mb_per_s']:8.1f} MB/s"
+                f"  cached after: src {after['src_mb']:7.1f} MB  dst {after['dst_mb']:7.1f} MB"
+                f"  hot {after['hot_mb']:6.1f}/{args.hot} MB"
+            )
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "size_mb": args.size,
+                "hot_mb": args.hot,
+                "results": results,
+            },
+            f,
+            ensure_ascii=False,
+            indent=2,
+        )
+    logger.info(f"saved to {args.output}")
+
+
+if __name__ == "__main__":
+    ch = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s %(name)-12s %(levelname)-8s %(message)s")
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    main()
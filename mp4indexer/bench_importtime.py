@@ -0,0 +1,123 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+bench_importtime.py:
+各CLIツールのインポート時間を python -X importtime で計測し、
+予算（ミリ秒）を超えたとき、あるいはインポート時に重いモジュールを読み込んでいるときに
+終了コード 1 で終わる
+
+    python bench_importtime.py            # すべてのツールを計測
+    python bench_importtime.py mp4find -n 10
+"""
+
+import argparse
+import logging
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# ツールごとのインポート時間の予算（ミリ秒）
+BUDGETS = {
+    "mp4find": 80,
+    "mp4indexer": 150,
+    "mp4copy": 120,
+    "key2chapter": 80,
+    "k2n_rename": 60,
+}
+# インポート時に読み込んではいけないモジュール（使うときに遅延インポートする）
+HEAVY_MODULES = {"cv2", "pymediainfo", "cmigemo", "tqdm", "jaconv", "kanjize"}
+# mp4find は DB に接続する前に答えられるものがあるので mariadb も遅延させる
+EXTRA_HEAVY = {"mp4find": {"mariadb"}}
+
+
+def measure(module: str, cwd: Path):
+    """module を一度インポートして (累積時間[us], インポートされたモジュール名の集合) を返す"""
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+    )
+    if res.returncode != 0:
+        raise ImportError(res.stderr.strip().splitlines()[-1])
+    cumulative = None
+    imported = set()
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative_us, name = (x.strip() for x in line[12:].split("|"))
+        if not cumulative_us.isdecimal():
+            continue  # 見出し行
+        imported.add(name.split(".")[0])
+        if name == module:
+            cumulative = int(cumulative_us)
+    return cumulative, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CLIツールのインポート時間を計測する")
+    parser.add_argument(
+        "modules",
+        nargs="*",
+        default=list(BUDGETS),
+        help="modules to measure (default: all CLI tools)",
+    )
+    parser.add_argument(
+        "-n",
+        "--repeat",
+        type=int,
+        default=5,
+        help="number of runs per module; the median is compared with the budget",
+    )
+    parser.add_argument(
+        "-s",
+        "--scale",
+        type=float,
+        default=1.0,
+        help="multiply all budgets by this factor (for slow machines)",
+    )
+    args = parser.parse_args()
+
+    cwd = Path(__file__).parent
+    failed = False
+    for module in args.modules:
+        budget = BUDGETS.get(module, 100) * args.scale
+        samples = []
+        imported = set()
+        try:
+            for _ in range(args.repeat):
+                cumulative, imported = measure(module, cwd)
+                samples.append(cumulative / 1000)
+        except ImportError as e:
+            logger.error(f"{module}: import failed: {e}")
+            failed = True
+            continue
+        median = statistics.median(samples)
+        heavy = imported & (HEAVY_MODULES | EXTRA_HEAVY.get(module, set()))
+        status = "OK"
+        if median > budget:
+            status = "SLOW"
+            failed = True
+        if heavy:
+            status = "HEAVY"
+            failed = True
+        logger.info(
+            f"{module:12} {median:8.1f} ms (budget {budget:.0f} ms) {status}"
+            + (f" imports {', '.join(sorted(heavy))}" if heavy else "")
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    ch = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s %(name)-12s %(levelname)-8s %(message)s")
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    main()
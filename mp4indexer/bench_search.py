@@ -0,0 +1,494 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+bench_search.py:
+検索方式ごとの検索時間のベンチマーク
+
+放送の録画のような名前とEPGの説明文を持つ videolist（MariaDB）と filelist（SQLite）を
+指定の件数だけ作り、決まった検索語の組を各方式で検索して
+p50/p95/p99 の時間と読んだ行数（MariaDB の Handler_read_* の増分）を表示し、JSONに保存する。
+
+    like            CONCAT_WS(directory, filename) LIKE（以前の mp4find の名前検索、比べる基準）
+    like_text       CONCAT_WS(directory, filename, description) LIKE（以前の mp4find -t）
+    search_key      正規化した search_key の LIKE（トライグラム索引のないときの mp4find）
+    regexp          Migemo の正規表現で REGEXP（mp4find -r）
+    fulltext        FULLTEXT 索引の MATCH ... AGAINST
+    trigram         トライグラム索引（mp4core.trigram）
+    nameindex       メモリ上の名前インデックス（mp4find_server）
+    snapshot        mmap したスナップショット（mp4core.snapshot）
+    sqlite_like     filelist の LIKE（pubfind）
+    sqlite_regexp   filelist の REGEXP（pubfind）
+
+    python bench_search.py -n 100000
+    python bench_search.py -n 1000000 --offline -o result.json
+    python bench_search.py --compare result.json   # p95 が tolerance 倍を超えたら終了コード 1
+"""
+
+import argparse
+import json
+import logging
+import random
+import re
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from mp4core import search, snapshot, trigram
+from mp4core.config import connect, load_config
+from mp4core.nameindex import NameIndex
+
+logger = logging.getLogger(__name__)
+
+DB_STRATEGIES = ["like", "like_text", "search_key", "regexp", "fulltext", "trigram"]
+OFFLINE_STRATEGIES = ["nameindex", "snapshot", "sqlite_like", "sqlite_regexp"]
+STRATEGIES = DB_STRATEGIES + OFFLINE_STRATEGIES
+
+CHANNELS = [
+    "ＮＨＫ総合",
+    "ＮＨＫＥテレ",
+    "日テレ",
+    "ＴＢＳ",
+    "フジテレビ",
+    "テレビ朝日",
+    "テレビ東京",
+    "ＢＳ１１",
+    "ＢＳプレミアム",
+    "ＷＯＷＯＷシネマ",
+]
+GENRES = {
+    "anime": [
+        "葬送のフリーレン",
+        "薬屋のひとりごと",
+        "ダンジョン飯",
+        "ぼっち・ざ・ろっく！",
+        "進撃の巨人",
+        "鬼滅の刃",
+        "スパイファミリー",
+        "響け！ユーフォニアム３",
+    ],
+    "drama": [
+        "大河ドラマ　光る君へ",
+        "連続テレビ小説　虎に翼",
+        "日曜劇場　アンチヒーロー",
+        "相棒ｓｅａｓｏｎ２２",
+        "孤独のグルメ",
+    ],
+    "documentary": [
+        "ＮＨＫスペシャル",
+        "プロフェッショナル　仕事の流儀",
+        "ブラタモリ",
+        "ドキュメント７２時間",
+        "新日本風土記",
+    ],
+    "news": ["ニュース７", "ニュースウオッチ９", "報道ステーション", "ワールドビジネスサテライト"],
+    "movie": ["映画　千と千尋の神隠し", "映画　シン・ゴジラ", "映画　君の名は。", "映画　ローマの休日"],
+}
+MARKS = ["[字]", "[デ]", "[新]", "[終]", "[再]", "[解]", "[二]", "[ＳＳ]"]
+EPG_WORDS = [
+    "出演",
+    "声の出演",
+    "語り",
+    "脚本",
+    "演出",
+    "原作",
+    "主題歌",
+    "京都",
+    "東京",
+    "北海道",
+    "沖縄",
+    "歴史",
+    "料理",
+    "旅",
+    "事件",
+    "魔法使い",
+    "勇者",
+    "宮廷",
+    "薬師",
+    "バンド",
+    "ライブ",
+    "特集",
+    "最終回",
+    "感動",
+    "密着",
+    "職人",
+    "鉄道",
+    "絶景",
+    "選挙",
+    "経済",
+]
+ASCII_WORDS = ["HDR", "4K", "5.1ch", "BD", "REMASTER", "SP"]
+
+# 検索語の組（よく出る語、珍しい語、AND、短い語、英字、見つからない語）
+QUERIES = [
+    ["ニュース"],
+    ["フリーレン"],
+    ["光る君へ", "第１２回"],
+    ["薬屋", "ＢＳ１１"],
+    ["旅"],
+    ["4K"],
+    ["映画", "ゴジラ"],
+    ["存在しない番組名"],
+]
+
+
+def generate_rows(n: int, seed: int = 0) -> list:
+    """videolist の架空のレコードを n 件作る（(directory, filename) の順）"""
+    rnd = random.Random(seed)
+    start = datetime(2020, 1, 1)
+    rows = []
+    for i in range(n):
+        genre = rnd.choice(list(GENRES))
+        title = rnd.choice(GENRES[genre])
+        channel = rnd.choice(CHANNELS)
+        date = start + timedelta(minutes=rnd.randrange(60 * 24 * 365 * 6))
+        episode = f"第{rnd.randrange(1, 60):d}回".translate(
+            str.maketrans("0123456789", "０１２３４５６７８９")
+        )
+        marks = "".join(rnd.sample(MARKS, rnd.randrange(0, 3)))
+        extra = f" {rnd.choice(ASCII_WORDS)}" if rnd.random() < 0.1 else ""
+        filename = (
+            f"{title}　{episode}{marks}{extra} {date:%Y_%m_%d %H%M} {channel} {i}.mp4"
+        )
+        description = "。".join(
+            "".join(rnd.choices(EPG_WORDS, k=rnd.randrange(3, 8)))
+            for _ in range(rnd.randrange(2, 6))
+        )
+        rows.append(
+            {
+                "directory": f"/m/{genre}/{title}",
+                "filename": filename,
+                "filetype": "MP4",
+                "width": 1920,
+                "height": rnd.choice([720, 1080, 2160]),
+                "length": f"00:{rnd.randrange(5, 59):02}:00.000",
+                "filesize": rnd.randrange(200, 8000) * 1024**2,
+                "fourcc": rnd.choice(["AVC", "HEVC"]),
+                "filedate": date,
+                "description": description,
+                "keep_flag": 0,
+            }
+        )
+    rows.sort(key=lambda r: (r["directory"], r["filename"]))
+    return rows
+
+
+def percentiles(samples: list) -> dict:
+    """p50/p95/p99（ミリ秒）"""
+    if len(samples) < 2:
+        v = samples[0] if samples else None
+        return {"p50": v, "p95": v, "p99": v}
+    q = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50": q[49], "p95": q[94], "p99": q[98]}
+
+
+def migemo_regexp(keyword: str) -> str:
+    """Migemo の正規表現（cmigemo がなければ検索語そのもの）"""
+    try:
+        return search.compile_pattern(keyword)
+    except ImportError:
+        return re.escape(keyword)
+
+
+class DbBench:
+    """MariaDB のベンチマーク用のテーブル（videolist と同じ定義で作る）"""
+
+    def __init__(self, config: dict, table: str):
+        self.source = config["table_name"]
+        self.table = table
+        self.conn = connect(config)
+        self.cur = self.conn.cursor(dictionary=True)
+
+    def setup(self, rows: list):
+        cur = self.cur
+        cur.execute(f"DROP TABLE IF EXISTS {self.table}_trigram")
+        cur.execute(f"DROP TABLE IF EXISTS {self.table}")
+        cur.execute(f"CREATE TABLE {self.table} LIKE {self.source}")
+        columns = list(rows[0])
+        placeholders = ", ".join(["?"] * len(columns))
+        for i in range(0, len(rows), 10000):
+            cur.executemany(
+                f"INSERT INTO {self.table} ({', '.join(columns)}) VALUES ({placeholders})",
+                [tuple(r[c] for c in columns) for r in rows[i : i + 10000]],
+            )
+            self.conn.commit()
+        cur.execute(
+            f"ALTER TABLE {self.table} "
+            "ADD FULLTEXT INDEX ft_bench (directory, filename, description)"
+        )
+        trigram.create_table(cur, self.table)
+        trigram.rebuild(self.conn, cur, self.table)
+
+    def drop(self):
+        self.cur.execute(f"DROP TABLE IF EXISTS {self.table}_trigram")
+        self.cur.execute(f"DROP TABLE IF EXISTS {self.table}")
+
+    def close(self):
+        self.conn.close()
+
+    def _handler_reads(self) -> int:
+        self.cur.execute("SHOW SESSION STATUS LIKE 'Handler_read%'")
+        return sum(int(r["Value"]) for r in self.cur.fetchall())
+
+    def sql(self, strategy: str, keywords: list):
+        """方式ごとの (SQL, パラメータ)。その方式で検索できないときは None"""
+        if strategy in ("like", "like_text"):
+            columns = "directory, filename" + (", description" if strategy == "like_text" else "")
+            return (
+                f"SELECT directory, filename FROM {self.table} WHERE "
+                + " AND ".join([f'CONCAT_WS(" ", {columns}) LIKE ?'] * len(keywords)),
+                [f"%{k}%" for k in keywords],
+            )
+        if strategy == "search_key":
+            return search.build_queries(self.table, keywords, False, False)[-1]
+        if strategy == "regexp":
+            return (
+                f'SELECT directory, filename FROM {self.table} '
+                f'WHERE CONCAT_WS(" ", directory, filename) REGEXP ?',
+                [migemo_regexp(keywords[0])],
+            )
+        if strategy == "fulltext":
+            return (
+                f"SELECT directory, filename FROM {self.table} "
+                "WHERE MATCH (directory, filename, description) AGAINST (? IN BOOLEAN MODE)",
+                [" ".join(f'+"{k}"' for k in keywords)],
+            )
+        if strategy == "trigram":
+            queries = search.build_queries(self.table, keywords, False, False)
+            return queries[0] if len(queries) > 1 else None
+        raise ValueError(strategy)
+
+    def run(self, strategy: str, keywords: list):
+        """1回検索して (時間[ミリ秒], 件数, 読んだ行数) を返す"""
+        if (query := self.sql(strategy, keywords)) is None:
+            return None
+        SQL, params = query
+        before = self._handler_reads()
+        time_start = time.perf_counter()
+        self.cur.execute(SQL, params)
+        count = len(self.cur.fetchall())
+        elapsed = (time.perf_counter() - time_start) * 1000
+        return elapsed, count, self._handler_reads() - before
+
+
+class OfflineBench:
+    """DB を使わない方式（メモリ上のインデックス、スナップショット、SQLite）"""
+
+    def __init__(self, rows: list, workdir: Path):
+        self.index = NameIndex(rows)
+        snapshot.write(rows, workdir / "names.idx")
+        self.snap = snapshot.NameSnapshot(workdir / "names.idx")
+        self.sqlite = sqlite3.connect(workdir / "filelist.db")
+        self.sqlite.create_function(
+            "REGEXP", 2, lambda p, s: s is not None and re.search(p, s) is not None
+        )
+        self.sqlite.execute(
+            "CREATE TABLE filelist (filename TEXT, directory TEXT, filesize INTEGER, datetime TEXT)"
+        )
+        self.sqlite.executemany(
+            "INSERT INTO filelist VALUES (?, ?, ?, ?)",
+            (
+                (r["filename"], r["directory"], r["filesize"], str(r["filedate"]))
+                for r in rows
+            ),
+        )
+        self.sqlite.commit()
+
+    def close(self):
+        self.snap.close()
+        self.sqlite.close()
+
+    def run(self, strategy: str, keywords: list):
+        """1回検索して (時間[ミリ秒], 件数, 読んだ行数) を返す（行数は分からないので None）"""
+        time_start = time.perf_counter()
+        if strategy == "nameindex":
+            count = len(self.index.search(keywords))
+        elif strategy == "snapshot":
+            count = sum(1 for _ in self.snap.search(keywords))
+        elif strategy == "sqlite_like":
+            conds = " AND ".join(["(filename LIKE ? OR directory LIKE ?)"] * len(keywords))
+            params = [f"%{k}%" for k in keywords for _ in range(2)]
+            count = len(self.sqlite.execute(f"SELECT * FROM filelist WHERE {conds}", params).fetchall())
+        elif strategy == "sqlite_regexp":
+            rx = migemo_regexp(keywords[0])
+            count = len(
+                self.sqlite.execute(
+                    "SELECT * FROM filelist WHERE filename REGEXP ? OR directory REGEXP ?",
+                    [rx, rx],
+                ).fetchall()
+            )
+        else:
+            raise ValueError(strategy)
+        return (time.perf_counter() - time_start) * 1000, count, None
+
+
+def bench(runner, strategy: str, repeat: int) -> dict:
+    """QUERIES を repeat 回ずつ検索した結果"""
+    samples = []
+    per_query = {}
+    scanned = []
+    for keywords in QUERIES:
+        times = []
+        result = None
+        for _ in range(repeat):
+            if (result := runner.run(strategy, keywords)) is None:
+                break
+            times.append(result[0])
+            if result[2] is not None:
+                scanned.append(result[2])
+        if result is None:
+            continue
+        samples += times
+        per_query[" ".join(keywords)] = dict(
+            percentiles(times), rows=result[1], rows_scanned=result[2]
+        )
+    summary = percentiles(samples)
+    summary["rows_scanned"] = statistics.mean(scanned) if scanned else None
+    summary["queries"] = per_query
+    return summary
+
+
+def compare(results: dict, baseline_file: Path, tolerance: float) -> bool:
+    """baseline と比べて p95 が tolerance 倍を超えた方式があれば False"""
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    ok = True
+    for strategy, r in results.items():
+        if (b := baseline.get(strategy)) is None or not b["p95"] or r["p95"] is None:
+            continue
+        ratio = r["p95"] / b["p95"]
+        status = "OK"
+        if ratio > tolerance:
+            status = "SLOW"
+            ok = False
+        logger.info(f"{strategy:14} p95 {r['p95']:9.2f} ms / baseline {b['p95']:9.2f} ms ({ratio:.2f}x) {status}")
+    return ok
+
+
+def main():
+    config = load_config()
+    parser = argparse.ArgumentParser(description="検索方式ごとの検索時間を計測する")
+    parser.add_argument(
+        "-n",
+        "--rows",
+        type=int,
+        default=100000,
+        help="number of synthetic records (100k - 5M)",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=5,
+        help="number of runs per query",
+    )
+    parser.add_argument(
+        "-s",
+        "--strategy",
+        choices=STRATEGIES,
+        action="append",
+        help="strategies to run (default: all; DB strategies need MariaDB)",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="run only the strategies that don't need MariaDB",
+    )
+    parser.add_argument(
+        "-t",
+        "--table",
+        type=str,
+        default=f"{config['table_name']}_bench",
+        help="table name for the synthetic videolist (dropped afterwards)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="random seed of the synthetic data",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        default=Path(time.strftime("bench_search-%Y%m%d-%H%M%S.json")),
+        help="JSON file to save the results",
+    )
+    parser.add_argument(
+        "--compare",
+        type=Path,
+        metavar="JSON",
+        help="compare p95 with a previous result and exit 1 if slower than tolerance",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.2,
+        help="allowed p95 ratio to the baseline (default: 1.2)",
+    )
+    args = parser.parse_args()
+
+    strategies = args.strategy or (OFFLINE_STRATEGIES if args.offline else STRATEGIES)
+    logger.info(f"generating {args.rows} records")
+    rows = generate_rows(args.rows, args.seed)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if offline := [s for s in strategies if s in OFFLINE_STRATEGIES]:
+            runner = OfflineBench(rows, Path(tmp))
+            try:
+                for s in offline:
+                    results[s] = bench(runner, s, args.repeat)
+            finally:
+                runner.close()
+    if online := [s for s in strategies if s in DB_STRATEGIES]:
+        runner = DbBench(config, args.table)
+        try:
+            logger.info(f"loading {args.rows} records into {args.table}")
+            runner.setup(rows)
+            for s in online:
+                results[s] = bench(runner, s, args.repeat)
+        finally:
+            runner.drop()
+            runner.close()
+
+    for s, r in results.items():
+        if r["p50"] is None:
+            logger.info(f"{s:14} (not applicable)")
+            continue
+        logger.info(
+            f"{s:14} p50 {r['p50']:9.2f} ms  p95 {r['p95']:9.2f} ms  p99 {r['p99']:9.2f} ms"
+            + (f"  scanned {r['rows_scanned']:,.0f}" if r["rows_scanned"] is not None else "")
+        )
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "rows": args.rows,
+                "repeat": args.repeat,
+                "seed": args.seed,
+                "queries": [" ".join(q) for q in QUERIES],
+                "results": results,
+            },
+            f,
+            ensure_ascii=False,
+            indent=2,
+        )
+    logger.info(f"saved to {args.output}")
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    ch = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s %(name)-12s %(levelname)-8s %(message)s")
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    main()
@@ -0,0 +1,156 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+bench_stage.py:
+remux の入力の用意（mp4copy.remux_file）にかかる時間のベンチマーク
+
+指定のディレクトリ（エンコードフォルダと同じボリュームにする）に動画と音声のダミーを作り、
+一時的な名前で用意する時間を方式ごとに計測して表示し、JSONに保存する。
+
+    copy        以前の方法（shutil.copy で中身をコピーする）
+    hardlink    ハードリンク
+    reflink     コピーオンライトの複製（対応するファイルシステムのみ）
+    symlink     シンボリックリンク
+    stage       mp4copy と同じ手順（動画は hardlink/reflink/copy、音声は使える方法から順に）
+
+    python bench_stage.py -d x:/Enc-test --size 4000
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from mp4core.fileops import METHODS, PRIVATE_METHODS, stage
+
+logger = logging.getLogger(__name__)
+
+# 音声（m4a）の大きさ（動画に対する比）
+AUDIO_RATIO = 0.02
+
+
+def make_file(path: Path, size: int):
+    """size バイトの（中身が0でない）ファイルを作る"""
+    chunk = os.urandom(1 << 20)
+    with open(path, "wb") as f:
+        for _ in range(size >> 20):
+            f.write(chunk)
+        f.write(chunk[: size & ((1 << 20) - 1)])
+
+
+def prepare(files: list, tmpdir: Path, method: str) -> float:
+    """files を tmpdir に method で用意して片付けるまでの時間[秒]"""
+    staged = []
+    try:
+        time_start = time.perf_counter()
+        for i, f in enumerate(files):
+            dst = tmpdir / f"staged{i}{f.suffix}"
+            if method == "stage":
+                methods = ["hardlink"] + PRIVATE_METHODS if i == 0 else None
+                stage(f, dst, methods=methods)
+            else:
+                stage(f, dst, methods=[method])
+            staged.append(dst)
+        return time.perf_counter() - time_start
+    finally:
+        for f in staged:
+            f.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="remux の入力を用意する時間を計測する")
+    parser.add_argument(
+        "-d",
+        "--dir",
+        type=Path,
+        default=None,
+        help="directory on the same volume as the encode folder (default: temp dir)",
+    )
+    parser.add_argument(
+        "-s",
+        "--size",
+        type=int,
+        default=1000,
+        help="size of the dummy video in MB",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of runs per method",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        default=Path(time.strftime("bench_stage-%Y%m%d-%H%M%S.json")),
+        help="JSON file to save the results",
+    )
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        tmpdir = Path(tmp)
+        video = tmpdir / "video file.mp4"
+        audios = [tmpdir / "audio file 1.m4a", tmpdir / "audio file 2.m4a"]
+        size = args.size << 20
+        logger.info(f"creating {args.size} MB of dummy files in {tmpdir}")
+        make_file(video, size)
+        for a in audios:
+            make_file(a, int(size * AUDIO_RATIO))
+        files = [video] + audios
+        total = sum(f.stat().st_size for f in files)
+        for method in METHODS + ["stage"]:
+            times = []
+            try:
+                for _ in range(args.repeat):
+                    times.append(prepare(files, tmpdir, method))
+            except OSError as e:
+                logger.info(f"{method:9} not supported: {e}")
+                results[method] = None
+                continue
+            median = statistics.median(times)
+            results[method] = {
+                "median_ms": round(median * 1000, 3),
+                "min_ms": round(min(times) * 1000, 3),
+                "mb_per_s": round(total / (1 << 20) / median, 1) if median else None,
+            }
+            logger.info(
+                f"{method:9} median {median * 1000:10.2f} ms  min {min(times) * 1000:10.2f} ms"
+            )
+    if results.get("copy") and results.get("stage"):
+        logger.info(
+            "stage is %.0fx faster than copy",
+            results["copy"]["median_ms"] / max(results["stage"]["median_ms"], 0.001),
+        )
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "size_mb": args.size,
+                "repeat": args.repeat,
+                "results": results,
+            },
+            f,
+            ensure_ascii=False,
+            indent=2,
+        )
+    logger.info(f"saved to {args.output}")
+
+
+if __name__ == "__main__":
+    ch = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s %(name)-12s %(levelname)-8s %(message)s")
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    main()
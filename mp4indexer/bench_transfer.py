@@ -0,0 +1,184 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+bench_transfer.py:
+mp4copy のコピー（mp4core.fileops.transfer）と shutil の速度のベンチマーク
+
+コピー元のディレクトリに大きなファイルを作り、コピー先のディレクトリ（別のドライブにすると
+アーカイブへのコピーと同じ条件になる）へ方式ごとにコピーして、MB/s と CPU 時間を表示し、
+JSONに保存する。--sparse ではディスクを読まない疎なファイルにするので、
+ディスクの速さではなくコピーの処理自体のコスト（CPU 時間）を比べられる。
+
+    shutil.copy         以前の方法
+    shutil.copy2        更新日時も保つ shutil
+    transfer            mp4copy と同じ（使える方法のうち最初のもの）
+    copy_file_range     transfer で方法を固定したもの
+    sendfile
+    read
+
+    python bench_transfer.py -s x:/tmp -d m:/tmp --size 4000
+    python bench_transfer.py --sparse --size 20000
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from mp4core.fileops import transfer
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = [
+    "shutil.copy",
+    "shutil.copy2",
+    "transfer",
+    "copy_file_range",
+    "sendfile",
+    "read",
+]
+
+
+def make_file(path: Path, size: int, sparse: bool):
+    """size バイトのファイルを作る（sparse なら中身のない疎なファイル）"""
+    with open(path, "wb") as f:
+        if sparse:
+            f.truncate(size)
+            return
+        chunk = os.urandom(1 << 20)
+        for _ in range(size >> 20):
+            f.write(chunk)
+
+
+def copy_once(strategy: str, src: Path, dstdir: Path):
+    """一度コピーして (経過時間[秒], CPU 時間[秒], 使った方法) を返す（コピーは消す）"""
+    dst = dstdir / src.name
+    cpu_start = os.times()
+    time_start = time.perf_counter()
+    if strategy == "shutil.copy":
+        shutil.copy(src, dst)
+        method = strategy
+    elif strategy == "shutil.copy2":
+        shutil.copy2(src, dst)
+        method = strategy
+    elif strategy == "transfer":
+        method = transfer(src, dst)["method"]
+    else:
+        method = transfer(src, dst, methods=[strategy])["method"]
+    elapsed = time.perf_counter() - time_start
+    cpu_end = os.times()
+    dst.unlink()
+    cpu = (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+    return elapsed, cpu, method
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ファイルのコピーの速度を計測する")
+    parser.add_argument(
+        "-s",
+        "--src",
+        type=Path,
+        default=None,
+        help="directory for the source file (default: temp dir)",
+    )
+    parser.add_argument(
+        "-d",
+        "--dest",
+        type=Path,
+        default=None,
+        help="destination directory, ideally on another drive (default: temp dir)",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=2000,
+        help="size of the test file in MB",
+    )
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        help="use a sparse test file (measures copy overhead rather than disk speed)",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of runs per strategy",
+    )
+    parser.add_argument(
+        "--strategy",
+        choices=STRATEGIES,
+        action="append",
+        help="strategies to run (default: all)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        default=Path(time.strftime("bench_transfer-%Y%m%d-%H%M%S.json")),
+        help="JSON file to save the results",
+    )
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir=args.src) as srcdir, tempfile.TemporaryDirectory(
+        dir=args.dest
+    ) as dstdir:
+        src = Path(srcdir) / "recording.m2ts"
+        size = args.size << 20
+        logger.info(f"creating {args.size} MB {'sparse ' if args.sparse else ''}file in {srcdir}")
+        make_file(src, size, args.sparse)
+        for strategy in args.strategy or STRATEGIES:
+            runs = []
+            try:
+                for _ in range(args.repeat):
+                    runs.append(copy_once(strategy, src, Path(dstdir)))
+            except OSError as e:
+                logger.info(f"{strategy:16} not supported: {e}")
+                results[strategy] = None
+                continue
+            elapsed = statistics.median(r[0] for r in runs)
+            cpu = statistics.median(r[1] for r in runs)
+            results[strategy] = {
+                "method": runs[-1][2],
+                "median_s": round(elapsed, 4),
+                "mb_per_s": round(args.size / elapsed, 1) if elapsed else None,
+                "cpu_s": round(cpu, 4),
+            }
+            logger.info(
+                f"{strategy:16} {results[strategy]['mb_per_s']:10.1f} MB/s"
+                f"  cpu {cpu:7.3f} s  ({runs[-1][2]})"
+            )
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "size_mb": args.size,
+                "sparse": args.sparse,
+                "repeat": args.repeat,
+                "results": results,
+            },
+            f,
+            ensure_ascii=False,
+            indent=2,
+        )
+    logger.info(f"saved to {args.output}")
+
+
+if __name__ == "__main__":
+    ch = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s %(name)-12s %(levelname)-8s %(message)s")
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    main()
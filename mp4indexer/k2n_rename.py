@@ -8,7 +8,7 @@ k2n_filenames.py:
 
 漢数字のパターンは、"([一二三四五六七八九壱弐参十][一二三四五六七八九〇壱弐参十]*)"で
 "([話章説])"があとに続くものとする。
-パターンはリテラル kansuji で指定する。
+パターンは mp4core.normalize の kansuji で指定する（検索用の正規化と同じもの）。
 """
 
 import argparse
@@ -17,14 +17,13 @@ import re
 from pathlib import Path
 from os import rename
 
-from jaconv import h2z
-from kanjize import kanji2number
+from mp4core.lazy import lazy_import
+# 置換する漢数字のパターン指定
+from mp4core.normalize import pattern
 
+jaconv = lazy_import("jaconv")
+kanjize = lazy_import("kanjize")
 
-# 置換する漢数字のパターン指定
-kansuji = "([一二三四五六七八九壱弐参十][一二三四五六七八九〇壱弐参十]*)"
-suffix = "([話章説夜幕])"
-pattern = kansuji + suffix
 workdir = "."
 
 
@@ -36,7 +35,7 @@ def k2n_replace(name):
     match = re.search(pattern, name)
     if match:
         repl = "{}{}".format(
-            h2z(str(kanji2number(match.group(1))), digit=True), match.group(2)
+            jaconv.h2z(str(kanjize.kanji2number(match.group(1))), digit=True), match.group(2)
         )
         new_name = re.sub(match.group(0), repl, name)
         return new_name
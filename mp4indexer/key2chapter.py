@@ -23,17 +23,28 @@ CHAPTER01=00:03:00.000
 CHAPTER01NAME=タイトル1
 CHAPTER02=00:06:30.000
 CHAPTER02NAME=タイトル2
+
+フレーム番号は動画のフレームレート（30000/1001 などの分数）で時刻にする。フレームレートは
+同じ名前の .mp4 のヘッダ（mp4core.mp4header）から読み、読めなければ 30000/1001 とする。
+
+-b/--batch では指定したディレクトリ（省略時はカレントディレクトリ）の下のすべての
+.keyframe をプロセスプールで変換する。同じ名前の .mp4 のヘッダから読めないときは、index DB
+（videolist の同じディレクトリの同じ名前の動画の frame_rate）を使う。.chapter.txt が
+.keyframe より新しければ変換しない（--force で変換する）。
 """
 
 import argparse
 import logging
+import os
 import sys
-from dateutil.relativedelta import relativedelta
+from fractions import Fraction
 
 # from glob import glob
 # from os.path import join, splitext
 from pathlib import Path
 
+from mp4core import mp4header
+
 logger = logging.getLogger(__name__)
 handler = logging.StreamHandler()
 formatter = logging.Formatter("%(asctime)s %(name)-12s %(levelname)-8s %(message)s")
@@ -42,43 +53,161 @@ logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 logger.propagate = False
 
+# フレームレートが分からないとき（NTSC）
+DEFAULT_FRAME_RATE = Fraction(30000, 1001)
+CHAPTER_SUFFIX = ".chapter.txt"
+
+
+def parse_keyframes(lines):
+    """.keyframe の行を一行ずつ読んで、チャプターを順に返す.
+
+    フレーム番号の行の次に "#Name=名前"（あるいは "#名前"）の行があれば、それを名前にする。
+
+    Yields:
+        (int, str): フレーム番号とチャプター名（名前がなければ ""）
+    """
+    frame = None
+    name = ""
+    for line in lines:
+        s = line.rstrip()
+        if s.isdecimal():  # if line is frame number
+            if frame is not None:
+                yield frame, name
+            frame, name = int(s), ""
+        elif s.startswith("#") and frame is not None:  # if line is chapter name
+            name = s[1:]
+            if name.startswith("Name="):
+                name = name[len("Name=") :]
+        elif s:
+            logger.debug("skip line: %s", s)
+    if frame is not None:
+        yield frame, name
+
+
+def frame_time(frame: int, fps: Fraction) -> str:
+    """フレーム番号の時刻（HH:MM:SS.mmm、ミリ秒に四捨五入）"""
+    # 整数だけで計算する（Fraction の演算はチャプターごとには遅い）
+    msec = (frame * 2000 * fps.denominator + fps.numerator) // (2 * fps.numerator)
+    return mp4header.format_duration(msec / 1000)
+
 
-def key2chapter(keyfile):
+def video_frame_rate(video: Path):
+    """動画のヘッダから読んだフレームレート（読めなければ None）"""
+    try:
+        header = mp4header.parse(video)
+    except (OSError, mp4header.Mp4HeaderError):
+        return None
+    for track in header["tracks"]:
+        if track["handler"] == "vide" and track.get("frame_rate"):
+            return Fraction(track["frame_rate"])
+    return None
+
+
+def key2chapter(keyfile, fps: Fraction = None, fallback: Fraction = None) -> bool:
+    """.keyframe を .chapter.txt に変換する.
+
+    Args:
+        keyfile (Path): .keyframe ファイル
+        fps (Fraction): フレームレート（None なら同じ名前の .mp4 から読む）
+        fallback (Fraction): .mp4 から読めないときのフレームレート（None なら 30000/1001）
+    Returns:
+        (bool): 変換できたか
+    """
     kffile = Path(keyfile)
-    chapname = kffile.with_suffix(".chapter.txt")
+    chapname = kffile.with_suffix(CHAPTER_SUFFIX)
     logger.debug("base: %s", chapname)
+    if fps is None:
+        fps = (
+            video_frame_rate(kffile.with_suffix(".mp4")) or fallback or DEFAULT_FRAME_RATE
+        )
+    # 書きかけの .chapter.txt が残ると --batch で新しいとみなされるので、書き終えてから置き換える
+    tmpname = chapname.with_name(chapname.name + ".tmp")
     try:
         with open(kffile, "r", encoding="utf-8") as f:
-            with open(chapname, "w", encoding="utf-8") as outfile:
-                lines = f.readlines()
-                i = 0  # line number
-                j = 1  # chapter number
-                while i < len(lines):
-                    chap = ""
-                    s = lines[i].rstrip()
-                    if s == "":  # skip blank line
-                        i = i + 1
-                        continue
-                    if s.isdecimal():  # if line is frame number
-                        rd = relativedelta(seconds=round(int(s) * 0.0333667))
-                        chap = "{:02}".format(j)
-                    if (i + 1) < len(lines):
-                        if lines[i + 1][0] == "#":  # if next line is chapter name
-                            chap = lines[i + 1].lstrip("#Name=").rstrip()
-                            i = i + 1
-                    time = "{0.hours:02}:{0.minutes:02}:{0.seconds:02}.000".format(rd)
-                    outfile.write(f"CHAPTER{j:02}={time}\n")
-                    outfile.write(f"CHAPTER{j:02}NAME={chap}\n")
-                    i = i + 1
-                    j = j + 1
+            with open(tmpname, "w", encoding="utf-8") as outfile:
+                for j, (frame, chap) in enumerate(parse_keyframes(f), 1):
+                    outfile.write(f"CHAPTER{j:02}={frame_time(frame, fps)}\n")
+                    outfile.write(f"CHAPTER{j:02}NAME={chap or f'{j:02}'}\n")
+        os.replace(tmpname, chapname)
     except FileNotFoundError:
         logger.error("keyframeファイルがありません: [%s]", kffile)
         return False
     except Exception as e:
         logger.error(e)
+        tmpname.unlink(missing_ok=True)
+        return False
+    return True
+
+
+def is_up_to_date(keyfile: Path) -> bool:
+    """.chapter.txt が .keyframe より新しいか"""
+    try:
+        return keyfile.with_suffix(CHAPTER_SUFFIX).stat().st_mtime >= keyfile.stat().st_mtime
+    except FileNotFoundError:
         return False
+
+
+def video_key(directory, stem: str) -> tuple:
+    """frame_rates_from_db のキー（ディレクトリと拡張子を除いた名前。大文字小文字は区別しない）"""
+    return Path(directory).absolute().as_posix().casefold(), stem.casefold()
+
+
+def frame_rates_from_db() -> dict:
+    """index DB に登録されている動画のフレームレート（video_key -> Fraction）"""
+    from mp4core.config import connect, load_config
+
+    config = load_config()
+    conn = connect(config)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT directory, filename, frame_rate FROM {config['table_name']}"
+            " WHERE frame_rate <> ''"
+        )
+        return {
+            video_key(dirname, Path(fname).stem): Fraction(rate) for dirname, fname, rate in cur
+        }
     finally:
-        return True
+        conn.close()
+
+
+def convert_tree(roots: list, jobs: int = None, force: bool = False, use_db: bool = True):
+    """roots の下のすべての .keyframe をプロセスプールで変換する.
+
+    Returns:
+        (int, int, int): 変換したファイル、最新なので飛ばしたファイル、失敗したファイルの数
+    """
+    # mp4copy から key2chapter だけを使うときには読み込まない
+    from concurrent.futures import ProcessPoolExecutor
+
+    keyfiles = []
+    for root in roots:
+        keyfiles += sorted(root.rglob("*.keyframe")) if root.is_dir() else [root]
+    todo = [f for f in keyfiles if force or not is_up_to_date(f)]
+    logger.info("%d of %d keyframe files to convert", len(todo), len(keyfiles))
+    if not todo:
+        return 0, len(keyfiles), 0
+    rates = {}
+    if use_db:
+        try:
+            rates = frame_rates_from_db()
+            logger.debug("frame rates of %d videos from the DB", len(rates))
+        except Exception as e:
+            logger.warning(f"couldn't read frame rates from the DB: {e}")
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(jobs) as executor:
+        results = list(
+            executor.map(
+                key2chapter,
+                todo,
+                [None] * len(todo),
+                # 同じ名前の .mp4 のヘッダが一番確かなので、DB は読めなかったときに使う
+                [rates.get(video_key(f.parent, f.stem)) for f in todo],
+                chunksize=max(1, len(todo) // (jobs * 4)),
+            )
+        )
+    failed = results.count(False)
+    return len(todo) - failed, len(keyfiles) - len(todo), failed
 
 
 if __name__ == "__main__":
@@ -93,7 +222,32 @@ if __name__ == "__main__":
         metavar="files",
         type=str,
         nargs="*",
-        help="files to convert from .kerframe to .chapter.txt",
+        help="files to convert from .kerframe to .chapter.txt (directories with --batch)",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        help="Convert every .keyframe under the directories in parallel, "
+        "skipping ones whose .chapter.txt is newer",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of worker processes in --batch mode (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Convert even if the .chapter.txt is up to date (--batch)",
+    )
+    parser.add_argument(
+        "--no-db",
+        action="store_true",
+        help="Don't read frame rates from the index DB (--batch)",
     )
     parser.add_argument(
         "-d",
@@ -115,6 +269,13 @@ if __name__ == "__main__":
     i = 0
     logger.info(sys.argv)
 
+    if args.batch:
+        converted, skipped, failed = convert_tree(
+            [Path(d) for d in args.files or [path]], args.jobs, args.force, not args.no_db
+        )
+        logger.info("converted %d, up to date %d, failed %d", converted, skipped, failed)
+        sys.exit(1 if failed else 0)
+
     if len(args.files) == 0:
         p = Path(path)
         files = p.glob("*.keyframe")
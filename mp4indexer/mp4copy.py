@@ -7,6 +7,8 @@ mp4copy.py:
 
 mp4ファイルに対応する*.aacファイルがある場合、aacファイルを音声エンコード後に
 remuxer（L-SMASH）でmuxしてからコピー/移動する。
+remux の出力は moov ボックスだけを読んで入力とトラック数・長さ・チャプター数を比べ、
+合わなければ元のファイルに戻す（元のファイルは削除しない）。
 コピー/移動が終わったらそれぞれのmp4ファイルのプロジェクトファイルを削除する。
 
 ・複数のファイルを指定できる
@@ -15,22 +17,51 @@ remuxer（L-SMASH）でmuxしてからコピー/移動する。
 copyright (c) K.Fujii 2022
 created : Sep 1, 2019
 last modified: Aug 19, 2022
+
+コピー・移動は mp4core.fileops.transfer で行う（同じデバイスなら名前の変更だけ、
+違うデバイスならチェックサムを計算しながらコピーして "名前.chk" に書き、更新日時を保つ）。
+中断したコピーは次の実行で続きから再開する。
+
+コピー・移動した動画はその場でプローブして videolist に登録する（mp4indexer を待たない）。
+
+処理するファイルはジョブキュー（mp4core.jobqueue、SQLite）に登録してから取り出すので、
+複数のフォルダで同時に実行してもよく、途中で落ちても次の実行で続きから処理する。
+
+--watch では Enc-* フォルダを監視し（mp4core.watch）、書き終わった動画を
+手で実行しなくてもすぐに処理する。
+
+ファイルごとの処理（音声エンコード→key2chapter→remux→コピー・移動・削除）は
+依存関係のあるタスクとして mp4core.scheduler で実行する。音声エンコードは並列に、
+remux とコピーは書き込み先のデバイスごとに順に行うので、エンコードとコピーが重なる。
 """
 
 import argparse
+import glob
 import logging
 import os
 import random
+import re
 import shutil
 import string
-from ctypes import byref, windll, wintypes
+import threading
+import time
 from pathlib import Path
-from shutil import copy, move
 from subprocess import run
 
 from key2chapter import key2chapter
+from mp4core.console import (
+    BRIGHT_RED,
+    BRIGHT_YELLOW,
+    DEFAULT,
+    color_console_enable,
+)
+from mp4core import mp4header, probe, search, snapshot, videolist
+from mp4core.config import connect, load_config
+from mp4core.fileops import PRIVATE_METHODS, stage, transfer
+from mp4core.jobqueue import JobQueue, worker_id
+from mp4core.scheduler import Scheduler
+from mp4core.watch import StableFiles, open_watcher
 from send2trash import send2trash
-from win32api import SetConsoleTitle
 
 # import pdb; pdb.set_trace()
 
@@ -40,38 +71,30 @@ path = Path(".")
 remuxer = Path("c:/Apps/aviutl/remuxer.exe")
 qaac = Path("c:/Apps/aviutl/qaac64.exe")
 without_ts = False
-
-BRIGHT_RED = "\033[91m"
-BRIGHT_GREEN = "\033[92m"
-BRIGHT_YELLOW = "\033[93m"
-BRIGHT_BLUE = "\033[94m"
-BRIGHT_MAGENTA = "\033[95m"
-BRIGHT_CYAN = "\033[96m"
-BRIGHT_WHITE = "\033[97m"
-DEFAULT = "\033[39m"
-
-
-def color_console_enable():
-    """Turn on colorized console."""
-    INVALID_HANDLE_VALUE = -1
-    # STD_INPUT_HANDLE = -10
-    STD_OUTPUT_HANDLE = -11
-    # STD_ERROR_HANDLE = -12
-    ENABLE_VIRTUAL_TERMINAL_PROCESSING = 0x0004
-    # ENABLE_LVB_GRID_WORLDWIDE = 0x0010
-
-    hOut = windll.kernel32.GetStdHandle(STD_OUTPUT_HANDLE)
-    if hOut == INVALID_HANDLE_VALUE:
-        return False
-    dwMode = wintypes.DWORD()
-    if windll.kernel32.GetConsoleMode(hOut, byref(dwMode)) == 0:
-        return False
-    dwMode.value |= ENABLE_VIRTUAL_TERMINAL_PROCESSING
-    # dwMode.value |= ENABLE_LVB_GRID_WORLDWIDE
-    if windll.kernel32.SetConsoleMode(hOut, dwMode) == 0:
-        return False
-    return True
-
+# コピー・移動した動画を videolist に登録する（--no-index で止める）
+update_index = True
+# コピーの読み込みにページキャッシュを使わない（--direct-io、O_DIRECT）
+direct_io = False
+# False ならスキップの確認で止まらない（--watch）
+interactive = True
+_prompt_lock = threading.Lock()
+
+VIDEO_SUFFIXES = {".mp4", ".mkv"}
+# remux の一時ファイルの名前の始まり（監視の対象にしない）
+TMP_PREFIX = "mp4copy_tmp_"
+# 書き込み中かどうかを調べるときに待つ秒数
+CHECK_INTERVAL = 2.0
+# --watch で書き終わったとみなすまでの秒数と、エンコードフォルダを探し直す間隔
+STABLE_SECONDS = 10.0
+RESCAN_SECONDS = 30.0
+WATCH_PATTERN = "Enc-*"
+# 一度にジョブキューから取り出すジョブの数と、ジョブがないときに待つ秒数
+BATCH_JOBS = 16
+POLL_SECONDS = 2.0
+# remux の前後でトラックの長さが違ってもよい秒数
+DURATION_TOLERANCE = 0.5
+# remux し終えた印（"名前.muxed"、中身は remux した動画の大きさと更新日時）
+MUXED_SUFFIX = ".muxed"
 
 def randomname(len=8):
     """ランダムなファイル名（デフォルト長は8文字）を返す.
@@ -84,35 +107,56 @@ def randomname(len=8):
     return "".join(random.choices(string.ascii_letters + string.digits, k=len))
 
 
-def open_check(files):
-    """ファイルがオープンされているかどうかを調べ、オープンされていれば処理対象から外す."""
-    for f in files:
-        if Path(f.stem + "_audio.m4a").exists():
-            # エンコード中の判定
-            files.remove(f)
-            break
-        else:
-            try:
-                """
-                os.tmpnam()はテンポラリファイル名を取得してから実際に使用するまでの間に横取りされる
-                セキュリティリスクがあるので、Python 3.0で削除されている。
-                pathlibではファイルがオープンされているかどうかを調べる方法（is_opened()など）がないので、
-                競合しないテンポラリファイル名を取得してそれをリネームすることでエラーが起きるかどうかを
-                確認するという方法を取るが、リネームのタイミングで横取りされる可能性があるため、
-                潜在的なリスクとなる。
-                fileオブジェクトであればclosedプロパティを検査することで確認できるが、
-                ファイルの内容を直接いじらずに検査することは難しい。
-                次善の策としてテンポラリファイル名を別途生成してリネームし、成功するかどうかを見る。
-                """
-                opencheck = Path("tmptmp" + randomname(10) + ".mp4")
-                f.rename(opencheck)
-                opencheck.rename(f)
-            except OSError:
-                files.remove(f)
+def is_settled(mp4file: Path, stable: float) -> bool:
+    """mp4ファイルと同じ名前の音声・keyframe などが書き終わっているか.
 
+    エンコード中は "名前_audio.m4a" がある。それ以外のファイルも stable 秒以上
+    更新されていなければ書き終わったとみなす。
+    """
+    if mp4file.with_name(mp4file.stem + "_audio.m4a").exists():
+        return False
+    now = time.time()
+    for f in mp4file.parent.glob(glob.escape(mp4file.stem) + "*"):
+        try:
+            if now - f.stat().st_mtime < stable:
+                return False
+        except FileNotFoundError:
+            pass
+    return True
+
+
+def ready_files(files: list, interval: float = CHECK_INTERVAL) -> list:
+    """書き込み中のファイルを処理対象から外す.
+
+    interval 秒おいて2回 stat し、大きさと更新日時が変わらず、
+    エンコード中の印（"名前_audio.m4a"）がないものだけを返す
+    （以前のように名前を変えてみて開かれているかを調べることはしない）。
+    """
+    before = {}
     for f in files:
+        try:
+            st = f.stat()
+            before[f] = (st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+    if before:
+        time.sleep(interval)
+    result = []
+    for f, sig in before.items():
+        try:
+            st = f.stat()
+        except FileNotFoundError:
+            continue
+        if (st.st_size, st.st_mtime_ns) == sig and is_settled(f, interval):
+            result.append(f)
+    for f in result:
         print("files:", f)
-    return files
+    return result
+
+
+def is_video(f: Path) -> bool:
+    """処理対象の動画か（mp4copy 自身の一時ファイルは除く）"""
+    return f.suffix.lower() in VIDEO_SUFFIXES and not f.name.startswith(TMP_PREFIX)
 
 
 def encode_audio(file: Path):
@@ -129,118 +173,578 @@ def encode_audio(file: Path):
     if not file.with_suffix(".m4a").exists():
         cmd = f'{qaac} -V 127 "{file}"'
         logger.debug(cmd)
-        run(cmd)
+        run(cmd, check=True)
     return file.with_suffix(".m4a")
 
 
-def remux_files(files):
+def device_of(p: Path) -> str:
+    """p（ディレクトリ）があるデバイスの I/O キューの名前"""
+    try:
+        return f"io:{os.stat(p).st_dev}"
+    except OSError:
+        return f"io:{Path(p).absolute().anchor}"
+
+
+def count_chapters(chapfile: Path) -> int:
+    """チャプターファイル（CHAPTERxx=時刻 の行）のチャプター数"""
+    return len(re.findall(rb"^CHAPTER\d+=", chapfile.read_bytes(), re.MULTILINE))
+
+
+def validate_remux(output: Path, video: Path, audios: list, chapfile: Path = None):
+    """remuxer の出力を入力とヘッダだけで比べる.
+
+    mp4header で moov ボックスだけを読む（ファイルの大きさによらず数KB〜数百KB）ので、
+    毎回確かめても時間はかからない。
+    ・映像トラックの数と長さが入力の動画と同じ
+    ・音声トラックの数が入力の動画と m4a の音声トラックの合計と同じで、長さもそれぞれ同じ
+    ・チャプター数がチャプターファイルと同じ
+    入力の動画が読めない（MP4でない）ときは確かめない。
+
+    Raises:
+        Mp4HeaderError: 出力が読めない、あるいは入力と合わない
+    """
+    try:
+        src = mp4header.parse(video)
+    except (OSError, mp4header.Mp4HeaderError) as e:
+        logger.warning(f"couldn't validate {output}: {e}")
+        return
+    out = mp4header.parse(output)
+
+    def tracks(info: dict, handler: str) -> list:
+        return [t for t in info["tracks"] if t["handler"] == handler]
+
+    problems = []
+    for kind, expected, actual in [
+        ("video", tracks(src, "vide"), tracks(out, "vide")),
+        (
+            "audio",
+            tracks(src, "soun") + [t for a in audios for t in tracks(mp4header.parse(a), "soun")],
+            tracks(out, "soun"),
+        ),
+    ]:
+        if len(actual) != len(expected):
+            problems.append(f"{len(actual)} {kind} tracks (expected {len(expected)})")
+            continue
+        for i, (e, a) in enumerate(zip(expected, actual)):
+            if abs(a["duration"] - e["duration"]) > DURATION_TOLERANCE:
+                problems.append(
+                    f"{kind} track {i + 1} is {mp4header.format_duration(a['duration'])}"
+                    f" (expected {mp4header.format_duration(e['duration'])})"
+                )
+    if chapfile is not None:
+        chapters = count_chapters(chapfile)
+        if out["chapters"] != chapters:
+            problems.append(f"{out['chapters']} chapters (expected {chapters})")
+    if problems:
+        raise mp4header.Mp4HeaderError(f"remux of {output} is broken: {', '.join(problems)}")
+    logger.debug(
+        f"validated {output}: {len(out['tracks'])} tracks, {out['chapters']} chapters,"
+        f" {mp4header.format_duration(out['duration'])}"
+    )
+
+
+def remux_inputs(mp4file: Path, m4afiles: list) -> list:
+    """remux の入力（m4a と元の aac、チャプター）のうち、あるもの"""
+    files = list(m4afiles) + [Path(f).with_suffix(".aac") for f in m4afiles]
+    files.append(mp4file.with_name(mp4file.stem + ".chapter.txt"))
+    return [Path(f) for f in files if Path(f).exists()]
+
+
+def muxed_marker(mp4file: Path) -> Path:
+    """remux し終えた印のファイル"""
+    return mp4file.with_name(mp4file.stem + MUXED_SUFFIX)
+
+
+def _signature(mp4file: Path) -> str:
+    st = mp4file.stat()
+    return f"{st.st_size} {st.st_mtime_ns}"
+
+
+def mark_muxed(mp4file: Path):
+    """mp4file を remux し終えたことを記録する"""
+    muxed_marker(mp4file).write_text(_signature(mp4file), encoding="utf-8")
+
+
+def is_muxed(mp4file: Path) -> bool:
+    """mp4file がこのプログラムで remux し終えたものか
+
+    印の大きさと更新日時が今の動画と違えば（同じ名前でエンコードし直した）remux していない
+    """
+    try:
+        return muxed_marker(mp4file).read_text(encoding="utf-8") == _signature(mp4file)
+    except (OSError, ValueError):
+        return False
+
+
+def remux_file(mp4file: Path, m4afiles: list):
+    """MP4ファイルとm4aファイル（とチャプター）をremuxする.
+
+    remuxer の入力は空白のない一時的な名前で用意する（mp4box は名前に空白があると扱えない）。
+    中身はコピーせず、できればハードリンク・reflink・シンボリックリンクにする（mp4core.fileops）。
+    動画をハードリンクにしたときは、remuxer の出力が入力と同じ inode を上書きしないように
+    元の名前を空けておく。remuxer が失敗したり、出力のヘッダが入力と合わなかったり
+    （validate_remux）したら元の動画に戻して例外にする（このファイルのコピー・移動と
+    元のファイルの削除はしない）。
+
+    remux できたら印（muxed_marker）を書いて、入力（m4a・aac・チャプター）はすぐにゴミ箱に移す。
+    コピーが失敗してジョブを再試行したときに、mux した動画に同じ音声をもう一度 mux しないように
+    するため。入力を移し終える前に落ちたときは、印があれば remux しない（音声トラックの数では
+    判断しない。元から音声のある動画の音声を捨ててしまう）。
+    """
+    folder = mp4file.parent
+    if is_muxed(mp4file):
+        logger.info("already muxed: %s", mp4file)
+        trash_remux_inputs(mp4file, m4afiles)
+        return
+    chapfile = mp4file.with_name(mp4file.stem + ".chapter.txt")
+    tmp_video0 = folder / (TMP_PREFIX + randomname() + ".mp4")
+    tmp_audio1 = folder / (TMP_PREFIX + randomname() + ".m4a")
+    tmp_audio2 = folder / (TMP_PREFIX + randomname() + ".m4a")
+    tmp_chapter3 = folder / (TMP_PREFIX + randomname() + ".chapter.txt")
+    video_staged = False
+    audios = [tmp_audio1]
+    try:
+        # ハードリンクなら元の名前を空けるので、シンボリックリンクは使えない
+        method = stage(mp4file, tmp_video0, methods=["hardlink"] + PRIVATE_METHODS)
+        video_staged = True
+        logger.debug(f'{method} "{mp4file}" {tmp_video0}')
+        if method == "hardlink":
+            mp4file.unlink()
+        logger.debug(f'{stage(m4afiles[0], tmp_audio1)} "{m4afiles[0]}" {tmp_audio1}')
+        if len(m4afiles) == 2 and Path(m4afiles[1]).exists():
+            logger.debug(f'{stage(m4afiles[1], tmp_audio2)} "{m4afiles[1]}" {tmp_audio2}')
+            audios.append(tmp_audio2)
+        if chapfile.exists():
+            logger.debug(f'{stage(chapfile, tmp_chapter3)} "{chapfile}" {tmp_chapter3}')
+            chap_exists = True
+        else:
+            chap_exists = False
+        # remux video file（フォルダの名前の空白を避けるため、フォルダで実行して名前だけ渡す）
+        cmd = f'{remuxer} -i {tmp_video0.name} -i {tmp_audio1.name} -o "{mp4file.name}"'
+        if len(m4afiles) == 2:
+            # 二ヶ国語のとき
+            logger.info("mux dual audio: %s", mp4file)
+            cmd += f" -i {tmp_audio2.name}"
+        else:
+            logger.info("mux single audio: %s", mp4file)
+
+        if chap_exists:  # chapterファイルがある場合
+            cmd += f" --chapter {tmp_chapter3.name}"
+        logger.debug(cmd)
+        run(cmd, check=True, cwd=folder)
+        validate_remux(mp4file, tmp_video0, audios, tmp_chapter3 if chap_exists else None)
+    except BaseException:
+        if video_staged:
+            os.replace(tmp_video0, mp4file)
+        raise
+    finally:
+        for f in [tmp_video0, tmp_audio1, tmp_audio2, tmp_chapter3]:
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                pass
+    mark_muxed(mp4file)
+    trash_remux_inputs(mp4file, m4afiles)
+
+
+def trash_remux_inputs(mp4file: Path, m4afiles: list):
+    """mux し終えた入力をゴミ箱に移す"""
+    for f in remux_inputs(mp4file, m4afiles):
+        logger.debug(f'send2trash "{f}"')
+        try:
+            send2trash(f)
+        except FileNotFoundError:
+            pass
+
+
+def plan_file(scheduler: Scheduler, mp4file: Path, indexer=None):
+    """一つのMP4ファイルの処理を依存関係つきでスケジューラに登録する.
+
+        encode (cpu) ──┐
+        encode (cpu) ──┼─> remux (作業ディレクトリのI/O) ─> copy (出力先のI/O) ─> index (db)
+        key2chapter ───┘
+
+    音声がなければ remux はせずにコピー・移動だけする。remux し終えている（前の試行で入力を
+    ゴミ箱に移す前に落ちた）ときも、エンコードと remux はしない（残った入力はコピーのあとで消す）。
+    """
+    base = mp4file.stem
+    folder = mp4file.parent
+    aacfiles = list(folder.glob(base.replace("[", "[[]") + "*.aac"))
+    m4afiles = list(folder.glob(base.replace("[", "[[]") + "*.m4a"))
+    keyfile = folder / (base + ".keyframe")
+    logger.debug(
+        'mp4 = "%s", aacfiles = %s, m4afiles = %s', mp4file, aacfiles, m4afiles
+    )
+    remux = None
+    if (len(aacfiles) != 0 or len(m4afiles) != 0) and not is_muxed(mp4file):
+        encodes = []
+        if len(m4afiles) == 0:
+            for f in aacfiles:
+                encodes.append(
+                    scheduler.add(f"encode {f}", encode_audio, f, group=mp4file)
+                )
+                m4afiles.append(f.with_suffix(".m4a"))
+        chapter = None
+        if keyfile.exists():
+            logger.debug(f'key2chapter "{keyfile}"')
+            chapter = scheduler.add(
+                f"key2chapter {keyfile}", key2chapter, keyfile, group=mp4file
+            )
+        remux = scheduler.add(
+            f"remux {mp4file}",
+            remux_file,
+            mp4file,
+            m4afiles,
+            deps=encodes + [chapter],
+            queue=device_of(folder),
+            group=mp4file,
+        )
+    copied = scheduler.add(
+        f"copy {mp4file}",
+        copy_file,
+        mp4file,
+        mp4dir,
+        deps=[remux],
+        queue=device_of(outdir),
+        group=mp4file,
+    )
+    if indexer is not None:
+        scheduler.add(
+            f"index {mp4file}",
+            indexer.index,
+            copied,
+            deps=[copied],
+            queue="db",
+            group=mp4file,
+        )
+
+
+class Indexer:
+    """コピー・移動した動画を videolist に登録する（db キューの1本のスレッドから使う）.
+
+    mp4indexer と同じプローブと登録の処理（mp4core.probe、mp4core.videolist）を使う。
+    プローブは1回だけ行い、コピー先と移動先の両方を登録する。
+    登録したら名前のスナップショットを書き直すので、mp4find ですぐに見つかる。
+    DB に接続できないときは警告して、以後は登録しない（次の mp4indexer で登録される）。
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.tablename = config["table_name"]
+        self.conn = None
+        self.cur = None
+        self.worker = None
+        self.count = 0
+        self.disabled = False
+
+    def _open(self):
+        self.conn = connect(self.config)
+        self.cur = self.conn.cursor(dictionary=True)
+        self.worker = probe.ProbeWorker(
+            timeout=self.config.get("probe_timeout") or probe.DEFAULT_TIMEOUT
+        )
+
+    def index(self, copy_task):
+        """copy_file の結果（コピー・移動した先）を登録する"""
+        files = [f for f in copy_task.result or [] if f.exists()]
+        if not files or self.disabled:
+            return
+        try:
+            if self.conn is None:
+                self._open()
+            result = probe.probe_file(files[0], self.worker)
+            if result.info is None:
+                logger.warning(f"{files[0]} couldn't be probed: {result.reason}")
+                return
+            if result.reason:
+                logger.warning(f"{files[0]}: {result.reason} ({result.strategy})")
+            for f in files:
+                videolist.upsert_video(self.cur, self.tablename, f, result.info)
+                logger.info("indexed %s", f)
+            self.conn.commit()
+            self.count += len(files)
+        except Exception as e:
+            logger.warning(f"couldn't update the index: {e}")
+            self.disabled = self.conn is None
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.close()
+        if self.conn is None:
+            return
+        if self.count and (snapshot_path := self.config["snapshot_path"]):
+            try:
+                n = snapshot.write_from_db(
+                    self.cur, self.tablename, snapshot_path, search.encoded_video_ext
+                )
+                logger.info(f"{n} names were written to {snapshot_path}")
+            except (OSError, snapshot.SnapshotError) as e:
+                logger.warning(f"couldn't write name snapshot: {e}")
+        self.conn.close()
+
+
+def remux_files(files, jobs: int = None):
     """MP4ファイルとAACファイルをremuxし、所定のディレクトリに移動・コピーする.
 
+    ファイルごとの処理（エンコード→remux→コピー）をスケジューラで並列に実行する。
+    音声エンコードは CPU の数まで並列に、remux とコピーは書き込み先のデバイスごとに
+    一つずつ順に行う。あるファイルが失敗しても、他のファイルの処理は続ける。
+
     Args:
         files (Path): mp4ファイル名のリスト
+        jobs (int): 音声エンコードの並列数（None なら CPU の数）
     Returns:
-        None.
+        (dict): 失敗したファイル -> 失敗した処理とエラー
     """
+    scheduler = Scheduler({"cpu": jobs} if jobs else None)
+    indexer = Indexer(load_config()) if update_index else None
     for mp4file in files:
-        base = mp4file.stem
-        aacfiles = list(path.glob(base.replace("[", "[[]") + "*.aac"))
-        m4afiles = list(path.glob(base.replace("[", "[[]") + "*.m4a"))
-        keyfile = base + ".keyframe"
-        chapfile = base + ".chapter.txt"
-        logger.debug(
-            'mp4 = "%s", aacfiles = %s, m4afiles = %s', mp4file, aacfiles, m4afiles
-        )
-        tmp_video0 = Path(randomname() + ".mp4")
-        tmp_audio1 = Path(randomname() + ".m4a")
-        tmp_audio2 = Path(randomname() + ".m4a")
-        tmp_chapter3 = Path(randomname() + ".chapter.txt")
-        if len(aacfiles) != 0 or len(m4afiles) != 0:
-            if len(m4afiles) == 0:
-                for f in aacfiles:
-                    m4afiles.append(encode_audio(f))
-            # mp4box doesn't allow spaces in filename.
-            logger.debug(f'copy "{mp4file}"" {tmp_video0}')
-            logger.debug(f'copy "{m4afiles[0]}" {tmp_audio1}')
-            if len(m4afiles) == 2:
-                logger.debug(f'copy "{m4afiles[1]}" {tmp_audio2}')
-            logger.debug(f'key2chapter "{keyfile}"')
-            logger.debug(f'copy "{chapfile}" {tmp_chapter3}')
-
-            copy(mp4file, tmp_video0)
-            copy(m4afiles[0], tmp_audio1)
-            if len(m4afiles) == 2 and Path(m4afiles[1]).exists():
-                copy(m4afiles[1], tmp_audio2)
-            if Path(keyfile).exists():
-                key2chapter(keyfile)
-            if Path(chapfile).exists():
-                copy(chapfile, tmp_chapter3)
-                chap_exists = True
+        plan_file(scheduler, mp4file, indexer)
+    try:
+        failed = {t.group: f"{t.name}: {t.error}" for t in scheduler.run()}
+    finally:
+        if indexer is not None:
+            indexer.close()
+    for f in failed:
+        print(BRIGHT_RED + f"{f}の処理に失敗しました。" + DEFAULT)
+    return failed
+
+
+def encode_folders(roots: list) -> list:
+    """roots の下のエンコードフォルダ（roots 自身が Enc-* ならそれも）"""
+    folders = []
+    for root in roots:
+        if root.match(WATCH_PATTERN):
+            folders.append(root)
+        folders += [d for d in root.glob(WATCH_PATTERN) if d.is_dir()]
+    return folders
+
+
+def process_jobs(
+    jobq: JobQueue,
+    batch: int = BATCH_JOBS,
+    jobs: int = None,
+    wait: bool = False,
+    stop: threading.Event = None,
+):
+    """ジョブキューからジョブを取り出して remux_files で処理する.
+
+    取り出したジョブは処理が終わるまでリースを延長し続ける。失敗したジョブ（コピー先が
+    使用中でコピー・移動できなかったものも含む）はジョブキューが後で再試行する。wait が False なら、取り出せるジョブがなくなったら終わる。
+    """
+    owner = worker_id()
+    while stop is None or not stop.is_set():
+        claimed = jobq.claim(owner, batch)
+        if not claimed:
+            if not wait:
+                return
+            time.sleep(POLL_SECONDS)
+            continue
+        files = {}
+        for job in claimed:
+            f = Path(job["path"])
+            if f.exists():
+                files[f] = job
             else:
-                chap_exists = False
-            # remux video file
-            cmd = f'{remuxer} -i {tmp_video0} -i {tmp_audio1} -o "{mp4file}"'
-            if len(m4afiles) == 2:
-                # 二ヶ国語のとき
-                logger.info("mux dual audio")
-                cmd += f" -i {tmp_audio2}"
+                # 前回の実行で移動し終えてから落ちた
+                logger.info(f"{f} is already processed")
+                jobq.complete(owner, job["id"])
+        if not files:
+            continue
+        with jobq.keep_alive(owner, [j["id"] for j in files.values()]):
+            try:
+                failed = remux_files(list(files), jobs)
+            except Exception as e:
+                logger.exception(f"pipeline failed: {e}")
+                failed = {f: str(e) for f in files}
+        for f, job in files.items():
+            if f in failed:
+                state = jobq.fail(owner, job["id"], failed[f])
+                logger.warning(f"{f}: {state} (attempt {job['attempts']})")
             else:
-                logger.info("mux single audio")
-
-            if chap_exists:  # chapterファイルがある場合
-                cmd += f" --chapter {tmp_chapter3}"
-            logger.debug(cmd)
-            run(cmd, check=False)
-        copy_file(mp4file, outdir)
+                jobq.complete(owner, job["id"])
+
+
+def watch_folders(
+    roots: list,
+    jobq: JobQueue,
+    stable: float = STABLE_SECONDS,
+    jobs: int = None,
+    workers: int = 1,
+):
+    """エンコードフォルダを監視して、書き終わった動画をすぐに remux・コピーする.
+
+    OSの通知（Linux は inotify の close_write、Windows は ReadDirectoryChangesW）の
+    あった動画を、大きさと更新日時が stable 秒変わらず、同じ名前の音声なども
+    書き終わったところでジョブキューに登録し、workers 個のスレッドが処理する。
+    新しいエンコードフォルダは RESCAN_SECONDS ごとに探す。
+    """
+    watcher = open_watcher()
+    logger.info("watching %s (%s)", ", ".join(map(str, roots)), type(watcher).__name__)
+    files = StableFiles(stable)
+    for _ in range(workers):
+        threading.Thread(
+            target=process_jobs,
+            args=(jobq, BATCH_JOBS, jobs, True),
+            daemon=True,
+        ).start()
+    watched = set()
+    next_scan = 0
+    try:
+        while True:
+            if time.monotonic() >= next_scan:
+                watched = {d for d in watched if d.exists()}
+                for folder in encode_folders(roots):
+                    if folder in watched:
+                        continue
+                    try:
+                        watcher.add(folder)
+                    except OSError as e:
+                        logger.warning(f"couldn't watch {folder}: {e}")
+                        continue
+                    watched.add(folder)
+                    logger.info("watch %s", folder)
+                    # 監視を始める前からある動画も調べる
+                    for f in folder.iterdir():
+                        if is_video(f):
+                            files.add(f)
+                next_scan = time.monotonic() + RESCAN_SECONDS
+            for f in watcher.read(1.0):
+                if is_video(f):
+                    files.add(f)
+            for f in files.ready():
+                if not is_settled(f, stable):
+                    files.add(f)
+                    continue
+                # 処理中・待ち・同じ内容で失敗したファイルは登録されない
+                try:
+                    jobq.enqueue(f)
+                except FileNotFoundError:
+                    pass
+    finally:
+        watcher.close()
+
+
+def pause(message: str):
+    """メッセージを表示してEnterを待つ（並列に動くタスクからの表示が混ざらないようにする）"""
+    if not interactive:
+        logger.warning(message)
+        return
+    with _prompt_lock:
+        input(message)
+
+
+def skip_or_raise(message: str, error: Exception):
+    """コピー・移動できなかったファイルを飛ばすか確認する
+
+    --watch では確認する人がいないので、error をそのまま送出してタスクを失敗にする
+    （元のファイルは残り、ジョブは後で再試行される）
+    """
+    if not interactive:
+        logger.error(message)
+        raise error
+    pause(message)
+
+
+def report_transfer(action: str, fname: Path, result: dict):
+    """コピー・移動の方法と速度を表示する"""
+    if result["method"] == "rename":
+        logger.info("%s %s (rename)", action, fname)
+    elif result["method"] == "skip":
+        logger.info("%s %s (already copied, sha256 %s)", action, fname, result["checksum"])
+    else:
+        logger.info(
+            "%s %s: %.1f MB in %.1f s, %.1f MB/s (%s)",
+            action,
+            fname,
+            result["bytes"] / (1 << 20),
+            result["seconds"],
+            result["mb_per_s"] or 0,
+            result["method"],
+        )
+        if result["resumed"]:
+            logger.info("resumed from %.1f MB", result["resumed"] / (1 << 20))
 
-        for f in [tmp_video0, tmp_audio1, tmp_audio2, tmp_chapter3]:
-            try:
-                f.unlink()
-            except FileNotFoundError:
-                pass
 
 def copy_file(fname: Path, destdir: Path):
+        """fname を destdir（$MP4DIR）にコピーし、outdir に移動する.
+
+        Returns:
+            (list): コピー・移動した先のmp4ファイル（videolist に登録する）
+        """
         # copy & move files
         base = Path(fname.name)
+        landed = []
         if mp4dir.exists() and not without_ts:
-            logger.info("copy %s to $MP4DIR", fname)
             try:
-                copy(fname, destdir)
-            except shutil.Error:
-                input(BRIGHT_RED + f"{fname}はすでに存在しているためスキップします。" + DEFAULT)
-            except FileNotFoundError:
-                input(BRIGHT_YELLOW + f"{fname}は見つからないためスキップします。" + DEFAULT)
+                report_transfer(
+                    "copy", fname, transfer(fname, destdir, verify=True, direct=direct_io)
+                )
+                landed.append(destdir / base)
+            except shutil.Error as e:
+                skip_or_raise(
+                    BRIGHT_RED + f"{fname}はすでに存在しているためスキップします。" + DEFAULT, e
+                )
+            except FileNotFoundError as e:
+                skip_or_raise(BRIGHT_YELLOW + f"{fname}は見つからないためスキップします。" + DEFAULT, e)
+        # 移動できなかったファイルはゴミ箱に移さない
+        unmoved = set()
         if outdir.exists() and not without_ts:
-            m2tsname = base.with_suffix(".m2ts")
-            logger.info("move %s", m2tsname)
+            m2tsname = fname.with_suffix(".m2ts")
             try:
-                move(m2tsname, outdir)
-            except shutil.Error:
-                input(BRIGHT_RED + f"{m2tsname}はすでに存在しているためスキップします。" + DEFAULT)
+                report_transfer(
+                    "move",
+                    m2tsname,
+                    transfer(m2tsname, outdir, move=True, verify=True, direct=direct_io),
+                )
+            except shutil.Error as e:
+                unmoved.add(m2tsname)
+                skip_or_raise(
+                    BRIGHT_RED + f"{m2tsname}はすでに存在しているためスキップします。" + DEFAULT, e
+                )
             except FileNotFoundError:
-                input(BRIGHT_YELLOW + f"{m2tsname}は見つからないためスキップします。" + DEFAULT)
-            except PermissionError:
-                input(BRIGHT_YELLOW + f"{m2tsname}は他のプロセスで開かれているためスキップします。" + DEFAULT)
+                pause(BRIGHT_YELLOW + f"{m2tsname}は見つからないためスキップします。" + DEFAULT)
+            except PermissionError as e:
+                unmoved.add(m2tsname)
+                skip_or_raise(
+                    BRIGHT_YELLOW
+                    + f"{m2tsname}は他のプロセスで開かれているためスキップします。"
+                    + DEFAULT,
+                    e,
+                )
 
-        logger.info("move %s", fname)
         try:
-            move(fname, outdir)
-        except shutil.Error:
-            input(BRIGHT_RED + f"{fname}はすでに存在しているためスキップします。" + DEFAULT)
-        except FileNotFoundError:
-            input(BRIGHT_YELLOW + f"{fname}は見つからないためスキップします。" + DEFAULT)
-        except PermissionError:
-            input(BRIGHT_YELLOW + f"{fname}は他のプロセスで開かれているためスキップします。" + DEFAULT)
-
-        for delfile in list(path.glob(base.stem.replace("[", "[[]") + "*")):
+            report_transfer(
+                "move", fname, transfer(fname, outdir, move=True, verify=True, direct=direct_io)
+            )
+            landed.append(outdir / base)
+        except shutil.Error as e:
+            skip_or_raise(BRIGHT_RED + f"{fname}はすでに存在しているためスキップします。" + DEFAULT, e)
+        except FileNotFoundError as e:
+            skip_or_raise(BRIGHT_YELLOW + f"{fname}は見つからないためスキップします。" + DEFAULT, e)
+        except PermissionError as e:
+            skip_or_raise(
+                BRIGHT_YELLOW + f"{fname}は他のプロセスで開かれているためスキップします。" + DEFAULT,
+                e,
+            )
+        if outdir / base not in landed:
+            # 移動していない動画と同じ名前のファイル（音声など）を消してしまわないようにする
+            return landed
+        muxed_marker(fname).unlink(missing_ok=True)
+
+        for delfile in list(fname.parent.glob(base.stem.replace("[", "[[]") + "*")):
+            if delfile in unmoved:
+                continue
             logger.debug(f'send2trash "{delfile}"')
             try:
                 send2trash(delfile)
             except FileNotFoundError:
-                input(BRIGHT_YELLOW + f"{delfile}は見つからないためスキップします。" + DEFAULT)
+                pause(BRIGHT_YELLOW + f"{delfile}は見つからないためスキップします。" + DEFAULT)
             except PermissionError:
-                input(BRIGHT_YELLOW + f"{delfile}は他のプロセスで開かれているためスキップします。" + DEFAULT)
+                pause(BRIGHT_YELLOW + f"{delfile}は他のプロセスで開かれているためスキップします。" + DEFAULT)
             except OSError:
-                input(BRIGHT_YELLOW + f"{delfile}は他のプロセスで開かれているためスキップします。" + DEFAULT)
+                pause(BRIGHT_YELLOW + f"{delfile}は他のプロセスで開かれているためスキップします。" + DEFAULT)
+        return landed
 
 
 if __name__ == "__main__":
@@ -265,6 +769,48 @@ if __name__ == "__main__":
         default=0,
         help="Print Debug information",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of parallel audio encodes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "-w",
+        "--watch",
+        type=Path,
+        nargs="+",
+        metavar="DIR",
+        help=f"Watch {WATCH_PATTERN} folders under DIR and process finished encodes",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker threads taking jobs from the queue in --watch mode",
+    )
+    parser.add_argument(
+        "--stable",
+        type=float,
+        default=STABLE_SECONDS,
+        help=f"Seconds a file must stay unchanged before processing (default: {STABLE_SECONDS})",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Requeue jobs that failed too many times (all of them in --watch mode)",
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="Don't register copied files to the index DB",
+    )
+    parser.add_argument(
+        "--direct-io",
+        action="store_true",
+        help="Read source files with O_DIRECT when copying (bypass the page cache)",
+    )
     parser.add_argument(
         "-t",
         "--wots",
@@ -277,31 +823,41 @@ if __name__ == "__main__":
     args = parser.parse_args()
     if args.wots:
         without_ts = True
+    if args.no_index:
+        update_index = False
+    if args.direct_io:
+        direct_io = True
     if args.debug:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
 
-    lockFile = Path.cwd() / "mp4copy.pid"
-    if lockFile.exists():
-        try:
-            lockFile.unlink()
-        except PermissionError:
-            exit()
-    else:
+    jobq = JobQueue(load_config()["job_queue"])
+    if args.watch:
+        if args.retry_failed:
+            jobq.retry_failed()
+        interactive = False
         color_console_enable()
-        SetConsoleTitle(Path.cwd().name.replace("Enc-", ""))
-        files = list(path.glob("*.mp4")) + list(path.glob("*.mkv"))
-
-        files = open_check(files)
-
         try:
-            with lockFile.open("w"):
-                lockFile.write_text(str(os.getpid()))
-                remux_files(files)
-        except shutil.Error:
+            watch_folders(args.watch, jobq, args.stable, args.jobs, args.workers)
+        except KeyboardInterrupt:
             pass
-        finally:
-            # lockfile should be removed even after exception is raised,
-            # unless lockfile is locked by other process.
-            lockFile.unlink()
+        exit()
+
+    from win32api import SetConsoleTitle
+
+    color_console_enable()
+    SetConsoleTitle(Path.cwd().name.replace("Enc-", ""))
+    files = sorted(f for f in path.iterdir() if is_video(f))
+
+    files = ready_files(files)
+
+    if args.retry_failed:
+        jobq.retry_failed(files)
+    # 他の mp4copy が同時に動いていても、同じファイルを二重に処理しない
+    for f in files:
+        jobq.enqueue(f)
+    process_jobs(jobq, jobs=args.jobs)
+    logger.info(
+        "jobs: %s", ", ".join(f"{k}={v}" for k, v in sorted(jobq.counts().items()))
+    )
@@ -0,0 +1,6 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+mp4core:
+mp4indexer / mp4find / mp4copy で共有する処理をまとめたパッケージ
+"""
@@ -0,0 +1,86 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+config.py:
+$XDG_CONFIG_HOME/mp4indexer.json を読み込んで、未指定の項目にはデフォルト値を入れる
+"""
+
+import json
+from os import environ
+from pathlib import Path
+
+DEFAULTS = {
+    "db_host": "192.168.10.4",
+    "db_user": "username",
+    "db_pass": "password",
+    "db_name": "mp4index.db",
+    "table_name": "videolist",
+    # mp4find_server の待ち受けアドレス
+    "search_host": "127.0.0.1",
+    "search_port": 8765,
+    # mp4indexer が書き出し、mp4find が読む名前検索のスナップショット
+    "snapshot_path": str(
+        Path(environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "mp4find" / "names.idx"
+    ),
+    # この時間（ミリ秒）以上かかった検索は実行計画と一緒に slow_query_log に書く
+    "slow_query_ms": 1000,
+    "slow_query_log": str(
+        Path(environ.get("XDG_STATE_HOME", Path.home() / ".local" / "state"))
+        / "mp4find"
+        / "slow_query.log"
+    ),
+    # mp4copy のジョブキュー（SQLite）
+    "job_queue": str(
+        Path(environ.get("XDG_STATE_HOME", Path.home() / ".local" / "state"))
+        / "mp4copy"
+        / "jobs.db"
+    ),
+}
+
+
+def load_config(name: str = "mp4indexer.json") -> dict:
+    """設定ファイルを読み込む
+
+    Args:
+        name (str): $XDG_CONFIG_HOME 以下の設定ファイル名
+
+    Returns:
+        (dict): 設定。ファイルがないときや項目がないときはデフォルト値
+    """
+    config = {}
+    config_file = Path(environ.get("XDG_CONFIG_HOME", Path.home() / ".config")) / name
+    try:
+        with open(config_file, encoding="utf-8") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        pass
+    for key, value in DEFAULTS.items():
+        if config.get(key) is None:
+            config[key] = value
+    return config
+
+
+def connect(config: dict):
+    """設定に従って MariaDB に接続する"""
+    import mariadb
+
+    return mariadb.connect(
+        host=config["db_host"],
+        user=config["db_user"],
+        password=config["db_pass"],
+        database=config["db_name"],
+    )
+
+
+def create_pool(config: dict, size: int):
+    """設定に従って MariaDB のコネクションプールを作る"""
+    import mariadb
+
+    return mariadb.ConnectionPool(
+        pool_name="mp4index",
+        pool_size=size,
+        host=config["db_host"],
+        user=config["db_user"],
+        password=config["db_pass"],
+        database=config["db_name"],
+    )
@@ -0,0 +1,44 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+console.py:
+コンソールの色付け
+"""
+
+import sys
+
+BRIGHT_RED = "\033[91m"
+BRIGHT_GREEN = "\033[92m"
+BRIGHT_YELLOW = "\033[93m"
+BRIGHT_BLUE = "\033[94m"
+BRIGHT_MAGENTA = "\033[95m"
+BRIGHT_CYAN = "\033[96m"
+BRIGHT_WHITE = "\033[97m"
+DEFAULT = "\033[39m"
+
+
+def color_console_enable():
+    """Turn on colorized console."""
+    if sys.platform != "win32":
+        # Windows以外のターミナルはもともとエスケープシーケンスを解釈する
+        return True
+    from ctypes import byref, windll, wintypes
+
+    INVALID_HANDLE_VALUE = -1
+    # STD_INPUT_HANDLE = -10
+    STD_OUTPUT_HANDLE = -11
+    # STD_ERROR_HANDLE = -12
+    ENABLE_VIRTUAL_TERMINAL_PROCESSING = 0x0004
+    # ENABLE_LVB_GRID_WORLDWIDE = 0x0010
+
+    hOut = windll.kernel32.GetStdHandle(STD_OUTPUT_HANDLE)
+    if hOut == INVALID_HANDLE_VALUE:
+        return False
+    dwMode = wintypes.DWORD()
+    if windll.kernel32.GetConsoleMode(hOut, byref(dwMode)) == 0:
+        return False
+    dwMode.value |= ENABLE_VIRTUAL_TERMINAL_PROCESSING
+    # dwMode.value |= ENABLE_LVB_GRID_WORLDWIDE
+    if windll.kernel32.SetConsoleMode(hOut, dwMode) == 0:
+        return False
+    return True
@@ -0,0 +1,406 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+fileops.py:
+mp4copy のファイル操作
+
+remux の入力を（空白のない）一時的な名前で用意するのに、中身をコピーせずに済む方法から順に試す。
+
+    hardlink    同じボリュームならハードリンク（NTFS、ext4 など）
+    reflink     コピーオンライトの複製（Linux の FICLONE。Btrfs、XFS など）
+    symlink     シンボリックリンク（Windows では権限が要る）
+    copy        どれも使えないときだけ中身をコピーする
+
+ハードリンクとシンボリックリンクは元のファイルと中身を共有するので、
+元のファイルに書き込む処理の入力には使えない（stage の shared 引数）。
+
+コピー・移動（transfer）は、同じデバイスの移動なら名前を変えるだけにし、
+違うデバイスならカーネル内でコピーする（データをユーザー空間に読み込まない）。
+
+    copy_file_range     Linux 4.5 以降（同じファイルシステムなら reflink になることもある）
+    sendfile            Linux（出力がファイルでもよい）
+    read                それ以外（Windows など）。大きなバッファで読み書きする
+
+コピーは "名前.part" に書いてから名前を変えるので、途中のファイルが出力先に残らない。
+更新日時は元のファイルと同じにする。
+
+verify を指定したコピーは、読んだデータをそのまま書きながらチェックサムを計算する
+（読むのは一度だけ。カーネル内のコピーは使えない）。チェックサムは CHUNK_SIZE ごとの
+SHA-256 と、それらをつないだものの SHA-256（digest）で、"名前.chk"（JSON）に書く。
+途中のチャンクは fsync してから "名前.part.chk" に記録するので、中断したコピーは
+次の実行で最後に記録したチャンクの続きから再開する。
+
+どのコピーも読み終えたチャンクのページキャッシュを捨てる（mp4core.streamio）。verify の
+コピーは fsync した出力のキャッシュも捨て、direct なら O_DIRECT で読む。
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+
+from mp4core.streamio import SEQUENTIAL, advise, drop_cache, iter_chunks
+
+logger = logging.getLogger(__name__)
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# 一度にコピーする大きさ
+CHUNK_SIZE = 64 << 20
+# カーネル内のコピーが使えないとき（呼べない、あるいは別のファイルシステム間）の errno
+_FALLBACK_ERRNOS = {
+    errno.ENOSYS,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+}
+
+CHECKSUM_ALGORITHM = "sha256"
+SIDECAR_SUFFIX = ".chk"
+# コピー中のファイル（名前を変えるまで）
+PART_SUFFIX = ".part"
+
+METHODS = ["hardlink", "reflink", "symlink", "copy"]
+# 元のファイルと中身（inode）を共有しない方法
+PRIVATE_METHODS = ["reflink", "copy"]
+
+
+def reflink(src: Path, dst: Path):
+    """src をコピーオンライトで dst に複製する（使えなければ OSError）"""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("reflink is not supported on this platform")
+    with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.unlink(dst)
+            raise
+
+
+def _hardlink(src: Path, dst: Path):
+    os.link(src, dst)
+
+
+def _symlink(src: Path, dst: Path):
+    os.symlink(Path(src).absolute(), dst)
+
+
+def _copy(src: Path, dst: Path):
+    shutil.copy(src, dst)
+
+
+_stagers = {
+    "hardlink": _hardlink,
+    "reflink": reflink,
+    "symlink": _symlink,
+    "copy": _copy,
+}
+
+
+def stage(src: Path, dst: Path, shared: bool = True, methods: list = None) -> str:
+    """src を dst の名前で読めるようにする（できるだけ中身をコピーしない）
+
+    Args:
+        src (Path): 元のファイル
+        dst (Path): 用意する名前（存在しないこと）
+        shared (bool): 元のファイルと中身を共有してよいか
+            （False なら reflink か copy だけを使う）
+        methods (list): 試す方法（デフォルトは METHODS の順）
+    Returns:
+        (str): 使った方法
+    """
+    if methods is None:
+        methods = METHODS if shared else PRIVATE_METHODS
+    last_error = None
+    for method in methods:
+        try:
+            _stagers[method](src, dst)
+        except (OSError, NotImplementedError) as e:
+            logger.debug(f"{method} {src} -> {dst} failed: {e}")
+            last_error = e
+            continue
+        logger.debug(f"{method} {src} -> {dst}")
+        return method
+    raise last_error
+
+
+def _copy_file_range(fsrc, fdst, size: int):
+    copied = 0
+    while copied < size:
+        count = min(CHUNK_SIZE, size - copied)
+        n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), count)
+        if n == 0:
+            break
+        drop_cache(fsrc.fileno(), copied, n)
+        copied += n
+    return copied
+
+
+def _sendfile(fsrc, fdst, size: int):
+    copied = 0
+    while copied < size:
+        count = min(CHUNK_SIZE, size - copied)
+        n = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, count)
+        if n == 0:
+            break
+        drop_cache(fsrc.fileno(), copied, n)
+        copied += n
+    return copied
+
+
+def _read(fsrc, fdst, size: int):
+    copied = 0
+    buf = bytearray(min(CHUNK_SIZE, max(size, 1)))
+    view = memoryview(buf)
+    while n := fsrc.readinto(buf):
+        fdst.write(view[:n])
+        drop_cache(fsrc.fileno(), copied, n)
+        copied += n
+    return copied
+
+
+_copiers = [
+    ("copy_file_range", _copy_file_range, hasattr(os, "copy_file_range")),
+    ("sendfile", _sendfile, hasattr(os, "sendfile")),
+    ("read", _read, True),
+]
+
+
+def copy_data(fsrc, fdst, size: int, methods: list = None) -> str:
+    """開いたファイル fsrc の中身を fdst に書く（使える方法のうち最初のもの）
+
+    Args:
+        methods (list): 試す方法（デフォルトは copy_file_range, sendfile, read の順）
+    Returns:
+        (str): 使った方法
+    """
+    advise(fsrc.fileno(), 0, 0, SEQUENTIAL)
+    for name, copier, available in _copiers:
+        if not available or (methods is not None and name not in methods):
+            continue
+        try:
+            copied = copier(fsrc, fdst, size)
+        except OSError as e:
+            # 何も書いていなければ次の方法を試す
+            if e.errno not in _FALLBACK_ERRNOS or os.fstat(fdst.fileno()).st_size:
+                raise
+            logger.debug(f"{name} is not available: {e}")
+            continue
+        if copied < size and name != "read":
+            raise OSError(errno.EIO, f"short copy ({copied} of {size} bytes)", fsrc.name)
+        return name
+    raise OSError(errno.ENOTSUP, "no copy method available", fsrc.name)
+
+
+def sidecar_of(path: Path) -> Path:
+    """path のチェックサムを書くファイル"""
+    return path.with_name(path.name + SIDECAR_SUFFIX)
+
+
+def read_checksum(path: Path):
+    """path のチェックサム（dict）。なければ、あるいは読めなければ None"""
+    try:
+        with open(sidecar_of(path), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_work_file(path: Path) -> bool:
+    """transfer が出力先に作るファイル（チェックサム、コピー中のファイルとその記録）か
+
+    動画と並んで出力先に置かれるが、動画として索引に登録するものではない
+    """
+    name = Path(path).name
+    return name.endswith((SIDECAR_SUFFIX, PART_SUFFIX, SIDECAR_SUFFIX + ".tmp"))
+
+
+def is_orphaned_sidecar(path: Path) -> bool:
+    """path が、動画（あるいはコピー中のファイル）がなくなったチェックサムのファイルか"""
+    path = Path(path)
+    if not path.name.endswith(SIDECAR_SUFFIX):
+        return False
+    return not path.with_name(path.name[: -len(SIDECAR_SUFFIX)]).exists()
+
+
+def _write_json(path: Path, obj: dict):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+
+def _digest(chunks: list) -> str:
+    return hashlib.new(
+        CHECKSUM_ALGORITHM, b"".join(bytes.fromhex(c) for c in chunks)
+    ).hexdigest()
+
+
+def verify_checksum(path: Path, direct: bool = False) -> bool:
+    """path を読み直して、チェックサムのファイルと一致するか調べる
+
+    Args:
+        direct (bool): O_DIRECT で読む（mp4core.streamio.iter_chunks）
+    """
+    checksum = read_checksum(path)
+    if checksum is None or checksum.get("algorithm") != CHECKSUM_ALGORITHM:
+        return False
+    chunks = [
+        hashlib.new(CHECKSUM_ALGORITHM, data).hexdigest()
+        for data in iter_chunks(path, checksum["chunk_size"], direct=direct)
+    ]
+    return chunks == checksum["chunks"] and _digest(chunks) == checksum["digest"]
+
+
+def _already_copied(dst: Path, st: os.stat_result) -> bool:
+    """dst が st のファイルを verify してコピーし終えたものか"""
+    checksum = read_checksum(dst)
+    return (
+        checksum is not None
+        and "digest" in checksum
+        and checksum.get("size") == st.st_size == os.stat(dst).st_size
+        and checksum.get("src_mtime_ns") == st.st_mtime_ns
+    )
+
+
+def _copy_verified(src: Path, part: Path, st: os.stat_result, direct: bool = False):
+    """src を part にチェックサムを計算しながらコピーする（記録があれば続きから）
+
+    読み終えた src と fsync した part のキャッシュは捨てる（direct なら src は O_DIRECT で読む）
+
+    Returns:
+        (dict, int): チェックサムと、再開した位置（バイト）
+    """
+    progress = sidecar_of(part)
+    checksum = read_checksum(part)
+    offset = 0
+    if (
+        checksum is not None
+        and checksum.get("algorithm") == CHECKSUM_ALGORITHM
+        and checksum.get("chunk_size") == CHUNK_SIZE
+        and checksum.get("size") == st.st_size
+        and checksum.get("src_mtime_ns") == st.st_mtime_ns
+        and part.exists()
+    ):
+        # 記録したチャンクのうち、part に書かれているところまで使う
+        n = min(len(checksum["chunks"]), part.stat().st_size // CHUNK_SIZE)
+        del checksum["chunks"][n:]
+        offset = n * CHUNK_SIZE
+    else:
+        checksum = {
+            "algorithm": CHECKSUM_ALGORITHM,
+            "chunk_size": CHUNK_SIZE,
+            "size": st.st_size,
+            "src_mtime_ns": st.st_mtime_ns,
+            "chunks": [],
+        }
+    if offset:
+        logger.info(f"resume {src} from {offset:,} bytes")
+    with open(part, "r+b" if offset else "wb") as fdst:
+        fdst.seek(offset)
+        fdst.truncate(offset)
+        pos = offset
+        for data in iter_chunks(src, CHUNK_SIZE, offset, direct):
+            fdst.write(data)
+            checksum["chunks"].append(hashlib.new(CHECKSUM_ALGORITHM, data).hexdigest())
+            # データを書き終えてからチャンクを記録する
+            fdst.flush()
+            os.fsync(fdst.fileno())
+            drop_cache(fdst.fileno(), pos, len(data))
+            pos += len(data)
+            _write_json(progress, checksum)
+    checksum["digest"] = _digest(checksum["chunks"])
+    return checksum, offset
+
+
+def _same_device(src: Path, dstdir: Path) -> bool:
+    try:
+        return os.stat(src).st_dev == os.stat(dstdir).st_dev
+    except OSError:
+        return False
+
+
+def transfer(
+    src: Path,
+    dst: Path,
+    move: bool = False,
+    methods: list = None,
+    verify: bool = False,
+    direct: bool = False,
+) -> dict:
+    """src を dst（ディレクトリならその中の同じ名前）にコピー・移動する
+
+    同じデバイスへの移動は名前を変えるだけ。それ以外はカーネル内でコピーして、
+    更新日時を元のファイルと同じにする（移動なら最後に src を消す）。
+    verify なら、チェックサムを計算しながらコピーして "名前.chk" に書き、
+    中断したコピーは続きから再開する。同じ src をコピーし終えた dst があれば何もしない。
+
+    Args:
+        methods (list): コピーの方法（copy_data を参照）
+        verify (bool): チェックサムを計算する（再開できるコピーにする）
+        direct (bool): verify のコピーで src を O_DIRECT で読む
+    Raises:
+        shutil.Error: dst がすでにある
+        FileNotFoundError: src がない
+    Returns:
+        (dict): method（rename/skip/verified/copy_file_range/sendfile/read）, bytes,
+            seconds, mb_per_s, checksum（verify のとき）, resumed（再開した位置）
+    """
+    src = Path(src)
+    dst = Path(dst)
+    if dst.is_dir():
+        dst = dst / src.name
+    st = os.stat(src)
+    result = {"bytes": st.st_size, "checksum": None, "resumed": 0}
+    time_start = time.perf_counter()
+    if dst.exists():
+        if not (verify and _already_copied(dst, st)):
+            raise shutil.Error(f"Destination path '{dst}' already exists")
+        # 前回コピーし終えている（移動なら src を消す前に中断した）
+        result.update(method="skip", checksum=read_checksum(dst)["digest"])
+        if move:
+            os.unlink(src)
+    elif move and _same_device(src, dst.parent):
+        os.rename(src, dst)
+        result["method"] = "rename"
+    else:
+        part = dst.with_name(dst.name + PART_SUFFIX)
+        try:
+            if verify:
+                checksum, result["resumed"] = _copy_verified(src, part, st, direct)
+                result.update(method="verified", checksum=checksum["digest"])
+            else:
+                with open(src, "rb") as fsrc, open(part, "wb") as fdst:
+                    result["method"] = copy_data(fsrc, fdst, st.st_size, methods)
+            os.utime(part, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(part, dst)
+        except BaseException:
+            # verify のときは続きから再開できるように残す
+            if not verify:
+                try:
+                    os.unlink(part)
+                except FileNotFoundError:
+                    pass
+            raise
+        if verify:
+            _write_json(sidecar_of(dst), checksum)
+            sidecar_of(part).unlink(missing_ok=True)
+        if move:
+            os.unlink(src)
+    seconds = time.perf_counter() - time_start
+    copied = 0 if result["method"] in ("skip", "rename") else st.st_size - result["resumed"]
+    result.update(
+        seconds=seconds,
+        mb_per_s=copied / (1 << 20) / seconds if seconds > 0 and copied else None,
+    )
+    logger.debug(f"{result['method']} {src} -> {dst}: {result}")
+    return result
@@ -0,0 +1,199 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+filters.py:
+mp4find の絞り込み条件（コーデック、高さ、長さ、サイズ、日付、keep_flag）
+
+条件は dict で持ち、DBに問い合わせるときは WHERE 句（パラメータ付き）にして
+インデックスで絞り込ませる。検索サービスのメモリ上のインデックスには同じ条件を
+Python で適用する。
+
+    {
+        "codecs": ["HEVC"],                 fourcc IN (...)
+        "keep_flags": [1],                  keep_flag IN (...)
+        "min_height": 1080,                 height >= ?
+        "max_height": 1080,                 height <= ?
+        "min_length": "00:30:00.000",       length >= ?
+        "max_length": "01:00:00.000",       length <= ?
+        "min_size": 1073741824,             filesize >= ?
+        "max_size": 4294967296,             filesize <= ?
+        "since": datetime(2026, 10, 1),     filedate >= ?
+        "until": datetime(2026, 11, 1),     filedate < ?
+    }
+
+length は HH:MM:SS.mmm 形式の文字列なので、文字列のまま比較できる。
+"""
+
+import re
+from datetime import datetime, timedelta
+
+from mp4core.mp4header import format_duration
+
+# fourcc に入っている名前への別名
+CODEC_ALIASES = {
+    "H264": "AVC",
+    "X264": "AVC",
+    "H.264": "AVC",
+    "H265": "HEVC",
+    "X265": "HEVC",
+    "H.265": "HEVC",
+}
+
+# (キー, カラム, 演算子)
+RANGE_FILTERS = [
+    ("min_height", "height", ">="),
+    ("max_height", "height", "<="),
+    ("min_length", "length", ">="),
+    ("max_length", "length", "<="),
+    ("min_size", "filesize", ">="),
+    ("max_size", "filesize", "<="),
+    ("since", "filedate", ">="),
+    ("until", "filedate", "<"),
+]
+# (キー, カラム)
+LIST_FILTERS = [
+    ("codecs", "fourcc"),
+    ("keep_flags", "keep_flag"),
+]
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+DURATION_UNITS = {"h": 3600, "m": 60, "s": 1}
+
+
+def parse_codecs(values: list) -> list:
+    """-c HEVC -c avc,x265 のような指定を fourcc のリストにする"""
+    codecs = []
+    for v in values or []:
+        for c in v.split(","):
+            if c := c.strip().upper():
+                codecs.append(CODEC_ALIASES.get(c, c))
+    return codecs
+
+
+def parse_size(s: str) -> int:
+    """"700M" "4.5G" のようなサイズをバイト数にする（単位は1024倍）"""
+    if not (m := re.fullmatch(r"([\d.]+)\s*([KMGT]?)i?B?", s.strip(), re.IGNORECASE)):
+        raise ValueError(f"invalid size: {s}")
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2).upper()])
+
+
+def parse_duration(s: str) -> str:
+    """"1:30:00" "45:00" "90m" "1.5h" のような長さを HH:MM:SS.mmm にする
+
+    単位のない数字は分とみなす
+    """
+    s = s.strip()
+    if ":" in s:
+        seconds = 0.0
+        for part in s.split(":"):
+            seconds = seconds * 60 + float(part)
+    elif m := re.fullmatch(r"([\d.]+)\s*([hms]?)", s, re.IGNORECASE):
+        seconds = float(m.group(1)) * DURATION_UNITS[(m.group(2) or "m").lower()]
+    else:
+        raise ValueError(f"invalid duration: {s}")
+    return format_duration(seconds)
+
+
+def parse_date(s: str, end: bool = False) -> datetime:
+    """"2026-10-19" "2026-10" "2026" "7d"（7日前）を日時にする
+
+    end が True のときはその期間の終わり（次の日・月・年の始まり）を返す。
+    until は filedate < until で比べるので、"--until 2026-10" は10月末までになる
+    """
+    s = s.strip()
+    if m := re.fullmatch(r"(\d+)d", s):
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        return today - timedelta(days=int(m.group(1))) + timedelta(days=end)
+    for fmt in ("%Y-%m-%d", "%Y-%m", "%Y"):
+        try:
+            d = datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+        if end:
+            if fmt == "%Y-%m-%d":
+                d += timedelta(days=1)
+            elif fmt == "%Y-%m":
+                d = d.replace(year=d.year + d.month // 12, month=d.month % 12 + 1)
+            else:
+                d = d.replace(year=d.year + 1)
+        return d
+    return datetime.fromisoformat(s)
+
+
+def is_empty(filters: dict) -> bool:
+    return not any(v not in (None, []) for v in filters.values())
+
+
+def conditions(filters: dict, prefix: str = ""):
+    """filters を WHERE の条件のリストとパラメータにする
+
+    Returns:
+        (list, list): 条件（AND でつなぐ）とパラメータ
+    """
+    conds = []
+    params = []
+    for key, column in LIST_FILTERS:
+        if values := filters.get(key):
+            conds.append(f"{prefix}{column} IN ({', '.join(['?'] * len(values))})")
+            params += values
+    for key, column, op in RANGE_FILTERS:
+        if (value := filters.get(key)) is not None:
+            conds.append(f"{prefix}{column} {op} ?")
+            params.append(value)
+    if filters.get("max_length") is not None and filters.get("min_length") is None:
+        # 長さが分からない（空の）ものは含めない
+        conds.append(f'{prefix}length > ""')
+    return conds, params
+
+
+_OPS = {
+    ">=": lambda a, b: a >= b,
+    "<=": lambda a, b: a <= b,
+    "<": lambda a, b: a < b,
+}
+
+
+def match(row: dict, filters: dict) -> bool:
+    """row が filters の条件をすべて満たすか（conditions と同じ条件を Python で調べる）"""
+    if (codecs := filters.get("codecs")) and row["fourcc"].upper() not in codecs:
+        return False
+    if (keep := filters.get("keep_flags")) and row["keep_flag"] not in keep:
+        return False
+    for key, column, op in RANGE_FILTERS:
+        if (value := filters.get(key)) is not None and not _OPS[op](row[column], value):
+            return False
+    if filters.get("max_length") is not None and not row["length"]:
+        return False
+    return True
+
+
+def to_params(filters: dict) -> list:
+    """検索サービスに渡すクエリパラメータ [(キー, 値), ...] にする"""
+    params = []
+    for key, _ in LIST_FILTERS:
+        params += [(key, v) for v in filters.get(key) or []]
+    for key, _, _ in RANGE_FILTERS:
+        if (value := filters.get(key)) is not None:
+            params.append(
+                (key, value.isoformat() if isinstance(value, datetime) else value)
+            )
+    return params
+
+
+def from_params(params: dict) -> dict:
+    """parse_qs の結果から to_params で渡された filters を取り出す"""
+    filters = {}
+    if "codecs" in params:
+        filters["codecs"] = params["codecs"]
+    if "keep_flags" in params:
+        filters["keep_flags"] = [int(v) for v in params["keep_flags"]]
+    for key in ("min_height", "max_height", "min_size", "max_size"):
+        if key in params:
+            filters[key] = int(params[key][0])
+    for key in ("min_length", "max_length"):
+        if key in params:
+            filters[key] = params[key][0]
+    for key in ("since", "until"):
+        if key in params:
+            filters[key] = datetime.fromisoformat(params[key][0])
+    return filters
@@ -0,0 +1,336 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+jobqueue.py:
+mp4copy のジョブキュー（SQLite）
+
+エンコードフォルダの書き終わった動画をジョブとして登録し、ワーカー（mp4copy のプロセス・
+スレッド）がリースを付けて取り出す。取り出しは BEGIN IMMEDIATE のトランザクションで行うので、
+同じジョブを二つのワーカーが取ることはない。
+
+    queued      待っている（not_before を過ぎたら取り出せる）
+    running     ワーカーが処理している（lease_until までに延長しなければ、落ちたとみなして
+                他のワーカーが取り直す）
+    done        終わった
+    failed      max_attempts 回失敗した（ファイルが変更されるか retry_failed で戻すまで
+                登録し直さない）
+
+失敗したジョブは RETRY_DELAY * 2 ** (試行回数 - 1) 秒後に再試行する。
+同じファイルの queued/running のジョブは一つだけ（部分一意インデックス）。
+"""
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    not_before REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_until REAL,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active
+    ON jobs (path) WHERE state IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, not_before);
+"""
+
+
+def worker_id() -> str:
+    """ワーカーの名前（ホスト名:プロセスID:スレッドID）"""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+class JobQueue:
+    """SQLite のジョブキュー
+
+    スレッドごとに接続を作るので、一つの JobQueue を複数のスレッドから使ってよい
+
+    Args:
+        path (Path): データベースのファイル
+        lease (float): リースの秒数
+        max_attempts (int): 失敗とするまでの試行回数
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        lease: float = LEASE_SECONDS,
+        max_attempts: int = MAX_ATTEMPTS,
+    ):
+        self.path = Path(path)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, f: Path) -> bool:
+        """f をジョブとして登録する
+
+        同じファイルのジョブが待っているか処理中のとき、あるいは同じ内容（大きさと更新日時）で
+        失敗しているときは登録しない（失敗していて登録しないときは警告を出す）
+
+        Returns:
+            (bool): 登録したとき True
+        """
+        f = Path(f).absolute()
+        st = f.stat()
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                failed = conn.execute(
+                    """
+                    SELECT attempts, error FROM jobs
+                    WHERE path = ? AND size = ? AND mtime_ns = ? AND state = 'failed'
+                    """,
+                    (str(f), st.st_size, st.st_mtime_ns),
+                ).fetchone()
+                if failed:
+                    logger.warning(
+                        f"not queued, failed {failed['attempts']} times before: {f}"
+                        f" ({failed['error']})"
+                    )
+                cur = conn.execute(
+                    """
+                    INSERT OR IGNORE INTO jobs
+                        (path, size, mtime_ns, max_attempts, created, updated)
+                    SELECT ?, ?, ?, ?, ?, ? WHERE ?
+                    """,
+                    (
+                        str(f),
+                        st.st_size,
+                        st.st_mtime_ns,
+                        self.max_attempts,
+                        now,
+                        now,
+                        failed is None,
+                    ),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if cur.rowcount:
+            logger.info(f"queued {f}")
+        return cur.rowcount > 0
+
+    def retry_failed(self, paths: list = None) -> int:
+        """失敗したジョブを試行回数 0 から待ち直しにする
+
+        paths を指定するとそのファイルのジョブだけを戻す。ファイルごとに最後のジョブだけを戻し、
+        同じファイルのジョブが待っているか処理中のときは戻さない
+
+        Returns:
+            (int): 戻したジョブの数
+        """
+        where = ""
+        params = []
+        if paths is not None:
+            if not paths:
+                return 0
+            params = [str(Path(f).absolute()) for f in paths]
+            where = f"AND path IN ({', '.join('?' * len(params))})"
+        with self._connect() as conn:
+            cur = conn.execute(
+                f"""
+                UPDATE jobs SET state = 'queued', attempts = 0, not_before = 0, error = NULL,
+                    updated = ?
+                WHERE id IN (
+                    SELECT MAX(id) FROM jobs WHERE state = 'failed' {where} GROUP BY path
+                )
+                    AND path NOT IN (
+                        SELECT path FROM jobs WHERE state IN ('queued', 'running')
+                    )
+                """,
+                (time.time(), *params),
+            )
+        if cur.rowcount:
+            logger.info(f"requeued {cur.rowcount} failed job(s)")
+        return cur.rowcount
+
+    def claim(self, owner: str, limit: int = 1) -> list:
+        """取り出せるジョブを limit 件まで取り出して、owner のリースを付ける
+
+        リースの切れた running のジョブ（ワーカーが落ちた）も取り出す
+
+        Returns:
+            (list): ジョブ（dict）のリスト
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    """
+                    SELECT * FROM jobs
+                    WHERE (state = 'queued' AND not_before <= ?)
+                        OR (state = 'running' AND lease_until < ?)
+                    ORDER BY id
+                    LIMIT ?
+                    """,
+                    (now, now, limit),
+                ).fetchall()
+                jobs = []
+                for r in rows:
+                    if r["state"] == "running":
+                        logger.warning(f"lease of {r['lease_owner']} expired: {r['path']}")
+                        if r["attempts"] >= r["max_attempts"]:
+                            self._finish(conn, r["id"], "failed", "lease expired")
+                            continue
+                    conn.execute(
+                        """
+                        UPDATE jobs SET state = 'running', attempts = attempts + 1,
+                            lease_owner = ?, lease_until = ?, updated = ?
+                        WHERE id = ?
+                        """,
+                        (owner, now + self.lease, now, r["id"]),
+                    )
+                    jobs.append(dict(r, state="running", attempts=r["attempts"] + 1))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return jobs
+
+    def extend(self, owner: str, ids: list) -> int:
+        """owner が持っているジョブのリースを延長する
+
+        Returns:
+            (int): 延長したジョブの数（他のワーカーに取られたものは数えない）
+        """
+        if not ids:
+            return 0
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                f"""
+                UPDATE jobs SET lease_until = ?, updated = ?
+                WHERE lease_owner = ? AND state = 'running'
+                    AND id IN ({", ".join("?" * len(ids))})
+                """,
+                (now + self.lease, now, owner, *ids),
+            )
+            return cur.rowcount
+
+    @contextmanager
+    def keep_alive(self, owner: str, ids: list):
+        """with の間、lease の 1/3 ごとにリースを延長する"""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease / 3):
+                try:
+                    self.extend(owner, ids)
+                except sqlite3.Error as e:
+                    logger.warning(f"couldn't extend the lease: {e}")
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    @staticmethod
+    def _finish(conn, job_id: int, state: str, error: str = None):
+        conn.execute(
+            """
+            UPDATE jobs SET state = ?, error = ?, lease_owner = NULL, lease_until = NULL,
+                updated = ?
+            WHERE id = ?
+            """,
+            (state, error, time.time(), job_id),
+        )
+
+    def complete(self, owner: str, job_id: int) -> bool:
+        """ジョブを終わったことにする（owner のリースがなくなっていれば何もしない）"""
+        with self._connect() as conn:
+            cur = conn.execute(
+                """
+                UPDATE jobs SET state = 'done', error = NULL, lease_owner = NULL,
+                    lease_until = NULL, updated = ?
+                WHERE id = ? AND lease_owner = ? AND state = 'running'
+                """,
+                (time.time(), job_id, owner),
+            )
+            return cur.rowcount > 0
+
+    def fail(self, owner: str, job_id: int, error: str) -> str:
+        """ジョブの失敗を記録する（試行回数が残っていれば後で再試行する）
+
+        Returns:
+            (str): ジョブの新しい状態（queued か failed。リースがなければ None）
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                r = conn.execute(
+                    "SELECT * FROM jobs WHERE id = ? AND lease_owner = ? AND state = 'running'",
+                    (job_id, owner),
+                ).fetchone()
+                if r is None:
+                    state = None
+                elif r["attempts"] >= r["max_attempts"]:
+                    state = "failed"
+                    self._finish(conn, job_id, state, error)
+                else:
+                    state = "queued"
+                    conn.execute(
+                        """
+                        UPDATE jobs SET state = 'queued', error = ?, not_before = ?,
+                            lease_owner = NULL, lease_until = NULL, updated = ?
+                        WHERE id = ?
+                        """,
+                        (error, now + RETRY_DELAY * 2 ** (r["attempts"] - 1), now, job_id),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return state
+
+    def counts(self) -> dict:
+        """状態ごとのジョブの数"""
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+    def pending(self) -> int:
+        """待っているか処理中のジョブの数"""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'running')"
+            ).fetchone()[0]
@@ -0,0 +1,45 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+lazy.py:
+重いモジュール（cv2, pymediainfo, cmigemo, mariadb, tqdm, jaconv など）を
+最初に属性を参照したときにインポートする
+
+    mariadb = lazy_import("mariadb")
+    conn = mariadb.connect(...)   # ここで初めて import mariadb される
+"""
+
+import importlib
+
+
+class LazyModule:
+    """属性の参照時にモジュールをインポートする代理オブジェクト"""
+
+    def __init__(self, name: str):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._name)
+        return self._module
+
+    @property
+    def loaded(self):
+        """すでにインポートされているかどうか"""
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = "loaded" if self.loaded else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    """name のモジュールを遅延インポートする"""
+    return LazyModule(name)
@@ -0,0 +1,368 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+mp4header.py:
+MP4（ISO BMFF）のヘッダ（moovボックス）だけを読んで動画の情報を取り出す
+
+mdatは読み飛ばすので、ファイルサイズに関係なく数KB〜数百KBの読み込みで済む。
+取り出す情報は
+・全体の長さ（mvhd）
+・トラックごとの種類、長さ、フレームサイズ、コーデック、チャンネル数（trak）
+・映像トラックのフレームレート（mdhd の timescale と stts のサンプルの長さの比。30000/1001 など）
+・チャプター数（udta/chpl、またはtref/chapで参照されるテキストトラック）
+・作成アプリケーション（udta/meta/ilst/©too）
+"""
+
+import struct
+from collections import Counter
+from fractions import Fraction
+from pathlib import Path
+
+# 中身を再帰的にたどるボックス
+CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"edts", b"dinf"}
+# stts で読むエントリの数
+STTS_ENTRIES = 256
+
+VIDEO_FORMATS = {
+    b"avc1": "AVC",
+    b"avc3": "AVC",
+    b"hev1": "HEVC",
+    b"hvc1": "HEVC",
+    b"mp4v": "MPEG-4 Visual",
+    b"av01": "AV1",
+    b"vp09": "VP9",
+}
+AUDIO_FORMATS = {
+    b"mp4a": "AAC",
+    b"ac-3": "AC-3",
+    b"ec-3": "E-AC-3",
+    b"alac": "ALAC",
+    b"Opus": "Opus",
+    b"fLaC": "FLAC",
+}
+AVC_PROFILES = {
+    66: "Baseline",
+    77: "Main",
+    88: "Extended",
+    100: "High",
+    110: "High 10",
+    122: "High 4:2:2",
+    244: "High 4:4:4 Predictive",
+}
+HEVC_PROFILES = {1: "Main", 2: "Main 10", 3: "Main Still", 4: "Format Range"}
+CHROMA_FORMATS = {0: "4:0:0", 1: "4:2:0", 2: "4:2:2", 3: "4:4:4"}
+
+
+class Mp4HeaderError(Exception):
+    """MP4のヘッダが読めない、あるいは壊れている"""
+
+
+def iter_boxes(f, start: int, end: int):
+    """start から end までの範囲にあるボックスを順に返す
+
+    Args:
+        f: バイナリモードで開いたファイル
+        start (int): 範囲の先頭オフセット
+        end (int): 範囲の末尾オフセット
+
+    Yields:
+        (bytes, int, int): ボックスの種類、中身の先頭オフセット、ボックスの末尾オフセット
+    """
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            large = f.read(8)
+            if len(large) < 8:
+                raise Mp4HeaderError(f"truncated box header at {pos}")
+            size = struct.unpack(">Q", large)[0]
+            header_size = 16
+        elif size == 0:
+            # ファイル末尾まで
+            size = end - pos
+        if size < header_size or pos + size > end:
+            raise Mp4HeaderError(f"broken box {box_type!r} at {pos}")
+        yield box_type, pos + header_size, pos + size
+        pos += size
+
+
+def _read(f, offset: int, length: int) -> bytes:
+    f.seek(offset)
+    data = f.read(length)
+    if len(data) < length:
+        raise Mp4HeaderError(f"truncated data at {offset}")
+    return data
+
+
+def _read_timescale_duration(f, body: int):
+    """mvhd / mdhd から (timescale, duration) を読む"""
+    version = _read(f, body, 1)[0]
+    if version == 1:
+        timescale, duration = struct.unpack(">IQ", _read(f, body + 20, 12))
+    else:
+        timescale, duration = struct.unpack(">II", _read(f, body + 12, 8))
+    return timescale, duration
+
+
+def _read_tkhd(f, body: int, track: dict):
+    version = _read(f, body, 1)[0]
+    if version == 1:
+        track["track_id"] = struct.unpack(">I", _read(f, body + 20, 4))[0]
+        offset = body + 88
+    else:
+        track["track_id"] = struct.unpack(">I", _read(f, body + 12, 4))[0]
+        offset = body + 76
+    width, height = struct.unpack(">II", _read(f, offset, 8))
+    # 16.16 固定小数点
+    track["width"] = width >> 16
+    track["height"] = height >> 16
+
+
+def _parse_avcc(data: bytes, track: dict):
+    profile_idc, level_idc = data[1], data[3]
+    profile = AVC_PROFILES.get(profile_idc, str(profile_idc))
+    level = f"{level_idc // 10}" if level_idc % 10 == 0 else f"{level_idc / 10:.1f}"
+    track["profile"] = f"{profile}@L{level}"
+    track["chroma_subsampling"] = "4:2:0"
+    track["bit_depth"] = 8
+    # High系のプロファイルではSPS/PPSのあとにクロマとビット深度が続く
+    try:
+        pos = 5
+        num_sps = data[pos] & 0x1F
+        pos += 1
+        for _ in range(num_sps):
+            pos += 2 + struct.unpack(">H", data[pos:pos + 2])[0]
+        num_pps = data[pos]
+        pos += 1
+        for _ in range(num_pps):
+            pos += 2 + struct.unpack(">H", data[pos:pos + 2])[0]
+        if profile_idc in (100, 110, 122, 144, 244) and len(data) >= pos + 4:
+            track["chroma_subsampling"] = CHROMA_FORMATS[data[pos] & 0x03]
+            track["bit_depth"] = (data[pos + 1] & 0x07) + 8
+    except (IndexError, struct.error):
+        pass
+
+
+def _parse_hvcc(data: bytes, track: dict):
+    if len(data) < 19:
+        return
+    tier = "High" if data[1] & 0x20 else "Main"
+    profile_idc = data[1] & 0x1F
+    level_idc = data[12]
+    profile = HEVC_PROFILES.get(profile_idc, str(profile_idc))
+    level = f"{level_idc // 30}" if level_idc % 30 == 0 else f"{level_idc / 30:.1f}"
+    track["profile"] = f"{profile}@L{level}@{tier}"
+    track["chroma_subsampling"] = CHROMA_FORMATS[data[16] & 0x03]
+    track["bit_depth"] = (data[17] & 0x07) + 8
+
+
+def _read_descriptor_length(data: bytes, pos: int):
+    length = 0
+    for _ in range(4):
+        b = data[pos]
+        pos += 1
+        length = (length << 7) | (b & 0x7F)
+        if not b & 0x80:
+            break
+    return length, pos
+
+
+def _parse_esds(data: bytes, track: dict):
+    """esds から objectTypeIndication と AudioObjectType を読む"""
+    try:
+        pos = 4
+        if data[pos] != 0x03:  # ES_Descriptor
+            return
+        _, pos = _read_descriptor_length(data, pos + 1)
+        flags = data[pos + 2]
+        pos += 3
+        if flags & 0x80:  # streamDependenceFlag
+            pos += 2
+        if flags & 0x40:  # URL_Flag
+            pos += 1 + data[pos]
+        if flags & 0x20:  # OCRstreamFlag
+            pos += 2
+        if data[pos] != 0x04:  # DecoderConfigDescriptor
+            return
+        _, pos = _read_descriptor_length(data, pos + 1)
+        object_type = data[pos]
+        if object_type == 0x6B:
+            track["format"] = "MPEG Audio"
+            return
+        pos += 13
+        if data[pos] != 0x05:  # DecoderSpecificInfo
+            return
+        _, pos = _read_descriptor_length(data, pos + 1)
+        audio_object_type = data[pos] >> 3
+        if audio_object_type == 2:
+            track["format"] = "AAC LC"
+        elif audio_object_type == 5:
+            track["format"] = "AAC LC SBR"
+    except IndexError:
+        pass
+
+
+def _read_stsd(f, body: int, end: int, track: dict):
+    entry_count = struct.unpack(">I", _read(f, body + 4, 4))[0]
+    if entry_count == 0:
+        return
+    for box_type, entry_body, entry_end in iter_boxes(f, body + 8, end):
+        track["codec"] = box_type.decode("latin-1")
+        if track["handler"] == "vide":
+            track["format"] = VIDEO_FORMATS.get(box_type, track["codec"].upper())
+            # tkhdの表示サイズではなく符号化サイズ（1440x1080など）を使う
+            track["width"], track["height"] = struct.unpack(
+                ">HH", _read(f, entry_body + 24, 4)
+            )
+            children = entry_body + 78
+        elif track["handler"] == "soun":
+            track["format"] = AUDIO_FORMATS.get(box_type, track["codec"])
+            version = struct.unpack(">H", _read(f, entry_body + 8, 2))[0]
+            track["channels"] = struct.unpack(">H", _read(f, entry_body + 16, 2))[0]
+            # QuickTimeのSoundDescription v1/v2 は拡張フィールドを持つ
+            children = entry_body + 28 + {1: 16, 2: 36}.get(version, 0)
+        else:
+            track["format"] = track["codec"]
+            return
+        for child_type, child_body, child_end in iter_boxes(f, children, entry_end):
+            if child_type in (b"avcC", b"hvcC", b"esds"):
+                data = _read(f, child_body, min(child_end - child_body, 4096))
+                {b"avcC": _parse_avcc, b"hvcC": _parse_hvcc, b"esds": _parse_esds}[
+                    child_type
+                ](data, track)
+        # 最初のサンプルエントリだけを見る
+        return
+
+
+def _read_stts(f, body: int, track: dict):
+    """いちばん多くのサンプルが持つ長さ（timescale 単位）を sample_delta にする
+
+    可変フレームレートでは stts が大きくなるので、先頭の STTS_ENTRIES 個だけを見る
+    """
+    entry_count = struct.unpack(">I", _read(f, body + 4, 4))[0]
+    n = min(entry_count, STTS_ENTRIES)
+    if n == 0:
+        return
+    data = struct.unpack(f">{n * 2}I", _read(f, body + 8, n * 8))
+    deltas = Counter()
+    for count, delta in zip(data[::2], data[1::2]):
+        deltas[delta] += count
+    track["sample_delta"] = deltas.most_common(1)[0][0]
+
+
+def _read_trak(f, body: int, end: int) -> dict:
+    track = {"handler": "", "duration": 0.0, "chapter_refs": []}
+    stack = [(body, end)]
+    while stack:
+        start, stop = stack.pop()
+        for box_type, box_body, box_end in iter_boxes(f, start, stop):
+            if box_type == b"tkhd":
+                _read_tkhd(f, box_body, track)
+            elif box_type == b"mdhd":
+                timescale, duration = _read_timescale_duration(f, box_body)
+                track["duration"] = duration / timescale if timescale else 0.0
+                track["timescale"] = timescale
+            elif box_type == b"hdlr":
+                track["handler"] = _read(f, box_body + 8, 4).decode("latin-1")
+            elif box_type == b"stsd":
+                _read_stsd(f, box_body, box_end, track)
+            elif box_type == b"tref":
+                for ref_type, ref_body, ref_end in iter_boxes(f, box_body, box_end):
+                    if ref_type == b"chap":
+                        data = _read(f, ref_body, ref_end - ref_body)
+                        track["chapter_refs"] += struct.unpack(
+                            f">{len(data) // 4}I", data[: len(data) // 4 * 4]
+                        )
+            elif box_type == b"stsz":
+                track["sample_count"] = struct.unpack(">I", _read(f, box_body + 8, 4))[0]
+            elif box_type == b"stts":
+                _read_stts(f, box_body, track)
+            elif box_type in CONTAINER_BOXES:
+                # 子ボックスは同じ階層のボックスを読み終えてからたどるので、
+                # stsd を読む時点で mdia/hdlr は読み終えている
+                stack.append((box_body, box_end))
+    if track["handler"] == "vide" and track.get("timescale") and track.get("sample_delta"):
+        track["frame_rate"] = str(Fraction(track["timescale"], track["sample_delta"]))
+    return track
+
+
+def _read_chpl(f, body: int) -> int:
+    version = _read(f, body, 1)[0]
+    if version == 1:
+        return struct.unpack(">I", _read(f, body + 5, 4))[0]
+    return _read(f, body + 4, 1)[0]
+
+
+def _read_udta(f, body: int, end: int, info: dict):
+    for box_type, box_body, box_end in iter_boxes(f, body, end):
+        if box_type == b"chpl":
+            info["chapters"] = _read_chpl(f, box_body)
+        elif box_type == b"meta":
+            # metaはFullBoxなので4バイト（version/flags）を読み飛ばす
+            for meta_type, meta_body, meta_end in iter_boxes(f, box_body + 4, box_end):
+                if meta_type != b"ilst":
+                    continue
+                for tag, tag_body, tag_end in iter_boxes(f, meta_body, meta_end):
+                    if tag != b"\xa9too":
+                        continue
+                    for data_type, data_body, data_end in iter_boxes(f, tag_body, tag_end):
+                        if data_type == b"data":
+                            raw = _read(f, data_body + 8, data_end - data_body - 8)
+                            info["writing_app"] = raw.decode("utf-8", "replace")
+
+
+def parse(fname: Path) -> dict:
+    """MP4ファイルのヘッダを読んで情報を返す
+
+    Args:
+        fname (Path): MP4ファイル
+
+    Returns:
+        (dict): duration（秒）、tracks（トラック情報のリスト）、chapters（チャプター数）、
+            writing_app
+    Raises:
+        Mp4HeaderError: moovボックスがない、あるいは壊れている
+    """
+    info = {"duration": 0.0, "tracks": [], "chapters": 0, "writing_app": ""}
+    with open(fname, "rb") as f:
+        f.seek(0, 2)
+        size = f.tell()
+        moov = None
+        for box_type, body, end in iter_boxes(f, 0, size):
+            if box_type == b"moov":
+                moov = (body, end)
+                break
+        if moov is None:
+            raise Mp4HeaderError(f"moov box not found: {fname}")
+        for box_type, body, end in iter_boxes(f, *moov):
+            if box_type == b"mvhd":
+                timescale, duration = _read_timescale_duration(f, body)
+                info["duration"] = duration / timescale if timescale else 0.0
+            elif box_type == b"trak":
+                info["tracks"].append(_read_trak(f, body, end))
+            elif box_type == b"udta":
+                _read_udta(f, body, end, info)
+    if info["chapters"] == 0:
+        # QuickTime形式のチャプター（tref/chapで参照されるテキストトラック）
+        refs = {r for t in info["tracks"] for r in t["chapter_refs"]}
+        if refs:
+            info["chapters"] = sum(
+                t.get("sample_count", 0)
+                for t in info["tracks"]
+                if t.get("track_id") in refs
+            )
+    return info
+
+
+def format_duration(seconds: float) -> str:
+    """秒数を MediaInfo の other_duration[3] と同じ HH:MM:SS.mmm 形式にする"""
+    msec = int(round(seconds * 1000))
+    hours, msec = divmod(msec, 3600_000)
+    minutes, msec = divmod(msec, 60_000)
+    secs, msec = divmod(msec, 1000)
+    return f"{hours:02}:{minutes:02}:{secs:02}.{msec:03}"
@@ -0,0 +1,125 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+nameindex.py:
+"ディレクトリ ファイル名" をメモリ上に持って、DBに問い合わせずに名前を検索する
+
+名前と検索語は mp4core.normalize で正規化して比べる（レコードに search_key があればそれを使う）。
+正規表現の検索は元の名前（小文字）に対して行う。
+
+すべての名前を小文字にして改行でつないだ一つの文字列（blob）を作っておき、
+検索語を blob に対して str.find / re.finditer で探す。
+見つかった位置から行番号を二分探索で引くので、1件ずつ比較するよりずっと速い。
+
+rows は DB の ORDER BY directory, filename の順（DB の照合順序）に並べて渡す。
+続きのページ（after）は、after の行の位置（行番号）から先を返すことで読む
+（Python で名前を比べると照合順序が DB と違うので、行が抜けたり重なったりする）。
+"""
+
+import re
+from bisect import bisect_right
+
+from mp4core.normalize import normalize_patterns, search_key
+
+
+class NameIndex:
+    """名前検索用のメモリ上のインデックス
+
+    rows は videolist のレコード（dict）のリスト。検索結果は rows の要素をそのまま返す
+    """
+
+    def __init__(self, rows: list):
+        self.rows = rows
+        self._keys, self._starts, self._blob = self._build(
+            r.get("search_key") or search_key(f"{r['directory']} {r['filename']}")
+            for r in rows
+        )
+        # 正規表現用（元の名前）は最初の正規表現の検索で作る
+        self._raw = None
+        # (directory, filename) -> 行番号。最初の position_after で作る
+        self._positions = None
+
+    @staticmethod
+    def _build(keys):
+        """(行のリスト, 各行の開始位置, 改行でつないだ文字列)"""
+        keys = [k.replace("\n", " ") for k in keys]
+        starts = []
+        pos = 0
+        for k in keys:
+            starts.append(pos)
+            pos += len(k) + 1
+        return keys, starts, "\n".join(keys)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def position_after(self, after):
+        """after = (directory, filename) の次の行番号（after の行がなければ None）"""
+        if self._positions is None:
+            self._positions = {
+                (r["directory"], r["filename"]): i for i, r in enumerate(self.rows)
+            }
+        i = self._positions.get(tuple(after))
+        return None if i is None else i + 1
+
+    def _find_all(self, word: str, start: int = 0):
+        """blob 中で word を含む start 行目以降の行番号を（昇順で重複なく）返す"""
+        hits = []
+        if start >= len(self._starts):
+            return hits
+        pos = self._blob.find(word, self._starts[start])
+        while pos >= 0:
+            i = bisect_right(self._starts, pos) - 1
+            hits.append(i)
+            # 同じ行の中の2つ目以降の出現は飛ばして次の行から探す
+            next_row = self._starts[i + 1] if i + 1 < len(self._starts) else len(self._blob)
+            pos = self._blob.find(word, next_row)
+        return hits
+
+    def search(self, patterns: list, start: int = 0) -> list:
+        """patterns のすべてを含む（AND）start 行目以降のレコードを返す（LIKE "%kw%" と同じ）"""
+        words = normalize_patterns(patterns)
+        if not words:
+            return []
+        # 一番長い語が一番絞り込めるはずなので、それで blob を走査する
+        words.sort(key=len, reverse=True)
+        first, rest = words[0], words[1:]
+        return [
+            self.rows[i]
+            for i in self._find_all(first, start)
+            if all(w in self._keys[i] for w in rest)
+        ]
+
+    def document_frequency(self, patterns: list) -> dict:
+        """検索語（正規化したもの）ごとに、その語を含むレコード数を返す（順位付けの IDF に使う）"""
+        return {w: len(self._find_all(w)) for w in set(normalize_patterns(patterns))}
+
+    def average_lengths(self) -> dict:
+        """directory と filename の平均の長さ（順位付けの正規化に使う）"""
+        n = max(len(self.rows), 1)
+        return {
+            "directory": sum(len(r["directory"]) for r in self.rows) / n,
+            "filename": sum(len(r["filename"]) for r in self.rows) / n,
+        }
+
+    def search_regexp(self, regexp: str, start: int = 0) -> list:
+        """正規表現 regexp にマッチする start 行目以降のレコードを返す（REGEXP と同じ）"""
+        if self._raw is None:
+            self._raw = self._build(
+                f"{r['directory']} {r['filename']}".casefold() for r in self.rows
+            )
+        keys, starts, blob = self._raw
+        rx = re.compile(regexp, re.IGNORECASE)
+        result = []
+        last = -1
+        if start >= len(starts):
+            return result
+        for m in rx.finditer(blob, starts[start]):
+            i = bisect_right(starts, m.start()) - 1
+            if i == last:
+                continue
+            # 改行をまたいでマッチしていないか、行単位で確認する
+            if rx.search(keys[i]):
+                result.append(self.rows[i])
+                last = i
+        return result
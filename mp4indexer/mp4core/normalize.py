@@ -0,0 +1,54 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+normalize.py:
+名前検索用の正規化（videolist.search_key と検索語に同じ規則を使う）
+
+ファイル名には全角・半角の英数字（z2h_rename.py）、漢数字とアラビア数字（k2n_rename.py）、
+飾りのカッコが混ざっているので、「ＳＰＹ」で「SPY」が見つからない。
+インデックスを作るときに名前を正規化したもの（search_key）を保存しておき、
+検索語も同じく正規化して、単純な部分文字列の一致で検索する。
+
+    1. jaconv.normalize（NFKC。全角英数字は半角に、半角カナは全角に、〜 などもそろえる）
+    2. 小文字にする
+    3. 漢数字＋「話章説夜幕」をアラビア数字にする（k2n_rename.py と同じパターン）
+    4. カッコを取り除き、空白をまとめる
+"""
+
+import re
+
+from mp4core.lazy import lazy_import
+
+jaconv = lazy_import("jaconv")
+kanjize = lazy_import("kanjize")
+
+# 漢数字のパターン（k2n_rename.py でも使う）
+kansuji = "([一二三四五六七八九壱弐参十][一二三四五六七八九〇壱弐参十]*)"
+suffix = "([話章説夜幕])"
+pattern = kansuji + suffix
+
+# 取り除くカッコ（「」『』【】［］など。NFKC で半角になるものは半角で書く）
+BRACKETS = "()[]{}<>「」『』【】〔〕〈〉《》〘〙〚〛“”‘’\"'"
+_brackets = str.maketrans("", "", BRACKETS)
+_kansuji = re.compile(pattern)
+_spaces = re.compile(r"\s+")
+
+
+def _k2n(m: re.Match) -> str:
+    try:
+        return f"{kanjize.kanji2number(m.group(1))}{m.group(2)}"
+    except (ValueError, KeyError):
+        return m.group(0)
+
+
+def search_key(s: str) -> str:
+    """名前を検索用に正規化する"""
+    s = jaconv.normalize(s, "NFKC").casefold()
+    s = _kansuji.sub(_k2n, s)
+    s = s.translate(_brackets)
+    return _spaces.sub(" ", s).strip()
+
+
+def normalize_patterns(patterns: list) -> list:
+    """検索語を search_key と同じ規則で正規化する（空になった語は捨てる）"""
+    return [k for p in patterns if (k := search_key(p))]
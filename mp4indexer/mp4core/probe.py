@@ -0,0 +1,303 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+probe.py:
+動画ファイルの情報取得（プローブ）を別プロセスで実行する
+
+壊れたTSや書きかけのMP4を MediaInfo や OpenCV に渡すと、数分間応答がなくなったり
+インタプリタごと落ちたりするので、プローブはワーカープロセスで実行し、
+ファイルごとのタイムアウトを超えたらワーカーを kill して作り直す。
+
+プローブは次の順に試し、必要な情報がそろった時点で終わる
+1. header         : MP4のヘッダだけを読む（mp4header.py、MP4系のみ）
+2. mediainfo      : MediaInfo（parse_speed=0）
+3. mediainfo_deep : MediaInfo（parse_speed=1、ファイル全体を解析する）
+4. opencv         : OpenCV
+
+header 以外はファイルの大部分を読むことがあるので、終わったらそのファイルのページキャッシュを
+捨てる（mp4core.streamio）。多くのファイルをプローブしても他のキャッシュを追い出さない。
+"""
+
+import logging
+import multiprocessing
+import time
+from fractions import Fraction
+from pathlib import Path
+
+from mp4core import mp4header, streamio
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_CHAIN = ("header", "mediainfo", "mediainfo_deep", "opencv")
+HEADER_SUFFIXES = {".MP4", ".M4V", ".MOV"}
+
+
+class NotApplicable(Exception):
+    """このプローブ方法は対象ファイルに使えない"""
+
+
+class ProbeError(Exception):
+    """プローブで情報が取れなかった"""
+
+
+def _empty_info() -> dict:
+    return {
+        "height": 0,
+        "width": 0,
+        "length": "",
+        "fourcc": "",
+        "profile": "",
+        "audio_channels": 0,
+        "chroma_subsampling": "",
+        "bit_depth": 0,
+        "audio_codecs": "",
+        "audio_stream": 0,
+        "writing_app": "",
+        # 分数（"30000/1001" など）。分からなければ ""
+        "frame_rate": "",
+    }
+
+
+def _probe_header(fname: Path) -> dict:
+    if fname.suffix.upper() not in HEADER_SUFFIXES:
+        raise NotApplicable(fname.suffix)
+    header = mp4header.parse(fname)
+    info = _empty_info()
+    video = [t for t in header["tracks"] if t["handler"] == "vide"]
+    audio = [t for t in header["tracks"] if t["handler"] == "soun"]
+    if not video:
+        raise ProbeError("no video track")
+    v = video[0]
+    info["width"] = v.get("width", 0)
+    info["height"] = v.get("height", 0)
+    info["fourcc"] = v.get("format", "")
+    info["profile"] = v.get("profile", "")
+    info["chroma_subsampling"] = v.get("chroma_subsampling", "")
+    info["bit_depth"] = v.get("bit_depth", 0)
+    info["frame_rate"] = v.get("frame_rate", "")
+    if header["duration"] > 0:
+        info["length"] = mp4header.format_duration(header["duration"])
+    if audio:
+        info["audio_stream"] = len(audio)
+        info["audio_channels"] = audio[0].get("channels", 0)
+        info["audio_codecs"] = " / ".join(t.get("format", "") for t in audio)
+        if len(info["audio_codecs"]) > 12:
+            info["audio_codecs"] = audio[0].get("format", "")
+    info["writing_app"] = header["writing_app"]
+    return info
+
+
+def _probe_mediainfo(fname: Path, parse_speed: float = 0) -> dict:
+    from pymediainfo import MediaInfo
+
+    info = _empty_info()
+    media_info = MediaInfo.parse(fname, parse_speed=parse_speed)
+    if not media_info.general_tracks or not media_info.video_tracks:
+        raise ProbeError("no video track")
+    general_info = media_info.general_tracks[0]
+    video_info = media_info.video_tracks[0]
+    if general_info.count_of_audio_streams is not None and media_info.audio_tracks:
+        audio_info = media_info.audio_tracks[0]
+        info["audio_channels"] = (
+            audio_info.channel_s if audio_info.channel_s is not None else 0
+        )
+        info["audio_codecs"] = general_info.audio_codecs or ""
+        if len(info["audio_codecs"]) > 12:
+            info["audio_codecs"] = audio_info.other_format[0]
+        info["audio_stream"] = int(general_info.count_of_audio_streams)
+    info["height"] = video_info.height or 0
+    info["width"] = video_info.width or 0
+    if general_info.other_duration is not None and len(general_info.other_duration) > 3:
+        info["length"] = general_info.other_duration[3]
+    info["fourcc"] = "XVID" if video_info.codec_id == "XVID" else video_info.format
+    info["profile"] = video_info.format_profile or ""
+    info["chroma_subsampling"] = video_info.chroma_subsampling or ""
+    info["bit_depth"] = video_info.bit_depth or 0
+    info["writing_app"] = general_info.writing_application or ""
+    if video_info.frame_rate_num and video_info.frame_rate_den:
+        info["frame_rate"] = str(
+            Fraction(int(video_info.frame_rate_num), int(video_info.frame_rate_den))
+        )
+    return info
+
+
+def _probe_opencv(fname: Path) -> dict:
+    """Get frame size data from the video file using OpenCV"""
+    import cv2
+
+    info = _empty_info()
+    video_track = cv2.VideoCapture(str(fname))
+    try:
+        info["width"] = int(video_track.get(cv2.CAP_PROP_FRAME_WIDTH))
+        info["height"] = int(video_track.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fcc_int = int(video_track.get(cv2.CAP_PROP_FOURCC))
+        info["fourcc"] = fcc_int.to_bytes(4, "little").decode("utf-8", "replace").upper()
+        fps = video_track.get(cv2.CAP_PROP_FPS)
+        fc = video_track.get(cv2.CAP_PROP_FRAME_COUNT)
+    finally:
+        video_track.release()
+    try:
+        length = fc / fps
+    except ZeroDivisionError:
+        length = 0
+    if length > 0:
+        info["length"] = mp4header.format_duration(length)
+    return info
+
+
+STRATEGIES = {
+    "header": _probe_header,
+    "mediainfo": lambda f: _probe_mediainfo(f, parse_speed=0),
+    "mediainfo_deep": lambda f: _probe_mediainfo(f, parse_speed=1),
+    "opencv": _probe_opencv,
+}
+
+
+def check_info(info: dict) -> list:
+    """プローブ結果に足りない情報があれば、その理由のリストを返す"""
+    reasons = []
+    if info["audio_stream"] == 0:
+        reasons.append("no audio track")
+    if not info["length"]:
+        reasons.append("no length")
+    if info["width"] == 0 or info["height"] == 0:
+        reasons.append(f"invalid frame size {info['width']}x{info['height']}")
+    return reasons
+
+
+def _worker_main(conn):
+    """ワーカープロセスの本体: (strategy, fname) を受け取って結果を返す"""
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        strategy, fname = request
+        try:
+            conn.send(("ok", STRATEGIES[strategy](Path(fname))))
+        except NotApplicable as e:
+            conn.send(("skip", str(e)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+        if strategy != "header":
+            streamio.drop_file_cache(fname)
+
+
+class ProbeWorker:
+    """タイムアウト付きでプローブを実行するワーカープロセス
+
+    タイムアウトしたり落ちたりしたワーカーは kill して、次の依頼のときに作り直す。
+    """
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.restarts = 0
+        self._ctx = multiprocessing.get_context("spawn")
+        self._proc = None
+        self._conn = None
+
+    def _start(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        self._proc = self._ctx.Process(
+            target=_worker_main, args=(child_conn,), daemon=True
+        )
+        self._proc.start()
+        child_conn.close()
+        self._conn = parent_conn
+
+    def _kill(self):
+        if self._proc is not None:
+            self._proc.kill()
+            self._proc.join()
+            self._conn.close()
+            self._proc = None
+            self._conn = None
+            self.restarts += 1
+
+    def run(self, strategy: str, fname: Path, timeout: float):
+        """strategy で fname をプローブする
+
+        Returns:
+            (str, object): 状態（ok, skip, error, timeout, crash）と結果または理由
+        """
+        if self._proc is None or not self._proc.is_alive():
+            self._start()
+        try:
+            self._conn.send((strategy, str(fname)))
+            if not self._conn.poll(timeout):
+                self._kill()
+                return "timeout", f"{strategy} timed out after {timeout:.1f}s"
+            return self._conn.recv()
+        except (EOFError, BrokenPipeError, ConnectionResetError) as e:
+            self._kill()
+            return "crash", f"{strategy} worker died: {e!r}"
+
+    def close(self):
+        if self._proc is not None:
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+            self._proc.join(1)
+            if self._proc.is_alive():
+                self._proc.kill()
+                self._proc.join()
+            self._conn.close()
+            self._proc = None
+            self._conn = None
+
+
+class ProbeResult:
+    """プローブの結果
+
+    info      : 取得できた情報（一つも取れなかったときは None）
+    strategy  : info を返したプローブ方法
+    reason    : info に足りない情報や失敗の理由
+    attempts  : 試したプローブ方法ごとの (strategy, status, detail, elapsed)
+    """
+
+    def __init__(self):
+        self.info = None
+        self.strategy = ""
+        self.reason = ""
+        self.attempts = []
+
+    @property
+    def timed_out(self):
+        return any(a[1] == "timeout" for a in self.attempts)
+
+
+def probe_file(fname: Path, worker: ProbeWorker, chain=DEFAULT_CHAIN) -> ProbeResult:
+    """fname を chain の順にプローブし、最初に情報がそろった結果を返す
+
+    一つのファイルにかける時間の合計は worker.timeout を超えない。
+    """
+    result = ProbeResult()
+    deadline = time.monotonic() + worker.timeout
+    best = None
+    for strategy in chain:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            result.attempts.append((strategy, "timeout", "no time left", 0.0))
+            break
+        started = time.monotonic()
+        status, payload = worker.run(strategy, fname, remaining)
+        elapsed = time.monotonic() - started
+        if status != "ok":
+            result.attempts.append((strategy, status, payload, elapsed))
+            logger.debug("probe %s %s: %s", strategy, status, payload)
+            continue
+        reasons = check_info(payload)
+        result.attempts.append((strategy, "ok", ", ".join(reasons), elapsed))
+        if best is None or len(reasons) < len(best):
+            result.info, result.strategy, best = payload, strategy, reasons
+        if not reasons:
+            break
+    if result.info is None:
+        result.reason = "; ".join(f"{a[0]}: {a[2]}" for a in result.attempts)
+    else:
+        result.reason = ", ".join(best)
+    return result
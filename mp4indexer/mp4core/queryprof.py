@@ -0,0 +1,103 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+queryprof.py:
+検索のSQLの実行時間と実行計画（mp4find -q と遅いクエリのログ）
+
+    EXPLAIN                 実行計画（実行しない）
+    ANALYZE FORMAT=JSON     実際に実行して、各段階の行数と時間を含めた実行計画（MariaDB）
+
+遅いクエリのログは1行1件のJSONで、実行時間、SQL、パラメータ、EXPLAIN の結果を書く。
+"""
+
+import json
+import logging
+import time
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def explain(cur, SQL: str, params=()) -> list:
+    """EXPLAIN の結果（行のリスト）"""
+    cur.execute(f"EXPLAIN {SQL}", params)
+    return [dict(r) for r in cur.fetchall()]
+
+
+def analyze(cur, SQL: str, params=()):
+    """ANALYZE FORMAT=JSON の結果（dict）。使えないサーバでは ANALYZE の表を返す"""
+    try:
+        cur.execute(f"ANALYZE FORMAT=JSON {SQL}", params)
+        row = cur.fetchall()[0]
+        return json.loads(next(iter(dict(row).values())))
+    except Exception as e:
+        logger.debug(f"ANALYZE FORMAT=JSON is not available: {e}")
+    cur.execute(f"ANALYZE {SQL}", params)
+    return [dict(r) for r in cur.fetchall()]
+
+
+def run(cur, SQL: str, params=()):
+    """SQL を実行して (結果, 実行時間[秒]) を返す"""
+    time_start = time.perf_counter()
+    cur.execute(SQL, params)
+    rows = cur.fetchall()
+    return rows, time.perf_counter() - time_start
+
+
+def format_table(rows: list) -> str:
+    """行（dict）のリストをタブ区切りの表にする"""
+    if not rows:
+        return "(empty)"
+    columns = list(rows[0])
+    lines = ["\t".join(columns)]
+    lines += ["\t".join(str(r.get(c, "")) for c in columns) for r in rows]
+    return "\n".join(lines)
+
+
+class SlowQueryLog:
+    """threshold_ms 以上かかったクエリを path に追記する"""
+
+    def __init__(self, path: Path, threshold_ms: float):
+        self.path = Path(path)
+        self.threshold_ms = threshold_ms
+
+    def is_slow(self, elapsed: float) -> bool:
+        return self.threshold_ms is not None and elapsed * 1000 >= self.threshold_ms
+
+    def record(self, cur, SQL: str, params, elapsed: float, plan: list = None):
+        """遅ければ実行計画と一緒にログに書く（plan がなければ EXPLAIN する）
+
+        cur は結果を読み終わっていること（EXPLAIN を実行するため）
+
+        Returns:
+            (bool): ログに書いたとき True
+        """
+        if not self.is_slow(elapsed):
+            return False
+        if plan is None:
+            try:
+                plan = explain(cur, SQL, params)
+            except Exception as e:
+                plan = [{"error": str(e)}]
+        logger.warning("slow query: %.1f ms (logged to %s)", elapsed * 1000, self.path)
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(
+                    json.dumps(
+                        {
+                            "time": datetime.now().isoformat(timespec="seconds"),
+                            "elapsed_ms": round(elapsed * 1000, 1),
+                            "sql": " ".join(SQL.split()),
+                            "params": list(params),
+                            "plan": plan,
+                        },
+                        ensure_ascii=False,
+                        default=str,
+                    )
+                    + "\n"
+                )
+        except OSError as e:
+            logger.warning(f"couldn't write slow query log: {e}")
+        return True
@@ -0,0 +1,127 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+rank.py:
+検索結果の順位付け（mp4find --top）
+
+BM25F に近いスコアで、検索語がファイル名・ディレクトリ名（text モードでは説明文も）に
+何回現れるかを数え、フィールドごとの重み（ファイル名を重くする）と長さで正規化する。
+それに新しいファイルほど高くなる点数を足す。
+
+結果は上位 k 件だけをヒープに持つので、ヒット件数が多くても全件を並べ替えない。
+
+検索語ごとの IDF には全体のレコード数と検索語を含むレコード数（df）が要る。
+検索サービスはメモリ上のインデックスから数えて渡す。渡されないときは同じ重みにする
+（検索は AND なので、候補はどれもすべての検索語を含んでいる）。
+"""
+
+import heapq
+import math
+import re
+from datetime import datetime
+
+from mp4core.normalize import normalize_patterns, search_key
+
+# BM25 のパラメータ
+K1 = 1.2
+B = 0.75
+# フィールドごとの重み（ファイル名の一致を重く見る）
+FIELD_WEIGHTS = {"filename": 2.0, "directory": 1.0, "description": 0.5}
+# フィールドの平均の長さ（呼び出し側が知らないとき）
+DEFAULT_AVG_LENGTHS = {"filename": 40, "directory": 30, "description": 400}
+# 検索語が単語（区切り文字で区切られた部分）と一致したときの加点
+WORD_BONUS = 0.5
+# 新しさの点数（RECENCY_WEIGHT * 0.5 ** (経過日数 / RECENCY_HALF_LIFE)）
+RECENCY_WEIGHT = 1.0
+RECENCY_HALF_LIFE = 90
+
+_word_split = re.compile(r"[\W_]+")
+
+
+def tokenize(s: str) -> set:
+    """区切り文字（空白、記号、_）で分けた単語の集合（小文字）"""
+    return {t for t in _word_split.split(s.casefold()) if t}
+
+
+class Scorer:
+    """検索語に対するレコードのスコアを計算する
+
+    Args:
+        patterns (list): 検索語
+        text (bool): 説明文もスコアに含めるか
+        n_docs (int): 全体のレコード数（df とあわせて IDF に使う）
+        df (dict): 検索語（正規化したもの） -> その語を含むレコード数
+        avg_lengths (dict): フィールド -> 平均の長さ
+        now (datetime): 新しさの基準の日時
+    """
+
+    def __init__(
+        self,
+        patterns: list,
+        text: bool = False,
+        n_docs: int = None,
+        df: dict = None,
+        avg_lengths: dict = None,
+        now: datetime = None,
+    ):
+        # 名前は検索と同じく正規化して比べる（説明文は小文字にするだけ）
+        self.words = normalize_patterns(patterns)
+        self.fields = ["filename", "directory"] + (["description"] if text else [])
+        self.avg_lengths = dict(DEFAULT_AVG_LENGTHS, **(avg_lengths or {}))
+        self.now = now or datetime.now()
+        self.idf = {}
+        for w in self.words:
+            if n_docs and df and w in df:
+                n = df[w]
+                self.idf[w] = math.log(1 + (n_docs - n + 0.5) / (n + 0.5))
+            else:
+                self.idf[w] = 1.0
+
+    def score(self, row: dict) -> float:
+        values = {
+            f: search_key(row.get(f) or "")
+            if f != "description"
+            else (row.get(f) or "").casefold()
+            for f in self.fields
+        }
+        norms = {
+            f: 1 - B + B * len(values[f]) / max(self.avg_lengths[f], 1)
+            for f in self.fields
+        }
+        filename_words = tokenize(values["filename"])
+        score = 0.0
+        for w in self.words:
+            tf = sum(
+                FIELD_WEIGHTS[f] * values[f].count(w) / norms[f] for f in self.fields
+            )
+            if tf > 0:
+                score += self.idf[w] * tf * (K1 + 1) / (tf + K1)
+            if w in filename_words:
+                score += self.idf[w] * WORD_BONUS
+        if (filedate := row.get("filedate")) is not None:
+            age = max((self.now - filedate).total_seconds() / 86400, 0)
+            score += RECENCY_WEIGHT * 0.5 ** (age / RECENCY_HALF_LIFE)
+        return score
+
+
+def top_k(rows, scorer: Scorer, k: int) -> list:
+    """rows のうちスコアの高い k 件を、高い順に [(スコア, レコード), ...] で返す
+
+    rows はイテレータでよい（全件をリストにしない）
+    """
+    if k <= 0:
+        return []
+    heap = []
+    for seq, row in enumerate(rows):
+        item = (scorer.score(row), -seq, row)
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, item)
+    # 同じスコアなら先に見つかった（名前順で前の）ものを上にする
+    return [(s, row) for s, _, row in sorted(heap, key=lambda x: x[:2], reverse=True)]
+
+
+def ranked(rows, scorer: Scorer, k: int) -> list:
+    """top_k の結果を、score を付けたレコードのリストにする（元のレコードは変えない）"""
+    return [dict(row, score=round(s, 4)) for s, row in top_k(rows, scorer, k)]
@@ -0,0 +1,159 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+render.py:
+mp4find の検索結果の表示
+
+    pretty  色付き（検索語を強調する）。text モードでは説明文のうち検索語を含む行も表示する
+    tsv     タブ区切り（色なし）。他のツールに渡す用
+    ndjson  1行1レコードのJSON（色なし）
+
+強調表示はすべての検索語を一つの正規表現（選択）にまとめて、一度の走査で置き換える。
+出力は BATCH_SIZE 件ずつまとめて書き出す（1行ずつ print しない）。
+"""
+
+import json
+import re
+import sys
+from functools import lru_cache
+
+from mp4core.console import BRIGHT_BLUE, BRIGHT_GREEN, BRIGHT_MAGENTA, BRIGHT_YELLOW, DEFAULT
+from mp4core.lazy import lazy_import
+from mp4core.normalize import search_key
+
+jaconv = lazy_import("jaconv")
+
+FORMATS = ["pretty", "tsv", "ndjson"]
+BATCH_SIZE = 500
+
+TSV_COLUMNS = [
+    "directory",
+    "filename",
+    "width",
+    "height",
+    "length",
+    "filesize",
+    "filedate",
+]
+
+
+def _like_to_regexp(keyword: str) -> str:
+    """LIKE の検索語を同じものにマッチする正規表現にする（% と _ 以外はそのまま）"""
+    return "".join(
+        ".*?" if c == "%" else "." if c == "_" else re.escape(c) for c in keyword
+    )
+
+
+def _variants(keyword: str) -> set:
+    """名前の中に現れうる検索語の書き方（そのまま、正規化したもの、全角にしたもの）
+
+    検索は正規化した名前で行うので、表示する元の名前では全角・半角が違うことがある
+    """
+    key = search_key(keyword)
+    return {keyword, key, jaconv.h2z(key, kana=False, ascii=True, digit=True)} - {""}
+
+
+@lru_cache(maxsize=64)
+def highlighter(patterns: tuple, regexp: bool):
+    """すべての検索語にマッチする一つの正規表現（長い語を優先する）
+
+    検索語がないときは None
+    """
+    if regexp:
+        alternatives = [p for p in patterns if p]
+    else:
+        words = {v for p in patterns if p for v in _variants(p)}
+        alternatives = [
+            _like_to_regexp(w) for w in sorted(words, key=len, reverse=True)
+        ]
+    if not alternatives:
+        return None
+    try:
+        return re.compile("|".join(f"(?:{a})" for a in alternatives), re.IGNORECASE)
+    except re.error:
+        # 強調できない正規表現は強調しない（検索はDB側の REGEXP で行っている）
+        return None
+
+
+def _colorize(rx, s: str, color: str):
+    """s の中の rx にマッチする部分を color で囲む
+
+    Returns:
+        (str, int): 置き換えた文字列と、マッチした数
+    """
+    if rx is None:
+        return s, 0
+    return rx.subn(lambda m: color + m.group() + DEFAULT, s)
+
+
+def format_pretty(item: dict, rx, text: bool) -> str:
+    dirname, _ = _colorize(rx, item["directory"], BRIGHT_YELLOW)
+    fname, _ = _colorize(rx, item["filename"], BRIGHT_GREEN)
+    fsize = "{:,}".format(item["filesize"])
+    dtime = item["filedate"].strftime("%Y-%m-%d %H:%M:%S")
+    framesize = (
+        (BRIGHT_BLUE + f'{item["width"]}x{item["height"]}' + DEFAULT)
+        if item["width"] > 0
+        else ""
+    )
+    line = f'"{dirname}/{fname}"\t{framesize}\t{item["length"]}\t{fsize}\t{dtime}\n'
+    # 説明文は text モードのときだけ（名前の検索では空）
+    if text and (desc := item.get("description")):
+        desc, n = _colorize(rx, desc, BRIGHT_MAGENTA)
+        if n:
+            line += "".join(f"    {l}\n" for l in desc.split("\n") if "\033" in l)
+    return line
+
+
+def _tsv_value(v) -> str:
+    if hasattr(v, "strftime"):
+        return v.strftime("%Y-%m-%d %H:%M:%S")
+    return str(v).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+def format_tsv(item: dict, text: bool) -> str:
+    columns = TSV_COLUMNS + ["description"] if text else TSV_COLUMNS
+    return "\t".join(_tsv_value(item.get(c, "")) for c in columns) + "\n"
+
+
+def format_ndjson(item: dict, text: bool) -> str:
+    if not text:
+        item = {k: v for k, v in item.items() if k != "description"}
+    return json.dumps(item, ensure_ascii=False, default=str) + "\n"
+
+
+def render(
+    result,
+    patterns: list,
+    regexp: bool,
+    text: bool = False,
+    fmt: str = "pretty",
+    out=None,
+):
+    """検索結果を届いた順に fmt の形式で out（標準出力）に書き出す
+
+    Returns:
+        (int, tuple): 書き出した件数と、最後のレコードの (directory, filename)
+    """
+    if out is None:
+        out = sys.stdout
+    rx = highlighter(tuple(patterns), regexp) if fmt == "pretty" else None
+    count = 0
+    last = None
+    buf = []
+    for item in result:
+        count += 1
+        last = (item["directory"], item["filename"])
+        if fmt == "ndjson":
+            buf.append(format_ndjson(item, text))
+        elif fmt == "tsv":
+            buf.append(format_tsv(item, text))
+        else:
+            buf.append(format_pretty(item, rx, text))
+        if len(buf) >= BATCH_SIZE:
+            out.write("".join(buf))
+            out.flush()
+            buf.clear()
+    out.write("".join(buf))
+    out.flush()
+    return count, last
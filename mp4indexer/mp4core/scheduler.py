@@ -0,0 +1,120 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+scheduler.py:
+依存関係のあるタスク（ファイルごとの小さな DAG）をキューごとのスレッドプールで実行する
+
+    cpu             CPU を使う処理（音声エンコードなど）。CPU の数だけ並列に動かす
+    その他のキュー  I/O の処理。キュー（書き込み先のデバイスなど）ごとに1本ずつ順に動かす
+
+外部プログラムを呼ぶ処理が中心なので、プロセスではなくスレッドで動かす。
+タスクが失敗すると、それに依存するタスク（同じファイルの後の段階）は実行しない。
+依存関係のない他のタスクはそのまま続ける。
+"""
+
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class Task:
+    """スケジューラに登録した一つの処理（Scheduler.add が作る）
+
+    終わったら func の戻り値を result に入れる（後のタスクは deps の result を読める）
+    """
+
+    def __init__(self, name: str, func, args: tuple, deps: list, queue: str, group):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = deps
+        self.queue = queue
+        self.group = group
+        self.state = PENDING
+        self.result = None
+        self.error = None
+
+    def __repr__(self):
+        return f"Task({self.name!r}, {self.state})"
+
+
+class Scheduler:
+    """依存関係を満たしたタスクから、キューごとのスレッドプールで実行する
+
+    Args:
+        workers (dict): キュー -> 並列数（cpu は CPU の数、書いていないキューは 1）
+    """
+
+    def __init__(self, workers: dict = None):
+        self.workers = {"cpu": os.cpu_count() or 1, **(workers or {})}
+        self.tasks = []
+
+    def add(self, name: str, func, *args, deps=(), queue: str = "cpu", group=None):
+        """タスクを登録する（deps は登録済みのタスク。None は無視する）
+
+        Returns:
+            (Task): 後のタスクの deps に渡す
+        """
+        task = Task(name, func, args, [d for d in deps if d is not None], queue, group)
+        self.tasks.append(task)
+        return task
+
+    def run(self) -> list:
+        """すべてのタスクを実行する
+
+        Returns:
+            (list): 失敗したタスク（依存していて実行しなかったタスクは含まない）
+        """
+        executors = {}
+        running = {}
+        waiting = list(self.tasks)
+        try:
+            while waiting or running:
+                # 登録順（依存先が先）に見るので、スキップは一度で後ろまで伝わる
+                for task in waiting:
+                    if any(d.state in (FAILED, SKIPPED) for d in task.deps):
+                        task.state = SKIPPED
+                        logger.info("skip %s", task.name)
+                for task in [t for t in waiting if t.state == PENDING]:
+                    if all(d.state == DONE for d in task.deps):
+                        running[self._submit(executors, task)] = task
+                waiting = [t for t in waiting if t.state == PENDING]
+                if not running:
+                    # 残っているのは実行できないタスク（依存関係が循環している）
+                    for task in waiting:
+                        task.state = SKIPPED
+                        logger.error("unresolvable dependency: %s", task.name)
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        task.result = future.result()
+                        task.state = DONE
+                        logger.debug("done %s", task.name)
+                    except Exception as e:
+                        task.state = FAILED
+                        task.error = e
+                        logger.error("%s failed: %s", task.name, e)
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True, cancel_futures=True)
+        return [t for t in self.tasks if t.state == FAILED]
+
+    def _submit(self, executors: dict, task: Task):
+        if task.queue not in executors:
+            executors[task.queue] = ThreadPoolExecutor(
+                max_workers=self.workers.get(task.queue, 1),
+                thread_name_prefix=task.queue,
+            )
+        logger.debug("start %s", task.name)
+        task.state = RUNNING
+        return executors[task.queue].submit(task.func, *task.args)
@@ -0,0 +1,345 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+search.py:
+videolist の検索（mp4find と検索サービス mp4find_server で共有する）
+"""
+
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from os import environ
+from pathlib import Path
+
+from mp4core import filters as filters_module
+from mp4core import trigram
+from mp4core.lazy import lazy_import
+from mp4core.normalize import search_key
+
+cmigemo = lazy_import("cmigemo")
+mariadb = lazy_import("mariadb")
+
+logger = logging.getLogger(__name__)
+
+migemo_dict = "c:/Apps/bin/dict/base-dict"
+
+encoded_video_ext = ["M2TS", "MP4", "MKV"]
+
+
+class PatternCache:
+    """検索語 -> Migemo の正規表現 の LRU キャッシュ
+
+    Migemo の辞書は最初にキャッシュに無い検索語が来たときに一度だけ読み込む。
+    path を指定するとキャッシュをファイルに保存し、次回の起動時に読み込む。
+    辞書ファイルが更新されていたら保存されたキャッシュは捨てる。
+
+    保存するのは新しく展開した検索語だけで、save_every 語たまったときと終了時に、
+    ファイルにある（他のプロセスが保存した）ものとまとめて書く。保存は検索の
+    ロックの外で行うので、検索サービスの他のスレッドを待たせない。
+    """
+
+    def __init__(
+        self, dict_path: str, maxsize: int = 1000, path: Path = None, save_every: int = 16
+    ):
+        self.dict_path = dict_path
+        self.maxsize = maxsize
+        self.path = path
+        self.save_every = save_every
+        self.hits = 0
+        self.misses = 0
+        self._migemo = None
+        self._patterns = None
+        # まだ保存していない検索語
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        if path is not None:
+            atexit.register(self.save)
+
+    def _dict_mtime(self):
+        try:
+            return Path(self.dict_path).stat().st_mtime
+        except OSError:
+            return 0
+
+    def _load(self):
+        self._patterns = OrderedDict()
+        if self.path is None:
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("dict_mtime") == self._dict_mtime():
+            self._patterns.update(data.get("patterns", {}))
+
+    def save(self):
+        """まだ保存していない検索語をファイルに書く"""
+        if self.path is None:
+            return
+        with self._save_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                dict_mtime = self._dict_mtime()
+                patterns = OrderedDict()
+                try:
+                    with open(self.path, encoding="utf-8") as f:
+                        data = json.load(f)
+                    if data.get("dict_mtime") == dict_mtime:
+                        patterns.update(data.get("patterns", {}))
+                except (OSError, ValueError):
+                    pass
+                for key, value in dirty.items():
+                    patterns.pop(key, None)
+                    patterns[key] = value
+                while len(patterns) > self.maxsize:
+                    patterns.popitem(last=False)
+                # mp4find と検索サービスが同時に書くことがあるので、一時ファイルは書き手ごとに作る
+                fd, tmp = tempfile.mkstemp(
+                    prefix=self.path.name + ".", suffix=".tmp", dir=self.path.parent
+                )
+                try:
+                    with open(fd, "w", encoding="utf-8") as f:
+                        json.dump(
+                            {"dict_mtime": dict_mtime, "patterns": patterns},
+                            f,
+                            ensure_ascii=False,
+                        )
+                    os.replace(tmp, self.path)
+                except BaseException:
+                    os.unlink(tmp)
+                    raise
+            except OSError as e:
+                logger.warning(f"couldn't save pattern cache: {e}")
+
+    @property
+    def migemo(self):
+        """読み込み済みの Migemo（最初の参照で辞書を読み込む）"""
+        if self._migemo is None:
+            logger.debug("loading migemo dictionary: %s", self.dict_path)
+            self._migemo = cmigemo.Migemo(self.dict_path)
+        return self._migemo
+
+    def query(self, S: str) -> str:
+        with self._lock:
+            if self._patterns is None:
+                self._load()
+            if (ret := self._patterns.get(S)) is not None:
+                self._patterns.move_to_end(S)
+                self.hits += 1
+                return ret
+            self.misses += 1
+            ret = self.migemo.query(S)
+            self._patterns[S] = ret
+            while len(self._patterns) > self.maxsize:
+                self._patterns.popitem(last=False)
+            self._dirty[S] = ret
+            full = len(self._dirty) >= self.save_every
+        if full:
+            self.save()
+        return ret
+
+
+pattern_cache = PatternCache(
+    migemo_dict,
+    path=Path(environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    / "mp4find"
+    / "migemo.json",
+)
+
+
+def compile_pattern(S: str):
+    """Migemo で S を正規表現に展開する（結果はキャッシュする）"""
+    logger.debug("Compiling pattern: %s", S)
+    ret = pattern_cache.query(S)
+    logger.debug("regex = %s", ret)
+    # return re.compile(ret, re.IGNORECASE)
+    return ret
+
+
+# 表示に必要なカラムだけを読む（description は --text のときの TXT だけ）
+RESULT_COLUMNS = [
+    "directory",
+    "filename",
+    "filetype",
+    "width",
+    "height",
+    "length",
+    "filesize",
+    "filedate",
+]
+FETCH_SIZE = 500
+
+
+def select_columns(text: bool, prefix: str = "") -> str:
+    """結果として読むカラムのリスト（SELECT 句）"""
+    columns = [prefix + c for c in RESULT_COLUMNS]
+    if text:
+        columns.append(f'IF({prefix}filetype = "TXT", {prefix}description, "") AS description')
+    else:
+        columns.append('"" AS description')
+    return ", ".join(columns)
+
+
+def keyset_condition(after, prefix: str = ""):
+    """(directory, filename) が after より後ろのレコードを選ぶ条件
+
+    ORDER BY directory, filename（主キー順）と組み合わせて、続きのページを読むのに使う。
+    行値式 (a, b) > (?, ?) はインデックスを使わないことがあるので展開して書く。
+    """
+    directory, filename = after
+    return (
+        f"({prefix}directory > ? OR ({prefix}directory = ? AND {prefix}filename > ?))",
+        [directory, directory, filename],
+    )
+
+
+def filetype_condition(prefix: str = ""):
+    """名前だけの検索で対象にするファイルの種類（encoded_video_ext）の条件"""
+    placeholders = ", ".join(["?"] * len(encoded_video_ext))
+    return f"{prefix}filetype IN ({placeholders})", list(encoded_video_ext)
+
+
+def build_queries(
+    table_name: str,
+    patterns: list,
+    text: bool,
+    regexp: bool,
+    limit: int = None,
+    after=None,
+    filters: dict = None,
+) -> list:
+    """検索の SQL を作る（引数は search_files と同じ）
+
+    Returns:
+        (list): [(SQL, パラメータ), ...]。前から順に試し、実行できなかったときは次を使う
+        （トライグラム索引のテーブルがないときのため）
+    """
+
+    def where(prefix: str = ""):
+        """検索語以外の条件（ファイルの種類、絞り込み、ページ）"""
+        conds = []
+        params = []
+        if not text:
+            cond, p = filetype_condition(prefix)
+            conds.append(cond)
+            params += p
+        if filters:
+            c, p = filters_module.conditions(filters, prefix)
+            conds += c
+            params += p
+        if after:
+            cond, p = keyset_condition(after, prefix)
+            conds.append(cond)
+            params += p
+        return conds, params
+
+    def tail(prefix: str = ""):
+        SQL = f" ORDER BY {prefix}directory, {prefix}filename"
+        if limit:
+            SQL += f" LIMIT {int(limit)}"
+        return SQL
+
+    queries = []
+    if not text and not regexp:
+        # 名前だけの検索はトライグラム索引で候補を絞り込む
+        if (query := trigram.build_query(
+            table_name, patterns, columns=select_columns(text, "v.")
+        )) is not None:
+            SQL, params = query
+            conds, p = where("v.")
+            SQL += "".join(f" AND {c}" for c in conds) + tail("v.")
+            queries.append((SQL, params + p))
+
+    if text:
+        SEARCH_COLUMNS = """ CONCAT_WS(" ", directory, filename, description)"""
+    else:
+        SEARCH_COLUMNS = """ CONCAT_WS(" ", directory, filename)"""
+
+    if not patterns:
+        # 絞り込み条件だけの検索
+        conds, params = [], []
+    elif not regexp:
+        # 名前は正規化した search_key で、説明文はそのまま比べる
+        conds = []
+        params = []
+        for p in patterns:
+            if not (key := search_key(p)):
+                continue
+            if text:
+                conds.append("(search_key LIKE ? OR description LIKE ?)")
+                params += [f"%{key}%", f"%{p}%"]
+            else:
+                conds.append("search_key LIKE ?")
+                params.append(f"%{key}%")
+    else:
+        # regexp only supports one argument.
+        conds = [f"{SEARCH_COLUMNS} REGEXP ?"]
+        params = [compile_pattern(patterns[0])]
+    c, p = where()
+    conds += c
+    params += p
+
+    SQL = f"SELECT {select_columns(text)} FROM {table_name}"
+    if conds:
+        SQL += " WHERE " + " AND ".join(conds)
+    SQL += tail()
+    queries.append((SQL, params))
+    return queries
+
+
+def search_files(
+    cur,
+    table_name: str,
+    patterns: list,
+    text: bool,
+    regexp: bool,
+    limit: int = None,
+    after=None,
+    filters: dict = None,
+    slow_log=None,
+):
+    """videolist を検索して、見つかったレコードを見つかった順に返す（ジェネレータ）
+
+    cur に buffered=False のカーソルを渡すと、全件を読み終える前に最初の結果を返せる。
+
+    Args:
+        limit (int): 最大件数（None なら全件）
+        after (tuple): (directory, filename)。これより後ろのレコードだけを返す
+        filters (dict): 絞り込み条件（mp4core.filters）。WHERE 句に入れてDBで絞り込む
+        slow_log (SlowQueryLog): 遅かったクエリを実行計画と一緒に記録する
+            （時間は execute と fetch だけを測り、表示にかかった時間は含めない）
+    """
+    queries = build_queries(table_name, patterns, text, regexp, limit, after, filters)
+    for n, (SQL, params) in enumerate(queries, 1):
+        logger.debug(SQL)
+        time_start = time.perf_counter()
+        try:
+            cur.execute(SQL, params)
+        except mariadb.ProgrammingError as e:
+            if n == len(queries):
+                raise
+            # 索引のテーブルがまだない（mp4indexer を実行していない）
+            logger.debug(f"trigram search is not available: {e}")
+            continue
+        elapsed = time.perf_counter() - time_start
+        while True:
+            time_start = time.perf_counter()
+            rows = cur.fetchmany(FETCH_SIZE)
+            elapsed += time.perf_counter() - time_start
+            if not rows:
+                break
+            yield from rows
+        if slow_log is not None:
+            slow_log.record(cur, SQL, params, elapsed)
+        return
@@ -0,0 +1,384 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+snapshot.py:
+名前検索用のインデックスのスナップショット（mmap で読むバイナリファイル）
+
+mp4indexer が実行のたびに書き出し、mp4find は DB に接続せずにこれを mmap して
+名前を検索する（NASのDBが止まっていても検索できる）。
+開くときはヘッダを読むだけなので、件数に関係なくすぐに使える。
+
+ファイルの構成（数値はリトルエンディアン、各セクションは8バイト境界から始まる）
+
+    header    HEADER
+    keys      "directory filename" を mp4core.normalize で正規化したもの（UTF-8）を
+              (directory, filename) の順に "\\n" でつないだもの
+    starts    keys の各行の開始位置 uint64 x (n_rows + 1)（最後は番兵）
+    records   各行の表示用の情報 RECORD x n_rows
+    strings   元の directory と filename（UTF-8、RECORD から参照する）
+    grams     トライグラムの表 GRAM x n_grams（gram のバイト列の順）
+    postings  各トライグラムを含む行番号 uint32 の列（GRAM から参照する）
+
+検索語は keys と同じく正規化し、3文字以上の語があれば一番候補の少ない
+トライグラムの行だけを、なければ keys 全体を mmap.find で走査して確認する。
+
+行は DB の ORDER BY directory, filename の順（DB の照合順序）に並んでいる。続きのページ（after）は
+strings の中から after の名前をそのまま探して行の位置を求め、それより後ろの行番号だけを返す
+（Python で名前を比べると照合順序が DB と違うので、行が抜けたり重なったりする）。
+"""
+
+import array
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from bisect import bisect_right
+from datetime import datetime
+from pathlib import Path
+
+from mp4core import trigram
+from mp4core.normalize import normalize_patterns
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"MP4NIDX\0"
+VERSION = 2
+# magic, version, n_rows, n_grams, created, keys_off, keys_len, starts_off,
+# records_off, strings_off, grams_off, postings_off
+HEADER = struct.Struct("<8sIIId7Q")
+# strings の位置, directory の長さ, filename の長さ, width, height, filesize,
+# filedate (UNIX時間), keep_flag, fourcc, filetype, length
+RECORD = struct.Struct("<IHHIIQdb4s8s16s")
+# gram (UTF-8, 0埋め), postings の開始位置（要素数）, 件数
+GRAM = struct.Struct("<12sII")
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _align(f):
+    if pad := -f.tell() % 8:
+        f.write(b"\0" * pad)
+    return f.tell()
+
+
+def _fixed(s, size: int) -> bytes:
+    return (s or "").encode("utf-8")[:size]
+
+
+def write(rows: list, path: Path):
+    """rows（videolist のレコード）のスナップショットを path に書き出す
+
+    rows は (directory, filename) の順に並んでいること。
+    書き出している途中のファイルを読まれないように、一時ファイルに書いてから置き換える。
+
+    Returns:
+        (int): 書き出した件数
+    """
+    if sys.byteorder != "little":
+        raise SnapshotError("snapshot can only be written on little-endian machines")
+    keys = bytearray()
+    starts = array.array("Q")
+    strings = bytearray()
+    records = bytearray()
+    postings = {}
+    for i, r in enumerate(rows):
+        key = (
+            r.get("search_key") or trigram.name_key(r["directory"], r["filename"])
+        ).replace("\n", " ")
+        starts.append(len(keys))
+        keys += key.encode("utf-8") + b"\n"
+        for g in trigram.trigrams(key):
+            postings.setdefault(g.encode("utf-8"), array.array("I")).append(i)
+        d = r["directory"].encode("utf-8")
+        n = r["filename"].encode("utf-8")
+        filedate = r["filedate"].timestamp() if r.get("filedate") else 0.0
+        records += RECORD.pack(
+            len(strings),
+            len(d),
+            len(n),
+            r["width"] or 0,
+            r["height"] or 0,
+            r["filesize"] or 0,
+            filedate,
+            r.get("keep_flag") or 0,
+            _fixed(r.get("fourcc"), 4),
+            _fixed(r["filetype"], 8),
+            _fixed(r["length"], 16),
+        )
+        strings += d + n
+    starts.append(len(keys))
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # mp4indexer と複数の mp4copy が同時に書くことがあるので、一時ファイルは書き手ごとに作る
+    fd, tmp = tempfile.mkstemp(prefix=path.name + ".", suffix=".tmp", dir=path.parent)
+    try:
+        _write_sections(fd, keys, starts, records, strings, postings)
+        # mkstemp は所有者だけが読めるファイルを作るので、普通のファイルと同じにする
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return len(starts) - 1
+
+
+def _write_sections(fd: int, keys, starts, records, strings, postings):
+    with open(fd, "wb") as f:
+        f.write(b"\0" * HEADER.size)
+        keys_off = _align(f)
+        f.write(keys)
+        starts_off = _align(f)
+        f.write(starts.tobytes())
+        records_off = _align(f)
+        f.write(records)
+        strings_off = _align(f)
+        f.write(strings)
+        grams_off = _align(f)
+        pos = 0
+        grams = sorted(postings)
+        for g in grams:
+            f.write(GRAM.pack(g, pos, len(postings[g])))
+            pos += len(postings[g])
+        postings_off = _align(f)
+        for g in grams:
+            f.write(postings[g].tobytes())
+        f.seek(0)
+        f.write(
+            HEADER.pack(
+                MAGIC,
+                VERSION,
+                len(starts) - 1,
+                len(grams),
+                time.time(),
+                keys_off,
+                len(keys),
+                starts_off,
+                records_off,
+                strings_off,
+                grams_off,
+                postings_off,
+            )
+        )
+
+
+def write_from_db(cur, tablename: str, path: Path, filetypes: list):
+    """videolist の filetypes のレコードからスナップショットを書き出す"""
+    placeholders = ", ".join(["?"] * len(filetypes))
+    cur.execute(
+        f"""
+        SELECT directory, filename, filetype, width, height, length, filesize,
+            fourcc, filedate, keep_flag, search_key
+        FROM {tablename}
+        WHERE filetype IN ({placeholders})
+        ORDER BY directory, filename
+        """,
+        list(filetypes),
+    )
+    return write(cur.fetchall(), path)
+
+
+class NameSnapshot:
+    """mmap したスナップショット
+
+    検索結果は mp4core.search.search_files と同じカラムの dict
+    （description は空、fourcc と keep_flag も入る）を (directory, filename) の順で返す
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (
+                magic,
+                version,
+                self.n_rows,
+                self.n_grams,
+                created,
+                self._keys_off,
+                keys_len,
+                starts_off,
+                self._records_off,
+                self._strings_off,
+                self._grams_off,
+                postings_off,
+            ) = HEADER.unpack_from(self._mm, 0)
+        except struct.error as e:
+            self._mm.close()
+            raise SnapshotError(f"{path}: broken snapshot: {e}")
+        if magic != MAGIC or version != VERSION or sys.byteorder != "little":
+            self._mm.close()
+            raise SnapshotError(f"{path}: not a snapshot of version {VERSION}")
+        self.created = datetime.fromtimestamp(created)
+        self._keys_end = self._keys_off + keys_len
+        view = memoryview(self._mm)
+        self._starts = view[starts_off : starts_off + 8 * (self.n_rows + 1)].cast("Q")
+        self._postings = view[postings_off:]
+        self._view = view
+
+    def close(self):
+        # mmap を閉じる前に memoryview を解放する
+        self._starts.release()
+        self._postings.release()
+        self._view.release()
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.n_rows
+
+    def _key(self, i: int) -> bytes:
+        base = self._keys_off
+        return self._mm[base + self._starts[i] : base + self._starts[i + 1] - 1]
+
+    def _row_of_string(self, off: int):
+        """strings の off から始まる行の番号（行の先頭でなければ None）"""
+        lo, hi = 0, self.n_rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (str_off,) = struct.unpack_from("<I", self._mm, self._records_off + RECORD.size * mid)
+            if str_off < off:
+                lo = mid + 1
+            elif str_off > off:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def position_after(self, after):
+        """after = (directory, filename) の次の行番号（after の行がなければ None）
+
+        strings には各行の directory と filename が行の順に続けて入っているので、
+        after の名前をバイト列のまま探し、行の先頭で長さも一致するところを after の行とする
+        """
+        d, n = (s.encode("utf-8") for s in after)
+        name = d + n
+        if not name:
+            return None
+        base = self._strings_off
+        pos = self._mm.find(name, base, self._grams_off)
+        while pos >= 0:
+            if (i := self._row_of_string(pos - base)) is not None:
+                _, dir_len, name_len = struct.unpack_from(
+                    "<IHH", self._mm, self._records_off + RECORD.size * i
+                )
+                if (dir_len, name_len) == (len(d), len(n)):
+                    return i + 1
+            pos = self._mm.find(name, pos + 1, self._grams_off)
+        return None
+
+    def row(self, i: int) -> dict:
+        """i 行目のレコード"""
+        (
+            str_off,
+            dir_len,
+            name_len,
+            width,
+            height,
+            filesize,
+            filedate,
+            keep_flag,
+            fourcc,
+            filetype,
+            length,
+        ) = RECORD.unpack_from(self._mm, self._records_off + RECORD.size * i)
+        s = self._strings_off + str_off
+        return {
+            "directory": self._mm[s : s + dir_len].decode("utf-8"),
+            "filename": self._mm[s + dir_len : s + dir_len + name_len].decode("utf-8"),
+            "filetype": filetype.rstrip(b"\0").decode("utf-8"),
+            "width": width,
+            "height": height,
+            "length": length.rstrip(b"\0").decode("utf-8"),
+            "filesize": filesize,
+            "filedate": datetime.fromtimestamp(filedate),
+            "fourcc": fourcc.rstrip(b"\0").decode("utf-8", "replace"),
+            "keep_flag": keep_flag,
+            "description": "",
+        }
+
+    def _postings_of(self, gram: bytes):
+        """gram を含む行番号の列（gram がなければ空）"""
+        gram = gram.ljust(12, b"\0")
+        lo, hi = 0, self.n_grams
+        while lo < hi:
+            mid = (lo + hi) // 2
+            g, pos, count = GRAM.unpack_from(self._mm, self._grams_off + GRAM.size * mid)
+            if g < gram:
+                lo = mid + 1
+            elif g > gram:
+                hi = mid
+            else:
+                return self._postings[4 * pos : 4 * (pos + count)].cast("I")
+        return ()
+
+    def _scan(self, word: bytes):
+        """keys 全体を走査して word を含む行番号を（昇順で重複なく）返す"""
+        base = self._keys_off
+        pos = self._mm.find(word, base, self._keys_end)
+        while pos >= 0:
+            i = bisect_right(self._starts, pos - base) - 1
+            yield i
+            pos = self._mm.find(word, base + self._starts[i + 1], self._keys_end)
+
+    def _candidates(self, words: list):
+        """words をすべて含むかもしれない行番号（昇順）"""
+        best = None
+        for w in words:
+            for g in trigram.trigrams(w):
+                postings = self._postings_of(g.encode("utf-8"))
+                if best is None or len(postings) < len(best):
+                    best = postings
+                if not best:
+                    return ()
+        if best is not None:
+            return best
+        # 3文字以上の語がないときは一番長い語で走査する
+        return self._scan(max(words, key=len).encode("utf-8"))
+
+    def search_ids(self, patterns: list, start: int = 0):
+        """patterns のすべてを含む（AND）start 行目以降の行番号を返す"""
+        words = normalize_patterns(patterns)
+        if not words:
+            yield from range(start, self.n_rows)
+            return
+        encoded = [w.encode("utf-8") for w in words]
+        for i in self._candidates(words):
+            if i < start:
+                continue
+            key = self._key(i)
+            if all(w in key for w in encoded):
+                yield i
+
+    def search(self, patterns: list, start: int = 0):
+        """patterns のすべてを含む（AND）start 行目以降のレコードを返す（ジェネレータ）"""
+        for i in self.search_ids(patterns, start):
+            yield self.row(i)
+
+    def document_frequency(self, patterns: list) -> dict:
+        """検索語（正規化したもの）ごとに、その語を含むレコード数（順位付けの IDF に使う）"""
+        return {
+            w: sum(1 for _ in self.search_ids([w])) for w in normalize_patterns(patterns)
+        }
+
+
+def open_snapshot(path: Path):
+    """スナップショットを開く。ないときや壊れているときは None"""
+    try:
+        return NameSnapshot(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, SnapshotError) as e:
+        logger.warning(f"couldn't open name snapshot: {e}")
+        return None
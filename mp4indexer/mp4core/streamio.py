@@ -0,0 +1,142 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+streamio.py:
+大きなファイルを一度だけ順に読む処理（コピー、チェックサム、プローブ）のためのI/O
+
+数十GBの録画を読むと、ページキャッシュが二度と読まないデータで埋まり、同じマシンの
+データベースや再生に使っていたキャッシュが追い出される。そこで読むときにカーネルへ
+posix_fadvise でヒントを出す。
+
+    SEQUENTIAL  開いたときに。先読みを大きくする
+    WILLNEED    チャンクを読んだら次のチャンクを。使う側の処理（ハッシュ・書き込み）と
+                ディスクの読み込みを重ねる
+    DONTNEED    使い終わったチャンクを。読んだところからキャッシュを捨てる
+
+direct では O_DIRECT で開いてページキャッシュを通さずに読む（バッファはページ境界に
+そろえた mmap の無名領域）。O_DIRECT が使えないファイルシステム（tmpfs など）では
+普通に開く。posix_fadvise のない Windows では O_SEQUENTIAL で開くだけにする。
+"""
+
+import errno
+import logging
+import mmap
+import os
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 << 20
+# O_DIRECT のバッファと位置・長さをそろえる単位
+ALIGNMENT = mmap.PAGESIZE
+
+SEQUENTIAL = getattr(os, "POSIX_FADV_SEQUENTIAL", None)
+WILLNEED = getattr(os, "POSIX_FADV_WILLNEED", None)
+DONTNEED = getattr(os, "POSIX_FADV_DONTNEED", None)
+
+_OPEN_FLAGS = os.O_RDONLY | getattr(os, "O_BINARY", 0) | getattr(os, "O_SEQUENTIAL", 0)
+
+
+def advise(fd: int, offset: int, length: int, advice):
+    """posix_fadvise（使えないとき、失敗したときは何もしない。ヒントなので結果は見ない）
+
+    Args:
+        length (int): 0 ならファイルの終わりまで
+        advice: SEQUENTIAL, WILLNEED, DONTNEED
+    """
+    if advice is None:
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError as e:
+        logger.debug(f"posix_fadvise({fd}, {offset}, {length}, {advice}): {e}")
+
+
+def drop_cache(fd: int, offset: int = 0, length: int = 0):
+    """fd の offset から length バイトのページキャッシュを捨てるように頼む
+
+    書き込んだ範囲は fsync してからでないと（汚れたページは）捨てられない。
+    """
+    advise(fd, offset, length, DONTNEED)
+
+
+def drop_file_cache(path: Path):
+    """path 全体のページキャッシュを捨てるように頼む（読めなければ何もしない）"""
+    if DONTNEED is None:
+        return
+    try:
+        fd = os.open(path, _OPEN_FLAGS)
+    except OSError:
+        return
+    try:
+        drop_cache(fd)
+    finally:
+        os.close(fd)
+
+
+def aligned_buffer(size: int) -> mmap.mmap:
+    """ALIGNMENT にそろった（O_DIRECT で読める）size 以上のバッファ"""
+    return mmap.mmap(-1, max(-(-size // ALIGNMENT) * ALIGNMENT, ALIGNMENT))
+
+
+def open_direct(path: Path):
+    """path を O_DIRECT で開く（使えなければ普通に開く）
+
+    Returns:
+        (int, bool): ファイルディスクリプタと、O_DIRECT で開けたか
+    """
+    flag = getattr(os, "O_DIRECT", 0)
+    if flag:
+        try:
+            return os.open(path, _OPEN_FLAGS | flag), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            logger.debug(f"O_DIRECT is not supported: {path}")
+    return os.open(path, _OPEN_FLAGS), False
+
+
+def iter_chunks(
+    path: Path,
+    chunk_size: int = CHUNK_SIZE,
+    offset: int = 0,
+    direct: bool = False,
+    drop: bool = True,
+):
+    """path を offset から chunk_size ごとに読む
+
+    返すのは同じバッファの memoryview なので、次のチャンクを受け取る前に使い終えること。
+    drop なら、次のチャンクを読む前に使い終わったチャンクのキャッシュを捨てる。
+
+    Args:
+        direct (bool): O_DIRECT で読む（offset と chunk_size が ALIGNMENT の倍数のときだけ）
+    Yields:
+        (memoryview): 読んだデータ
+    """
+    if direct and (offset % ALIGNMENT or chunk_size % ALIGNMENT):
+        logger.debug(f"unaligned read, O_DIRECT is not used: {path}")
+        direct = False
+    if direct:
+        fd, direct = open_direct(path)
+    else:
+        fd = os.open(path, _OPEN_FLAGS)
+    try:
+        # 小さなファイルには残りの大きさのバッファで足りる（チャンクの区切りは変わらない）
+        size = min(chunk_size, max(os.fstat(fd).st_size - offset, 1))
+        view = memoryview(aligned_buffer(size) if direct else bytearray(size))
+        with open(fd, "rb", buffering=0, closefd=False) as f:
+            if not direct:
+                advise(fd, offset, 0, SEQUENTIAL)
+                advise(fd, offset, chunk_size, WILLNEED)
+            f.seek(offset)
+            pos = offset
+            while n := f.readinto(view):
+                if not direct:
+                    advise(fd, pos + n, chunk_size, WILLNEED)
+                yield view[:n]
+                if drop and not direct:
+                    drop_cache(fd, pos, n)
+                pos += n
+    finally:
+        # 使う側が最後のチャンクを持っているかもしれないので、バッファは閉じずに GC に任せる
+        os.close(fd)
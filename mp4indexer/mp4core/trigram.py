@@ -0,0 +1,147 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+trigram.py:
+videolist の "ディレクトリ ファイル名" のトライグラム索引（{table}_trigram）
+
+search_key LIKE "%kw%" は全件を走査するので、
+search_key（名前を mp4core.normalize で正規化したもの）の3文字ずつの組（トライグラム）と
+videolist.id の組を別テーブルに持っておき、検索語のトライグラムをすべて含む id だけを
+候補にしてから LIKE で確認する。
+
+table videolist_trigram
+----------------------
+gram | VARBINARY(12)  3文字（UTF-8）
+id   | INT UNSIGNED   videolist.id
+"""
+
+import logging
+
+from mp4core.normalize import normalize_patterns, search_key
+
+logger = logging.getLogger(__name__)
+
+
+def name_key(directory: str, filename: str) -> str:
+    """検索対象の文字列（videolist.search_key に保存するもの）"""
+    return search_key(f"{directory} {filename}")
+
+
+def trigrams(text: str) -> set:
+    """text に含まれるトライグラムの集合"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def create_table(cur, tablename: str):
+    """トライグラムのテーブルを作る
+
+    Returns:
+        (bool): 新しく作ったときは True（既存のレコードの索引を作る必要がある）
+    """
+    cur.execute(f"SHOW TABLES LIKE '{tablename}_trigram'")
+    if cur.fetchall():
+        return False
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {tablename}_trigram (
+            gram VARBINARY(12) NOT NULL,
+            id INT UNSIGNED NOT NULL,
+        PRIMARY KEY (gram, id),
+        KEY (id))
+        """
+    )
+    return True
+
+
+def add_postings(cur, tablename: str, directory: str, filename: str):
+    """1件分の search_key を保存して、トライグラムを登録する（登録済みのものは無視する）"""
+    cur.execute(
+        f"SELECT id FROM {tablename} WHERE directory = ? AND filename = ?",
+        (directory, filename),
+    )
+    if not (res := cur.fetchall()):
+        return
+    row_id = res[0]["id"]
+    key = name_key(directory, filename)
+    cur.execute(f"UPDATE {tablename} SET search_key = ? WHERE id = ?", (key, row_id))
+    grams = trigrams(key)
+    if grams:
+        cur.executemany(
+            f"INSERT IGNORE INTO {tablename}_trigram (gram, id) VALUES (?, ?)",
+            [(g, row_id) for g in grams],
+        )
+
+
+def remove_postings(cur, tablename: str, row_id: int):
+    """1件分のトライグラムを削除する"""
+    cur.execute(f"DELETE FROM {tablename}_trigram WHERE id = ?", (row_id,))
+
+
+def rebuild(conn, cur, tablename: str, batch: int = 10000):
+    """videolist の全レコードの search_key とトライグラムの索引を作り直す
+
+    Returns:
+        (int): 索引を作ったレコード数
+    """
+    cur.execute(f"TRUNCATE TABLE {tablename}_trigram")
+    count = 0
+    last_id = 0
+    while True:
+        # 全件を一度に読まないように id 順に batch 件ずつ処理する
+        cur.execute(
+            f"""
+            SELECT id, directory, filename FROM {tablename}
+            WHERE id > ? ORDER BY id LIMIT ?
+            """,
+            (last_id, batch),
+        )
+        rows = cur.fetchall()
+        if not rows:
+            break
+        keys = [(name_key(r["directory"], r["filename"]), r["id"]) for r in rows]
+        cur.executemany(f"UPDATE {tablename} SET search_key = ? WHERE id = ?", keys)
+        postings = [(g, row_id) for key, row_id in keys for g in trigrams(key)]
+        cur.executemany(
+            f"INSERT IGNORE INTO {tablename}_trigram (gram, id) VALUES (?, ?)",
+            postings,
+        )
+        conn.commit()
+        count += len(rows)
+        last_id = rows[-1]["id"]
+        logger.debug("trigram: %d rows", count)
+    return count
+
+
+def build_query(tablename: str, patterns: list, columns: str = "v.*"):
+    """検索語のトライグラムで候補を絞り込む SQL を作る
+
+    候補は検索語のトライグラムをすべて含むレコードで、最後に LIKE で確認する。
+    3文字以上の（ワイルドカードを含まない）検索語がない、つまり絞り込めないときは
+    None を返す。
+
+    Returns:
+        (str, list): SQL と パラメータ
+    """
+    patterns = normalize_patterns(patterns)
+    grams = set()
+    for p in patterns:
+        if "%" in p or "_" in p:
+            # LIKE のワイルドカードを含む語は LIKE の確認だけに使う
+            continue
+        grams |= trigrams(p)
+    if not grams:
+        return None
+    placeholders = ", ".join(["?"] * len(grams))
+    SQL = f"""
+        SELECT {columns} FROM (
+            SELECT id FROM {tablename}_trigram
+            WHERE gram IN ({placeholders})
+            GROUP BY id
+            HAVING COUNT(*) = {len(grams)}
+        ) AS c
+        JOIN {tablename} AS v ON v.id = c.id
+        WHERE """ + " AND ".join(
+        ["v.search_key LIKE ?"] * len(patterns)
+    )
+    params = list(grams) + [f"%{p}%" for p in patterns]
+    return SQL, params
@@ -0,0 +1,90 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+videolist.py:
+動画ファイルの videolist テーブルへの登録（mp4indexer と mp4copy で共通）
+
+mp4indexer はディレクトリを走査して登録し、mp4copy はコピー・移動した動画を
+その場で登録する（プローブの結果は mp4core.probe.probe_file の info）。
+"""
+
+import time
+from pathlib import Path
+
+from mp4core import trigram
+
+# 動画として登録するファイルの種類（拡張子の大文字）
+VIDEO_FILETYPES = ["MP4", "M2TS", "M2T", "MPG", "TS", "AVI", "MKV"]
+# fourcc を MPEG にする種類
+MPEG_FILETYPES = ["M2TS", "M2T", "TS", "MPG"]
+
+
+def file_attributes(f: Path):
+    """登録に使うファイルの属性
+
+    Returns:
+        (str, str, str, int, str): directory, filename, filetype, filesize, filedate
+    """
+    f = Path(f).absolute()
+    st = f.stat()
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(st.st_mtime))
+    return f.parent.as_posix(), f.name, f.suffix.upper()[1:], st.st_size, timestamp
+
+
+def upsert_sql(
+    tablename: str,
+    dirname: str,
+    fname: str,
+    filetype: str,
+    fsize: int,
+    timestamp: str,
+    info: dict,
+):
+    """動画を登録する（登録済みなら情報を更新する）SQL とパラメータ"""
+    fourcc = "MPEG" if filetype in MPEG_FILETYPES else info["fourcc"]
+    SQL = f"""
+        INSERT INTO {tablename}
+            (filename, directory, filetype, height, width,
+             length, filesize, fourcc, filedate, description, keep_flag,
+             profile, audio_channels, chroma_subsampling, bit_depth,
+             audio_codecs, audio_stream, writing_app, frame_rate)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, "", 0, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON DUPLICATE KEY
+        UPDATE height = VALUES(height), width = VALUES(width),
+            length = VALUES(length), filedate = VALUES(filedate),
+            filesize = VALUES(filesize), bit_depth = VALUES(bit_depth),
+            profile = VALUES(profile), fourcc = VALUES(fourcc),
+            frame_rate = VALUES(frame_rate)
+        RETURNING filename
+        """
+    params = (
+        fname,
+        dirname,
+        filetype,
+        info["height"],
+        info["width"],
+        info["length"],
+        fsize,
+        fourcc,
+        timestamp,
+        info["profile"],
+        info["audio_channels"],
+        info["chroma_subsampling"],
+        info["bit_depth"],
+        info["audio_codecs"],
+        info["audio_stream"],
+        info["writing_app"],
+        info.get("frame_rate", ""),
+    )
+    return SQL, params
+
+
+def upsert_video(cur, tablename: str, f: Path, info: dict):
+    """動画 f を info（プローブの結果）で登録して、名前の索引も更新する
+
+    コミットは呼び出し側で行う
+    """
+    dirname, fname, filetype, fsize, timestamp = file_attributes(f)
+    cur.execute(*upsert_sql(tablename, dirname, fname, filetype, fsize, timestamp, info))
+    cur.fetchall()
+    trigram.add_postings(cur, tablename, dirname, fname)
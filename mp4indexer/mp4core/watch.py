@@ -0,0 +1,239 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+watch.py:
+エンコードフォルダの監視（mp4copy --watch）
+
+ディレクトリの変更をOSの通知で受け取り、書き終わったファイルを見つける。
+
+    InotifyWatcher      Linux の inotify（IN_CLOSE_WRITE と IN_MOVED_TO）
+    WindowsWatcher      Windows の ReadDirectoryChangesW（pywin32）
+    PollWatcher         どちらも使えないとき。一定の間隔でディレクトリを読み直す
+
+Windows には close_write に当たる通知がないので、どの方法でも通知のあったファイルは
+StableFiles で大きさと更新日時が stable 秒変わらなくなるまで待ってから書き終わったとみなす。
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+
+from mp4core.lazy import lazy_import
+
+win32file = lazy_import("win32file")
+
+logger = logging.getLogger(__name__)
+
+# linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+_EVENT = struct.Struct("iIII")
+
+# winnt.h
+FILE_LIST_DIRECTORY = 0x0001
+FILE_NOTIFY_CHANGE_FILE_NAME = 0x0001
+FILE_NOTIFY_CHANGE_SIZE = 0x0008
+FILE_NOTIFY_CHANGE_LAST_WRITE = 0x0010
+
+
+class InotifyWatcher:
+    """inotify で書き終わった（閉じた、あるいは移動してきた）ファイルを受け取る"""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}
+
+    def add(self, directory: Path):
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO
+        )
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed", str(directory))
+        self._dirs[wd] = Path(directory)
+
+    def read(self, timeout: float) -> list:
+        """timeout 秒まで待って、通知のあったファイルのリストを返す"""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        paths = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, pos)
+            name = data[pos + _EVENT.size : pos + _EVENT.size + length].rstrip(b"\0")
+            pos += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed")
+            elif mask & IN_IGNORED:
+                # 監視していたディレクトリが消えた
+                self._dirs.pop(wd, None)
+            elif not mask & IN_ISDIR and wd in self._dirs:
+                paths.append(self._dirs[wd] / os.fsdecode(name))
+        return paths
+
+    def close(self):
+        os.close(self._fd)
+
+
+class WindowsWatcher:
+    """ReadDirectoryChangesW で変更のあったファイルを受け取る（ディレクトリごとにスレッド）"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def add(self, directory: Path):
+        handle = win32file.CreateFile(
+            str(directory),
+            FILE_LIST_DIRECTORY,
+            win32file.FILE_SHARE_READ
+            | win32file.FILE_SHARE_WRITE
+            | win32file.FILE_SHARE_DELETE,
+            None,
+            win32file.OPEN_EXISTING,
+            win32file.FILE_FLAG_BACKUP_SEMANTICS,
+            None,
+        )
+        threading.Thread(
+            target=self._watch, args=(Path(directory), handle), daemon=True
+        ).start()
+
+    def _watch(self, directory: Path, handle):
+        try:
+            while True:
+                for _, name in win32file.ReadDirectoryChangesW(
+                    handle,
+                    1 << 16,
+                    False,
+                    FILE_NOTIFY_CHANGE_FILE_NAME
+                    | FILE_NOTIFY_CHANGE_SIZE
+                    | FILE_NOTIFY_CHANGE_LAST_WRITE,
+                    None,
+                    None,
+                ):
+                    self._queue.put(directory / name)
+        except Exception as e:
+            # ディレクトリが消えたときなど
+            logger.info(f"stop watching {directory}: {e}")
+
+    def read(self, timeout: float) -> list:
+        try:
+            paths = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                paths.append(self._queue.get_nowait())
+            except queue.Empty:
+                return paths
+
+    def close(self):
+        pass
+
+
+class PollWatcher:
+    """一定の間隔でディレクトリを読み直して、大きさか更新日時の変わったファイルを返す"""
+
+    def __init__(self):
+        self._dirs = {}
+
+    def add(self, directory: Path):
+        self._dirs[Path(directory)] = self._scan(directory)
+
+    @staticmethod
+    def _scan(directory: Path) -> dict:
+        try:
+            return {
+                e.name: (e.stat().st_size, e.stat().st_mtime_ns)
+                for e in os.scandir(directory)
+                if e.is_file()
+            }
+        except OSError:
+            return {}
+
+    def read(self, timeout: float) -> list:
+        time.sleep(timeout)
+        paths = []
+        for directory, before in self._dirs.items():
+            after = self._scan(directory)
+            paths += [directory / n for n, sig in after.items() if before.get(n) != sig]
+            self._dirs[directory] = after
+        return paths
+
+    def close(self):
+        pass
+
+
+def open_watcher():
+    """この環境で使える一番よい監視の方法"""
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify is not available: {e}")
+    elif sys.platform == "win32":
+        try:
+            win32file.CreateFile
+            return WindowsWatcher()
+        except ImportError as e:
+            logger.warning(f"ReadDirectoryChangesW is not available: {e}")
+    return PollWatcher()
+
+
+class StableFiles:
+    """通知のあったファイルのうち、大きさと更新日時が stable 秒変わらないものを返す
+
+    Args:
+        stable (float): 書き終わったとみなすまでの秒数
+    """
+
+    def __init__(self, stable: float):
+        self.stable = stable
+        self._files = {}
+
+    def __contains__(self, path: Path) -> bool:
+        return path in self._files
+
+    def add(self, path: Path):
+        """path に通知があった（書き込まれた）"""
+        try:
+            st = os.stat(path)
+            sig = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            sig = None
+        self._files[path] = (sig, time.monotonic())
+
+    def ready(self) -> list:
+        """書き終わったファイルを返す（返したファイルと消えたファイルは忘れる）"""
+        now = time.monotonic()
+        result = []
+        for path, (sig, since) in list(self._files.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self._files[path]
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if current != sig:
+                self._files[path] = (current, now)
+            elif now - since >= self.stable:
+                del self._files[path]
+                result.append(path)
+        return result
@@ -11,127 +11,302 @@ mp4find.py:
 データベースからMP4ファイルを検索する"""
 
 import argparse
-import json
-import re
 import logging
+import sys
+import threading
 import time
-from ctypes import windll, wintypes, byref
-from os import environ
-from pathlib import Path
 from datetime import datetime, timedelta
+from itertools import islice
 from shutil import disk_usage
-from typing import List
 from sys import exit
 
-import cmigemo
-import mariadb
+from mp4core import filters, queryprof, rank, render, search, snapshot
+from mp4core.config import connect, create_pool, load_config
+from mp4core.console import color_console_enable
 
 __version__ = "0.5"
 
 
-migemo_dict = "c:/Apps/bin/dict/base-dict"
-BRIGHT_RED = "\033[91m"
-BRIGHT_GREEN = "\033[92m"
-BRIGHT_YELLOW = "\033[93m"
-BRIGHT_BLUE = "\033[94m"
-BRIGHT_MAGENTA = "\033[95m"
-BRIGHT_CYAN = "\033[96m"
-BRIGHT_WHITE = "\033[97m"
-DEFAULT = "\033[39m"
-
-encoded_video_ext = ["M2TS", "MP4", "MKV"]
-
-
-def color_console_enable():
-    INVALID_HANDLE_VALUE = -1
-    STD_INPUT_HANDLE = -10
-    STD_OUTPUT_HANDLE = -11
-    STD_ERROR_HANDLE = -12
-    ENABLE_VIRTUAL_TERMINAL_PROCESSING = 0x0004
-    ENABLE_LVB_GRID_WORLDWIDE = 0x0010
-
-    hOut = windll.kernel32.GetStdHandle(STD_OUTPUT_HANDLE)
-    if hOut == INVALID_HANDLE_VALUE:
-        return False
-    dwMode = wintypes.DWORD()
-    if windll.kernel32.GetConsoleMode(hOut, byref(dwMode)) == 0:
-        return False
-    dwMode.value |= ENABLE_VIRTUAL_TERMINAL_PROCESSING
-    # dwMode.value |= ENABLE_LVB_GRID_WORLDWIDE
-    if windll.kernel32.SetConsoleMode(hOut, dwMode) == 0:
-        return False
-    return True
-
-
-def compile_pattern(S: str):
-    logger.debug("Compiling pattern: %s", S)
-    m = cmigemo.Migemo(migemo_dict)
-    ret = m.query(S)
-    logger.debug("regex = %s", ret)
-    # return re.compile(ret, re.IGNORECASE)
-    return ret
-
-
-def search_files(cur, table_name: str, patterns: list, text: bool, regexp: bool):
-    # TODO: check REGEXP perfomance
-
-    if text:
-        SEARCH_COLUMNS = """ CONCAT_WS(" ", directory, filename, description)"""
-    else:
-        SEARCH_COLUMNS = """ CONCAT_WS(" ", directory, filename)"""
-
-    if not regexp:
-        pat = f""" {SEARCH_COLUMNS} LIKE "%{patterns[0]}%" """
-        if len(patterns) > 1:
-            for p in patterns[1:]:
-                pat += f""" AND {SEARCH_COLUMNS} LIKE "%{p}%" """
+def query_service(
+    config: dict,
+    patterns: list,
+    text: bool,
+    regexp: bool,
+    limit=None,
+    after=None,
+    conditions: dict = None,
+    top: int = None,
+):
+    """検索サービス（mp4find_server）に問い合わせる
+
+    Returns:
+        (list): 検索結果。サービスが動いていないときは None
+    """
+    # http.client のインポートも少し重いので、ここでインポートする
+    import http.client
+    import json
+    from urllib.parse import urlencode
+
+    params = [("q", p) for p in patterns]
+    params += [("text", int(text)), ("regexp", int(regexp))]
+    if limit:
+        params.append(("limit", limit))
+    if after:
+        params.append(("after", "/".join(after)))
+    if conditions:
+        params += filters.to_params(conditions)
+    if top:
+        params.append(("top", top))
+    query = urlencode(params)
+    conn = http.client.HTTPConnection(
+        config["search_host"], config["search_port"], timeout=10
+    )
+    try:
+        conn.connect()
+    except OSError:
+        return None
+    try:
+        conn.request("GET", f"/search?{query}")
+        res = conn.getresponse()
+        data = json.loads(res.read())
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        logger.warning(f"search service error: {e}")
+        return None
+    finally:
+        conn.close()
+    if res.status != 200:
+        logger.warning(f"search service error: {data.get('error')}")
+        return None
+    logger.debug("served from %s in %.1f ms", data["source"], data["elapsed"])
+    for row in data["rows"]:
+        row["filedate"] = datetime.fromisoformat(row["filedate"])
+    return data["rows"]
+
+
+class Searcher:
+    """検索の実行
+
+    名前だけの検索はスナップショットで、それ以外は検索サービス（mp4find_server）が
+    動いていればサービスで、そうでなければDBを直接検索する。
+    search は結果を読みながら返す（1スレッド用）。search_all は結果をリストで返し、
+    複数のスレッドから呼べる（DBはコネクションプールから接続を借りる）。
+    """
+
+    def __init__(self, config: dict, args, conditions: dict, pool_size: int = 4):
+        self.config = config
+        self.args = args
+        self.conditions = conditions
+        self.table_name = config["table_name"]
+        self.use_service = not args.direct
+        self.slow_log = queryprof.SlowQueryLog(
+            config["slow_query_log"], config["slow_query_ms"]
+        )
+        # スナップショットは開くだけならすぐなので最初に開いておく
+        self.snap = None if args.direct else snapshot.open_snapshot(config["snapshot_path"])
+        self._conn = None
+        self._cur = None
+        self._pool = None
+        self._pool_size = pool_size
+        self._pool_lock = threading.Lock()
+        # プールが空のときは get_connection() が例外になるので、セマフォで待たせる
+        self._pool_sem = threading.BoundedSemaphore(pool_size)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+        if self.snap is not None:
+            self.snap.close()
+
+    def _use_snapshot(self) -> bool:
+        return self.snap is not None and not self.args.text and not self.args.regexp
+
+    def _search_snapshot(self, keywords: list, start: int = 0):
+        """スナップショットで start 行目以降の名前を検索する（DBに接続しない）"""
+        logger.debug("search name snapshot of %s", self.snap.created)
+        result = self.snap.search(keywords, start)
+        if self.conditions:
+            result = (r for r in result if filters.match(r, self.conditions))
+        if self.args.top:
+            scorer = rank.Scorer(
+                keywords, n_docs=len(self.snap), df=self.snap.document_frequency(keywords)
+            )
+            return rank.ranked(result, scorer, self.args.top)
+        if self.args.limit:
+            result = islice(result, self.args.limit)
+        return result
+
+    def _query_service(self, keywords: list, after=None):
+        """サービスに問い合わせる。動いていなければ None（以後はサービスを使わない）"""
+        if not self.use_service:
+            return None
+        args = self.args
+        result = query_service(
+            self.config,
+            keywords,
+            args.text,
+            args.regexp,
+            args.limit,
+            after,
+            self.conditions,
+            args.top,
+        )
+        if result is None:
+            logger.debug("search service is not running. search DB directly.")
+            self.use_service = False
+        return result
+
+    def _search_db(self, cur, keywords: list, after=None):
+        args = self.args
+        result = search.search_files(
+            cur,
+            self.table_name,
+            keywords,
+            args.text,
+            args.regexp,
+            args.limit,
+            after,
+            self.conditions,
+            self.slow_log,
+        )
+        if args.top:
+            # 結果を読みながら上位 top 件だけを残す
+            scorer = rank.Scorer(keywords if not args.regexp else [], args.text)
+            return rank.ranked(result, scorer, args.top)
+        return result
+
+    def search(self, keywords: list, after=None):
+        """検索結果を読みながら返す"""
+        if self._use_snapshot():
+            # 続きのページは after の行の次から（スナップショットは DB の照合順序で並んでいる）
+            start = self.snap.position_after(after) if after else 0
+            if start is not None:
+                return self._search_snapshot(keywords, start)
+            # after の行がスナップショットにない（後から登録された）ときは DB の順序で比べる
+            logger.debug("%s is not in the snapshot", "/".join(after))
+        if (result := self._query_service(keywords, after)) is not None:
+            return result
+        if self._conn is None:
+            self._conn = connect(self.config)
+            # 読み終える前に表示を始められるように、結果をバッファしないカーソルを使う
+            self._cur = self._conn.cursor(dictionary=True, buffered=False)
+        return self._search_db(self._cur, keywords, after)
+
+    def search_all(self, keywords: list) -> list:
+        """検索結果をリストで返す（複数のスレッドから呼べる）"""
+        if self._use_snapshot():
+            return list(self._search_snapshot(keywords))
+        if (result := self._query_service(keywords)) is not None:
+            return result
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = create_pool(self.config, self._pool_size)
+        with self._pool_sem:
+            conn = self._pool.get_connection()
+            try:
+                cur = conn.cursor(dictionary=True)
+                return list(self._search_db(cur, keywords))
+            finally:
+                # プールに返す
+                conn.close()
+
+
+def run_batch(searcher: Searcher, queries, jobs: int, text: bool):
+    """queries（1行に1つの検索）を jobs 個ずつ並行に検索し、終わった順に
+    {"query": 行, "index": 行番号, "count": 件数, "rows": [...]} を1行のJSONで書き出す
+
+    Returns:
+        (int, int): 検索の数と、1件以上見つかった検索の数
+    """
+    import json
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    queries = [q.strip() for q in queries if q.strip()]
+    found = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(searcher.search_all, q.split()): (i, q)
+            for i, q in enumerate(queries)
+        }
+        for future in as_completed(futures):
+            i, q = futures[future]
+            try:
+                rows = future.result()
+            except Exception as e:
+                logger.error(f"{q}: {e}")
+                record = {"query": q, "index": i, "error": str(e)}
+            else:
+                if not text:
+                    rows = [
+                        {k: v for k, v in r.items() if k != "description"} for r in rows
+                    ]
+                found += bool(rows)
+                record = {"query": q, "index": i, "count": len(rows), "rows": rows}
+            sys.stdout.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            sys.stdout.flush()
+    return len(queries), found
+
+
+def profile_query(searcher: Searcher, keywords: list, after=None):
+    """SQL（-q で指定したもの、なければ検索語から作ったもの）を実行して、
+    件数と実行時間、EXPLAIN と ANALYZE の結果を表示する
+
+    遅いクエリは遅いクエリのログにも書く
+    """
+    import json
+
+    args = searcher.args
+    if args.query:
+        queries = [(args.query, [])]
     else:
-        # regexp only supports one argument.
-        pat = f""" {SEARCH_COLUMNS} REGEXP "{compile_pattern(patterns[0])}" """
-
-    SQL = f"SELECT * FROM {table_name} WHERE {pat}"
-    if not text:
-        #TODO: filetypeをencoded_video_extから作りたいけど、面倒なのでおいておく
-        SQL += """ AND (filetype in ("MP4", "MKV", "M2TS"))"""
-    logger.debug(SQL)
-    cur.execute(SQL)
-    data = cur.fetchall()
-    result = [dict(d) for d in data]
-    logger.debug(result)
-    return result
-
-
-def pretty_print(result: list, patterns: list, regexp: bool):
-    match_list: List[re.Pattern] = []
-    for p in patterns:
-        match_list.append(re.compile(p))
-
-    for item in result:
-        dirname = item["directory"]
-        fname = item["filename"]
-        desc = item["description"]
-        fsize = "{:,}".format(item["filesize"])
-        length = item["length"]
-        dtime = item["filedate"].strftime("%Y-%m-%d %H:%M:%S")
-        framesize = (
-            (BRIGHT_BLUE + f'{item["width"]}x{item["height"]}' + DEFAULT)
-            if item["width"] > 0
-            else ""
+        # トライグラム索引を使うものと使わないものの両方を試す
+        queries = search.build_queries(
+            searcher.table_name,
+            keywords,
+            args.text,
+            args.regexp,
+            args.limit,
+            after,
+            searcher.conditions,
         )
-        for rx in match_list:
-            if res := rx.search(dirname):
-                dirname = rx.sub(BRIGHT_YELLOW + res.group() + DEFAULT, dirname)
-            if res := rx.search(fname):
-                fname = rx.sub(BRIGHT_GREEN + res.group() + DEFAULT, fname)
-            if res := rx.search(desc):
-                desc = rx.sub(
-                    BRIGHT_MAGENTA + res.group() + DEFAULT, desc, re.MULTILINE
-                )
-        print(f'"{dirname}/{fname}"\t{framesize}\t{length}\t{fsize}\t{dtime}')
-        if desc != "":
-            for line in desc.split("\n"):
-                if "\033" in line:
-                    print(f"    {line}")
+    conn = connect(searcher.config)
+    cur = conn.cursor(dictionary=True)
+    try:
+        for SQL, params in queries:
+            print(" ".join(SQL.split()))
+            if params:
+                print(f"params: {params}")
+            try:
+                rows, elapsed = queryprof.run(cur, SQL, params)
+                plan = queryprof.explain(cur, SQL, params)
+                analyzed = queryprof.analyze(cur, SQL, params)
+            except search.mariadb.Error as e:
+                logger.error(f"query failed: {e}")
+                continue
+            logger.info("%d rows in %.1f ms", len(rows), elapsed * 1000)
+            print("EXPLAIN:")
+            print(queryprof.format_table(plan))
+            print("ANALYZE:")
+            if isinstance(analyzed, dict):
+                print(json.dumps(analyzed, ensure_ascii=False, indent=2))
+            else:
+                print(queryprof.format_table(analyzed))
+            print("")
+            searcher.slow_log.record(cur, SQL, params, elapsed, plan)
+    finally:
+        conn.close()
+
+
+def print_next_page(count: int, last, limit, fmt: str = "pretty"):
+    """limit 件で打ち切ったときに、続きを表示する方法を示す
+
+    tsv/ndjson のときは出力を汚さないようにログ（標準エラー）に出す
+    """
+    if limit and count == limit:
+        hint = f'-- more: --after "{last[0]}/{last[1]}"'
+        if fmt == "pretty":
+            print(hint)
+        else:
+            logger.info(hint)
 
 
 def show_query_time(start_time: float):
@@ -147,6 +322,13 @@ def show_query_time(start_time: float):
     )
 
 
+def positive_int(s: str) -> int:
+    """1 以上の整数（argparse の type）"""
+    if (n := int(s)) < 1:
+        raise ValueError(f"not a positive integer: {s}")
+    return n
+
+
 def show_disk_info(drive: str):
     (total, used, free) = disk_usage(drive)
     free_tb = free / 1024**4
@@ -159,23 +341,7 @@ def show_disk_info(drive: str):
 
 def main():
     # read target directories from json file.
-    config = {}
-    config_file = Path(environ["XDG_CONFIG_HOME"]) / "mp4indexer.json"
-    try:
-        with open(config_file, encoding="utf-8") as f:
-            config = json.load(f)
-    except FileNotFoundError:
-        pass
-    if (db_host := config.get("db_host")) is None:
-        db_host = "192.168.10.4"
-    if (db_user := config.get("db_user")) is None:
-        db_user = "username"
-    if (db_pass := config.get("db_pass")) is None:
-        db_pass = "password"
-    if (db_name := config.get("db_name")) is None:
-        db_name = "mp4index.db"
-    if (table_name := config.get("table_name")) is None:
-        table_name = "videolist"
+    config = load_config()
 
     parser = argparse.ArgumentParser(
         description="MP4データベースからタイトルを検索する",
@@ -198,7 +364,11 @@ def main():
         "-q",
         "--query",
         type=str,
-        help="print SQL query phrase",
+        nargs="?",
+        const="",
+        metavar="SQL",
+        help="run SQL (or the SQL for the keywords if omitted) with timing, "
+        "and show EXPLAIN/ANALYZE",
     )
     parser.add_argument(
         "-C",
@@ -212,8 +382,54 @@ def main():
         "--codec",
         type=str,
         action="append",
-        nargs="*",
-        help="specify codec type(s)",
+        help="filter by codec (fourcc) e.g. HEVC, AVC (repeat or comma-separate)",
+    )
+    parser.add_argument(
+        "--min-height",
+        type=int,
+        help="filter by frame height (e.g. 1080)",
+    )
+    parser.add_argument(
+        "--max-height",
+        type=int,
+        help="filter by frame height",
+    )
+    parser.add_argument(
+        "--min-length",
+        type=filters.parse_duration,
+        help='filter by duration (e.g. "1:30:00", "90m", "1.5h"; number = minutes)',
+    )
+    parser.add_argument(
+        "--max-length",
+        type=filters.parse_duration,
+        help="filter by duration",
+    )
+    parser.add_argument(
+        "--min-size",
+        type=filters.parse_size,
+        help='filter by file size (e.g. "700M", "4G")',
+    )
+    parser.add_argument(
+        "--max-size",
+        type=filters.parse_size,
+        help="filter by file size",
+    )
+    parser.add_argument(
+        "--since",
+        type=str,
+        help='filter by file date (e.g. "2026-10-01", "2026-10", "7d" = 7 days ago)',
+    )
+    parser.add_argument(
+        "--until",
+        type=str,
+        help='filter by file date (inclusive; "2026-10" = until the end of October)',
+    )
+    parser.add_argument(
+        "-k",
+        "--keep",
+        type=int,
+        action="append",
+        help="filter by keep flag (repeatable)",
     )
     parser.add_argument(
         "-p",
@@ -222,6 +438,55 @@ def main():
         #default=False,
         help="print with 'start' command and full-path"
     )
+    parser.add_argument(
+        "-l",
+        "--limit",
+        type=int,
+        help="show at most LIMIT files (use --after for the next page)",
+    )
+    parser.add_argument(
+        "-a",
+        "--after",
+        type=str,
+        metavar="PATH",
+        help='show files after "directory/filename" (next page of --limit)',
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        type=str,
+        nargs="?",
+        const="-",
+        metavar="FILE",
+        help="read one query per line from FILE (default: stdin) and print NDJSON",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="number of queries (and DB connections) run concurrently in --batch",
+    )
+    parser.add_argument(
+        "-T",
+        "--top",
+        type=positive_int,
+        metavar="K",
+        help="rank results by relevance (filename matches, recency) and show the top K",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=render.FORMATS,
+        default="pretty",
+        help="output format: pretty (colored), tsv or ndjson (no ANSI, for piping)",
+    )
+    parser.add_argument(
+        "-D",
+        "--direct",
+        action="store_true",
+        help="search DB directly without the name snapshot and the search service",
+    )
     parser.add_argument(
         "-r",
         "--regexp",
@@ -247,39 +512,84 @@ def main():
 
     if args.debug:
         logger.setLevel(logging.DEBUG)
+        logging.getLogger("mp4core").setLevel(logging.DEBUG)
         print(args)
 
     logger.debug(args)
 
-    conn = mariadb.connect(host=db_host, user=db_user, passwd=db_pass, database=db_name)
-    cur = conn.cursor(dictionary=True)
+    try:
+        conditions = {
+            "codecs": filters.parse_codecs(args.codec),
+            "keep_flags": args.keep,
+            "min_height": args.min_height,
+            "max_height": args.max_height,
+            "min_length": args.min_length,
+            "max_length": args.max_length,
+            "min_size": args.min_size,
+            "max_size": args.max_size,
+            "since": filters.parse_date(args.since) if args.since else None,
+            "until": filters.parse_date(args.until, end=True) if args.until else None,
+        }
+    except ValueError as e:
+        parser.error(str(e))
+    if filters.is_empty(conditions):
+        conditions = None
+    if args.top and (args.limit or args.after):
+        parser.error("--top can't be used with --limit/--after")
+
+    searcher = Searcher(config, args, conditions, pool_size=args.jobs)
+    after = tuple(args.after.rsplit("/", 1)) if args.after else None
+
     start_time = time.perf_counter()
-    if args.query:
-        pass
+    if args.query is not None:
+        if not args.query and not args.keywords and conditions is None:
+            parser.error("-q needs SQL or keywords")
+        profile_query(searcher, args.keywords, after)
+    elif args.batch:
+        if args.batch == "-":
+            total, found = run_batch(searcher, sys.stdin, args.jobs, args.text)
+        else:
+            with open(args.batch, encoding="utf-8") as f:
+                total, found = run_batch(searcher, f, args.jobs, args.text)
+        logger.info(f"{found}/{total} queries found")
+        show_query_time(start_time=start_time)
     else:
-        color_console_enable()
-
-        if args.codec:
-            for t in args.codec:
-                # TODO: list of types support
-                pass
+        if args.format == "pretty":
+            color_console_enable()
 
-        elif (len(args.keywords)==0) or args.console:
+        if (len(args.keywords) == 0 and conditions is None) or args.console:
             # コンソールモード
+            # --limit のときは、空行で前の検索の続きを表示する
+            last_keyword = None
             while True:
                 try:
                     keyword = input("> ").split()
-                    result = search_files(cur, table_name, keyword, args.text, args.regexp)
-                    pretty_print(result, keyword, args.regexp)
+                    if not keyword:
+                        if not (args.limit and last_keyword is not None and after):
+                            continue
+                        keyword = last_keyword
+                    else:
+                        after = None
+                    result = searcher.search(keyword, after)
+                    count, last = render.render(
+                        result, keyword, args.regexp, args.text, args.format
+                    )
+                    print_next_page(count, last, args.limit, args.format)
+                    last_keyword = keyword
+                    after = last if args.limit and count == args.limit else None
                 except EOFError:
                     exit()
         else:
-            result = search_files(cur, table_name, args.keywords, args.text, args.regexp)
-            pretty_print(result, args.keywords, args.regexp)
-        print("")
+            result = searcher.search(args.keywords, after)
+            count, last = render.render(
+                result, args.keywords, args.regexp, args.text, args.format
+            )
+            print_next_page(count, last, args.limit, args.format)
+        if args.format == "pretty":
+            print("")
         show_query_time(start_time=start_time)
         show_disk_info("m:")
-    conn.close()
+    searcher.close()
 
 
 if __name__ == "__main__":
@@ -290,4 +600,5 @@ if __name__ == "__main__":
     logger.addHandler(ch)
     logger.setLevel(logging.INFO)
     logger.propagate = False
+    logging.getLogger("mp4core").addHandler(ch)
     main()
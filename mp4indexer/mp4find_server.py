@@ -0,0 +1,284 @@
+#!python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+mp4find_server.py:
+mp4find の検索サービス（常駐プロセス）
+
+DBのコネクションプール、読み込み済みのMigemo、メモリ上の名前インデックスを持ち続けて、
+ローカルHTTPで検索要求に答える。mp4find はサービスが動いていればそちらに問い合わせ、
+動いていなければ直接DBを検索する。
+
+    GET /search?q=kw1&q=kw2[&text=1][&regexp=1][&limit=n][&after=dir/file]
+               [&codecs=HEVC][&min_height=1080][&since=2026-10-01T00:00:00]...[&top=k]
+                                                検索（結果はJSON、条件は mp4core.filters）
+    GET /reload                                 名前インデックスを読み込み直す
+    GET /status                                 状態を返す
+
+名前検索（text/regexp なし、および regexp）はメモリ上のインデックスで答え、
+説明文（text）を含む検索だけをDBに問い合わせる。
+インデックスは refresh 秒ごとにレコード数と最終更新日時を確認し、変わっていれば読み込み直す。
+"""
+
+import argparse
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from mp4core import filters, rank, search
+from mp4core.config import create_pool, load_config
+from mp4core.nameindex import NameIndex
+
+logger = logging.getLogger(__name__)
+
+__version__ = "0.1"
+
+
+class SearchService:
+    """検索サービスの状態（コネクションプール、Migemo、名前インデックス）"""
+
+    def __init__(self, config: dict, pool_size: int):
+        self.table_name = config["table_name"]
+        self.pool = create_pool(config, pool_size)
+        # プールが空のときは get_connection() が例外になるので、セマフォで待たせる
+        self._pool_sem = threading.BoundedSemaphore(pool_size)
+        self.index = NameIndex([])
+        self._avg_lengths = {}
+        self._signature = None
+        self._reload_lock = threading.Lock()
+
+    def _query(self, SQL: str, params=()):
+        with self._pool_sem:
+            conn = self.pool.get_connection()
+            try:
+                cur = conn.cursor(dictionary=True)
+                cur.execute(SQL, params)
+                return cur.fetchall()
+            finally:
+                # プールに返す
+                conn.close()
+
+    def _table_signature(self):
+        row = self._query(
+            f"SELECT COUNT(*) AS n, MAX(filedate) AS last FROM {self.table_name}"
+        )[0]
+        return row["n"], row["last"]
+
+    def reload(self, force: bool = True):
+        """名前インデックスを読み込み直す（force が False なら変更があったときだけ）"""
+        with self._reload_lock:
+            signature = self._table_signature()
+            if not force and signature == self._signature:
+                return False
+            time_start = time.perf_counter()
+            types = ", ".join(f'"{t}"' for t in search.encoded_video_ext)
+            rows = self._query(
+                f"""
+                SELECT filename, directory, filetype, height, width, length,
+                    filesize, fourcc, filedate, "" AS description, keep_flag, search_key
+                FROM {self.table_name}
+                WHERE filetype IN ({types})
+                ORDER BY directory, filename
+                """
+            )
+            index = NameIndex([dict(r) for r in rows])
+            self._avg_lengths = index.average_lengths()
+            self.index = index
+            self._signature = signature
+            logger.info(
+                "loaded %d names in %.2fs", len(self.index), time.perf_counter() - time_start
+            )
+            return True
+
+    def search(
+        self,
+        patterns: list,
+        text: bool,
+        regexp: bool,
+        limit=None,
+        after=None,
+        conditions: dict = None,
+        top: int = None,
+    ):
+        """検索して (結果, 検索元) を返す
+
+        結果は (directory, filename) の順で、after より後ろの最大 limit 件。
+        top を指定したときはスコアの高い順に top 件（limit と after は使わない）
+        """
+        if top:
+            rows, source = self.search(patterns, text, regexp, conditions=conditions)
+            index = self.index
+            scorer = rank.Scorer(
+                patterns if not regexp else [],
+                text,
+                n_docs=len(index),
+                df=index.document_frequency(patterns) if not regexp else None,
+                avg_lengths=self._avg_lengths,
+            )
+            return rank.ranked(rows, scorer, top), source
+        # インデックスの参照は一度だけ取り出す（途中で reload されても一貫させる）
+        index = self.index
+        # 続きのページは after の行の次から読む（インデックスは DB の照合順序で並んでいる）。
+        # after の行がインデックスにない（読み込み直して消えた）ときは DB で読む
+        start = index.position_after(after) if after else 0
+        if not text and start is not None:
+            if not patterns:
+                rows = index.rows[start:]
+            elif regexp:
+                rows = index.search_regexp(search.compile_pattern(patterns[0]), start)
+            else:
+                rows = index.search(patterns, start)
+            if conditions:
+                rows = [r for r in rows if filters.match(r, conditions)]
+            return (rows[:limit] if limit else rows), "memory"
+        with self._pool_sem:
+            conn = self.pool.get_connection()
+            try:
+                cur = conn.cursor(dictionary=True)
+                result = list(
+                    search.search_files(
+                        cur,
+                        self.table_name,
+                        patterns,
+                        text,
+                        regexp,
+                        limit,
+                        after,
+                        conditions,
+                    )
+                )
+                return result, "db"
+            finally:
+                conn.close()
+
+    def watch(self, interval: float):
+        """interval 秒ごとにテーブルの変更を確認してインデックスを読み込み直す"""
+        while True:
+            time.sleep(interval)
+            try:
+                self.reload(force=False)
+            except Exception as e:
+                logger.error(f"reload failed: {e}")
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    service: SearchService = None
+
+    def _send_json(self, obj, status: int = 200):
+        body = json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        time_start = time.perf_counter()
+        try:
+            if url.path == "/search":
+                patterns = params.get("q", [])
+                conditions = filters.from_params(params)
+                if not patterns and not conditions:
+                    self._send_json({"error": "no keyword"}, 400)
+                    return
+                text = params.get("text", ["0"])[0] == "1"
+                regexp = params.get("regexp", ["0"])[0] == "1"
+                limit = int(params["limit"][0]) if "limit" in params else None
+                top = int(params["top"][0]) if "top" in params else None
+                if top is not None and top < 1:
+                    self._send_json({"error": "top must be a positive integer"}, 400)
+                    return
+                after = tuple(params["after"][0].rsplit("/", 1)) if "after" in params else None
+                rows, source = self.service.search(
+                    patterns, text, regexp, limit, after, conditions, top
+                )
+                self._send_json(
+                    {
+                        "rows": rows,
+                        "source": source,
+                        "elapsed": (time.perf_counter() - time_start) * 1000,
+                    }
+                )
+            elif url.path == "/reload":
+                self.service.reload()
+                self._send_json({"names": len(self.service.index)})
+            elif url.path == "/status":
+                self._send_json({"names": len(self.service.index), "version": __version__})
+            else:
+                self._send_json({"error": "not found"}, 404)
+        except Exception as e:
+            logger.exception(e)
+            self._send_json({"error": str(e)}, 500)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def main():
+    config = load_config()
+    parser = argparse.ArgumentParser(description="mp4find の検索サービスを起動する")
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=config["search_port"],
+        help=f"port to listen on (default: {config['search_port']})",
+    )
+    parser.add_argument(
+        "-n",
+        "--pool-size",
+        type=int,
+        default=4,
+        help="number of pooled DB connections",
+    )
+    parser.add_argument(
+        "-r",
+        "--refresh",
+        type=float,
+        default=60,
+        help="interval in seconds to check the table for changes",
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        action="store_true",
+        help="Print Debug information",
+    )
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    service = SearchService(config, args.pool_size)
+    # 辞書は起動時に読み込んでおく
+    search.pattern_cache.migemo
+    service.reload()
+    threading.Thread(target=service.watch, args=(args.refresh,), daemon=True).start()
+
+    SearchHandler.service = service
+    # 外部には公開しない
+    server = ThreadingHTTPServer((config["search_host"], args.port), SearchHandler)
+    logger.info("listening on %s:%d", config["search_host"], args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        # 保存していない Migemo の展開結果を書いておく
+        search.pattern_cache.save()
+
+
+if __name__ == "__main__":
+    ch = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s %(name)-12s %(levelname)-8s %(message)s")
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    main()
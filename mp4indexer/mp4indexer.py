@@ -18,23 +18,27 @@ mp4indexer.py:
 
 import argparse
 import datetime
-import json
 import logging
 import sys
 import time
+from collections import Counter
 from os import environ
 from pathlib import Path
 from subprocess import run
 
-import cv2
 import mariadb
-from pymediainfo import MediaInfo
+
+from mp4core import fileops, probe, search, snapshot, trigram, videolist
+from mp4core.config import connect, load_config
 
 logger = logging.getLogger(__name__)
 
 __version__ = "0.5"
 
 flag_verbose = False
+probe_stats = Counter()
+# 隔離リスト: (directory, filename) -> (filesize, filedate)
+quarantined = {}
 
 class VideoData:
     """ビデオの情報をプロパティ化してアクセスしやすくするためのクラス"""
@@ -228,74 +232,6 @@ def lsr_files(directory):
     return ret
 
 
-def get_media_info(fname: Path):
-    v_data = VideoData()
-    media_info = MediaInfo.parse(fname, parse_speed=0)
-    general_info = media_info.general_tracks[0]
-    video_info = media_info.video_tracks[0]
-    if general_info.count_of_audio_streams is not None:
-        audio_info = media_info.audio_tracks[0]
-        v_data.audio_channels = (
-            audio_info.channel_s if audio_info.channel_s is not None else 0
-        )
-        v_data.audio_codecs = general_info.audio_codecs
-        if len(v_data.audio_codecs) > 12:
-            v_data.audio_codecs = audio_info.other_format[0]
-        v_data.audio_stream = general_info.count_of_audio_streams
-    else:
-        logger.warning(f"{fname.as_posix()} doesn't have audio!?")
-    v_data.filename = fname.name
-    v_data.directory = fname.parent.as_posix()
-    v_data.filetype = fname.suffix.upper()[1:]
-    v_data.height = video_info.height
-    v_data.width = video_info.width
-    try:
-        v_data.length = general_info.other_duration[3]
-    except:
-        logger.error(f"{fname.as_posix()} doesn't have length")
-    v_data.filesize = fname.stat().st_size
-    v_data.fourcc = "XVID" if video_info.codec_id == "XVID" else video_info.format
-    v_data.filedate = fname.stat().st_mtime
-    v_data.profile = video_info.format_profile
-    v_data.chroma_subsampling = video_info.chroma_subsampling
-    v_data.bit_depth = video_info.bit_depth
-    v_data.writing_app = general_info.writing_application
-    if v_data.width == 0 or v_data.height == 0:
-        logger.warn(
-            f"invalid frame size: width {v_data.width} height {v_data.height} on {fname}"
-        )
-
-    return v_data
-
-
-def get_video_info(fname: Path):
-    """Get frame size data from the video file using OpenCV"""
-    v_data = VideoData()
-
-    video_track = cv2.VideoCapture(str(fname))
-    v_data.width = video_track.get(cv2.CAP_PROP_FRAME_WIDTH)
-    v_data.height = video_track.get(cv2.CAP_PROP_FRAME_HEIGHT)
-    fcc_int = int(video_track.get(cv2.CAP_PROP_FOURCC))
-    v_data.fourcc = "".join(list(fcc_int.to_bytes(4, "little").decode("utf-8"))).upper()
-    fps = video_track.get(cv2.CAP_PROP_FPS)
-    fc = video_track.get(cv2.CAP_PROP_FRAME_COUNT)
-    try:
-        length = fc / fps
-    except ZeroDivisionError:
-        logger.info("wrong FPS value: %s", fname)
-        length = 0
-    if length <= 0:
-        logger.warn(f"invalid length: {fc} / {fps} on {fname}")
-        length = 0
-    v_data.length = length
-    if v_data.width == 0 or v_data.height == 0:
-        logger.warn(
-            f"invalid frame size: width {v_data.width} height {v_data.height} on {fname}"
-        )
-
-    return v_data
-
-
 def remove(conn: mariadb.Connection, cur, tablename: str):
     """DBのデータから keep == 2 のレコードを検索し、ファイルが実在すれば削除する
 
@@ -318,6 +254,7 @@ def remove(conn: mariadb.Connection, cur, tablename: str):
                 logger.info(f"removed : {p}")
             else:
                 logger.warn(f"remove: {p} does not exist")
+            trigram.remove_postings(cur, tablename, r["id"])
             SQL = f"""
                 delete from {tablename}
                 where directory="{r['directory']}"
@@ -345,10 +282,12 @@ def cleanup(conn: mariadb.Connection, cur, tablename: str):
     res = cur.fetchall()
     for r in res:
         p = Path(r["directory"], r["filename"])
-        if p.exists():
+        # 以前に登録してしまった mp4copy のチェックサムなども消す
+        if p.exists() and not fileops.is_work_file(p):
             continue
         else:
             logger.info(f"clean-up {p}")
+            trigram.remove_postings(cur, tablename, r["id"])
             SQL = f"""
                 delete from {tablename}
                 where directory="{r['directory']}"
@@ -360,9 +299,94 @@ def cleanup(conn: mariadb.Connection, cur, tablename: str):
     return count
 
 
-def index_files(p: Path, conn: mariadb.Connection, cur, tablename: str):
-    """Get video info from the video file using OpenCV"""
-    v_data = VideoData()
+def load_quarantine(cur, tablename: str):
+    """隔離リストを読み込む"""
+    quarantined.clear()
+    cur.execute(f"SELECT directory, filename, filesize, filedate FROM {tablename}_quarantine")
+    for r in cur.fetchall():
+        quarantined[(r["directory"], r["filename"])] = (
+            r["filesize"],
+            r["filedate"].strftime("%Y-%m-%d %H:%M:%S"),
+        )
+
+
+def quarantine_file(cur, tablename: str, f: Path, fsize: int, timestamp: str, reason: str):
+    """プローブに失敗したファイルを隔離リストに登録する（登録済みなら試行回数を増やす）"""
+    dirname = f.parent.as_posix()
+    cur.execute(
+        f"""
+        INSERT INTO {tablename}_quarantine
+            (filename, directory, filesize, filedate, reason, attempts)
+        VALUES (?, ?, ?, ?, ?, 1)
+        ON DUPLICATE KEY
+        UPDATE filesize = VALUES(filesize), filedate = VALUES(filedate),
+            reason = VALUES(reason), attempts = attempts + 1, last_attempt = NOW()
+        """,
+        (f.name, dirname, fsize, timestamp, reason),
+    )
+    quarantined[(dirname, f.name)] = (fsize, timestamp)
+    logger.info(f"quarantined {f.as_posix()}: {reason}")
+
+
+def release_file(cur, tablename: str, dirname: str, fname: str):
+    """隔離リストからファイルを外す"""
+    cur.execute(
+        f"DELETE FROM {tablename}_quarantine WHERE directory = ? AND filename = ?",
+        (dirname, fname),
+    )
+    quarantined.pop((dirname, fname), None)
+
+
+def list_quarantine(cur, tablename: str):
+    """隔離リストを表示する"""
+    cur.execute(
+        f"""
+        SELECT * FROM {tablename}_quarantine
+        ORDER BY directory, filename
+        """
+    )
+    res = cur.fetchall()
+    for r in res:
+        print(
+            f'"{r["directory"]}/{r["filename"]}"\t{r["filesize"]:,}\t{r["filedate"]}'
+            f'\t{r["attempts"]}\t{r["last_attempt"]}\t{r["reason"]}'
+        )
+    return len(res)
+
+
+def retry_quarantine(conn: mariadb.Connection, cur, tablename: str, worker, dirs):
+    """隔離リストのファイルを（dirs 以下のものに限って）もう一度プローブする"""
+    count = 0
+    prefixes = [Path(d).absolute().as_posix() for d in dirs]
+    for dirname, fname in list(quarantined):
+        if prefixes and not any(
+            (dirname + "/").startswith(p.rstrip("/") + "/") or f"{dirname}/{fname}" == p
+            for p in prefixes
+        ):
+            continue
+        p = Path(dirname, fname)
+        if not p.exists():
+            release_file(cur, tablename, dirname, fname)
+            logger.info(f"released {p.as_posix()} (not exist)")
+            continue
+        index_files(p, conn, cur, tablename, worker, force=True)
+        count += 1
+    conn.commit()
+    return count
+
+
+def index_files(
+    p: Path,
+    conn: mariadb.Connection,
+    cur,
+    tablename: str,
+    worker: probe.ProbeWorker,
+    force: bool = False,
+):
+    """Get video info from the video files and register them to DB
+
+    force が True のときは、隔離中や登録済みのファイルもプローブし直す。
+    """
     if p.is_file():
         target = [p]
     else:
@@ -384,6 +408,17 @@ def index_files(p: Path, conn: mariadb.Connection, cur, tablename: str):
         )
         if fname == "ls-R":
             continue
+        elif fileops.is_work_file(f):
+            # mp4copy のチェックサム（.chk）とコピー中のファイル（.part）は登録しない。
+            # 動画が消えたり名前が変わったりして残ったチェックサムは消す
+            if fileops.is_orphaned_sidecar(f):
+                f.unlink(missing_ok=True)
+                logger.info(f"removed orphaned checksum {f.as_posix()}")
+            continue
+        elif not force and quarantined.get((dirname, fname)) == (fsize, timestamp):
+            # 前回から変更されていない隔離中のファイルはプローブしない
+            logger.debug(f"quarantined, skip {fname}")
+            continue
         else:
             logger.debug(f)
             # 処理時間短縮のためデータベースにすでにあるかどうかを確認する
@@ -399,36 +434,33 @@ def index_files(p: Path, conn: mariadb.Connection, cur, tablename: str):
             except ValueError:
                 r = []
             # データがあれば登録不要
-            if r:
+            if r and not force:
                 logger.debug(f"already registered, skip {fname}")
                 continue
 
             # その他に .keyframe, .err がある
-            if filetype in ["MP4", "M2TS", "M2T", "MPG", "TS", "AVI", "MKV"]:
+            if filetype in videolist.VIDEO_FILETYPES:
                 # ビデオファイル
                 logger.debug(f"updating {fname}")
-                v_data = get_media_info(f)
-                if filetype in ["M2TS", "M2T", "TS", "MPG"]:
-                    v_data.fourcc = "MPEG"
-                SQL = f"""
-                    INSERT INTO {tablename}
-                        (filename, directory, filetype, height, width,
-                         length, filesize, fourcc, filedate, description, keep_flag,
-                         profile, audio_channels, chroma_subsampling, bit_depth,
-                         audio_codecs, audio_stream, writing_app)
-                    VALUES ("{fname}", "{dirname}", "{filetype}",
-                        {v_data.height}, {v_data.width}, "{v_data.length}",
-                        {fsize}, "{v_data.fourcc}", "{timestamp}", "", 0,
-                        "{v_data.profile}", {v_data.audio_channels}, "{v_data.chroma_subsampling}",
-                        {v_data.bit_depth}, "{v_data.audio_codecs}", {v_data.audio_stream},
-                        "{v_data.writing_app}")
-                    ON DUPLICATE KEY
-                    UPDATE height = {v_data.height}, width = {v_data.width},
-                        length = "{v_data.length}", filedate = "{timestamp}", filesize = {fsize},
-                        bit_depth = {v_data.bit_depth}, profile = "{v_data.profile}",
-                        fourcc = "{v_data.fourcc}"
-                    RETURNING filename
-                    """
+                result = probe.probe_file(f, worker)
+                probe_stats[result.strategy or "failed"] += 1
+                if result.timed_out:
+                    probe_stats["timeout"] += 1
+                    logger.warning(f"probe timed out: {f.as_posix()}")
+                if result.info is None:
+                    logger.error(f"{f.as_posix()} couldn't be probed: {result.reason}")
+                    quarantine_file(cur, tablename, f, fsize, timestamp, result.reason)
+                    continue
+                if result.reason:
+                    logger.warning(f"{f.as_posix()}: {result.reason} ({result.strategy})")
+                    quarantine_file(cur, tablename, f, fsize, timestamp, result.reason)
+                elif (dirname, fname) in quarantined:
+                    release_file(cur, tablename, dirname, fname)
+                    logger.info(f"released {f.as_posix()}")
+                logger.debug(f"probed by {result.strategy}: {result.attempts}")
+                SQL, params = videolist.upsert_sql(
+                    tablename, dirname, fname, filetype, fsize, timestamp, result.info
+                )
             elif filetype in ["TXT"]:
                 logger.debug(f"updating {fname}")
                 try:
@@ -444,7 +476,12 @@ def index_files(p: Path, conn: mariadb.Connection, cur, tablename: str):
                     logger.debug("output: {}".format(res.stderr.decode()))
                     description = f.read_text(encoding="utf-8")
                 description = description.replace("'", "''").replace('"', '""')
+                params = ()
                 SQL = f"""INSERT INTO {tablename}
+                        (filename, directory, filetype, height, width,
+                         length, filesize, fourcc, filedate, description, keep_flag,
+                         profile, audio_channels, chroma_subsampling, bit_depth,
+                         audio_codecs, audio_stream, writing_app)
                     VALUES ("{fname}", "{dirname}", "{filetype}",
                         0, 0, "", {fsize}, "", "{timestamp}", "", 0,
                         "", 0, "", 0, "", 0, "")
@@ -455,7 +492,12 @@ def index_files(p: Path, conn: mariadb.Connection, cur, tablename: str):
             else:
                 logger.info(f"unknown suffix : {f.parent}\\{fname}")
 
+                params = ()
                 SQL = f"""INSERT INTO {tablename}
+                        (filename, directory, filetype, height, width,
+                         length, filesize, fourcc, filedate, description, keep_flag,
+                         profile, audio_channels, chroma_subsampling, bit_depth,
+                         audio_codecs, audio_stream, writing_app)
                     VALUES ("{fname}", "{dirname}", "{filetype}",
                         0, 0, "", {fsize}, "", "{timestamp}", "", 0,
                         "", 0, "", 0, "", 0, "")
@@ -465,7 +507,7 @@ def index_files(p: Path, conn: mariadb.Connection, cur, tablename: str):
                     """
 
             try:
-                cur.execute(SQL)
+                cur.execute(SQL, params)
             except mariadb.OperationalError as e:
                 print(e)
                 logger.error(SQL)
@@ -486,6 +528,7 @@ def index_files(p: Path, conn: mariadb.Connection, cur, tablename: str):
                     logger.warn(f"insertion failed: {fname}")
                 else:
                     logger.debug(f"inserted {dirname}/{fname}")
+                    trigram.add_postings(cur, tablename, dirname, fname)
         conn.commit()
 
 
@@ -511,6 +554,9 @@ def create_table(cur, tablename: str):
     # audio_codecs | CHAR(24)
     # audio_stream | TINYINT
     # writing_app  | CHAR(128)
+    # id           | INT UNSIGNED (AUTO_INCREMENT, トライグラム索引から参照する)
+    # search_key   | VARCHAR(1024) ("directory filename" を mp4core.normalize で正規化したもの)
+    # frame_rate   | CHAR(16) (分数。"30000/1001" など。key2chapter が使う)
     try:
         cur.execute(
             f"""
@@ -533,38 +579,93 @@ def create_table(cur, tablename: str):
                 audio_codecs CHAR(24) DEFAULT "",
                 audio_stream TINYINT DEFAULT 0,
                 writing_app  CHAR(128) DEFAULT "",
+                id INT UNSIGNED NOT NULL AUTO_INCREMENT UNIQUE,
+                search_key VARCHAR(1024) NOT NULL DEFAULT "",
+                frame_rate CHAR(16) NOT NULL DEFAULT "",
             PRIMARY KEY (directory, filename))
             """
         )
     except mariadb.OperationalError:
         # すでにTABLEがある
         pass
-    return
+    # id のない古いテーブルには id を追加する（既存のレコードにも採番される）
+    cur.execute(
+        f"""
+        ALTER TABLE {tablename}
+        ADD COLUMN IF NOT EXISTS id INT UNSIGNED NOT NULL AUTO_INCREMENT UNIQUE
+        """
+    )
+    # frame_rate のない古いテーブルには追加する（値は次にプローブしたときに入る）
+    cur.execute(
+        f"""
+        ALTER TABLE {tablename}
+        ADD COLUMN IF NOT EXISTS frame_rate CHAR(16) NOT NULL DEFAULT ""
+        """
+    )
+    # search_key のない古いテーブルには追加する（値は trigram.rebuild で入れる）
+    cur.execute(f"SHOW COLUMNS FROM {tablename} LIKE 'search_key'")
+    key_added = not cur.fetchall()
+    if key_added:
+        cur.execute(
+            f"""
+            ALTER TABLE {tablename}
+            ADD COLUMN search_key VARCHAR(1024) NOT NULL DEFAULT ""
+            """
+        )
+    # mp4find の絞り込み条件（mp4core.filters）用のインデックス
+    # "HEVC 1080p 今月" のような条件は idx_codec で、それ以外は各カラムの範囲で引く
+    for name, columns in (
+        ("idx_codec", "fourcc, height, filedate"),
+        ("idx_height", "height, filedate"),
+        ("idx_filedate", "filedate"),
+        ("idx_length", "length"),
+        ("idx_filesize", "filesize"),
+        ("idx_keep_flag", "keep_flag, filedate"),
+        # 前方一致の検索用。部分一致はトライグラム索引（search_key から作る）で引く
+        ("idx_search_key", "search_key(255)"),
+    ):
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {tablename} ({columns})")
+
+    # table videolist_quarantine
+    # プローブに失敗したファイルの隔離リスト。
+    # filesize と filedate が変わるまではプローブしない
+    # ----------------------
+    # filename     | VARCHAR(255)
+    # directory    | VARCHAR(255)
+    # filesize     | BIGINT
+    # filedate     | TIMESTAMP
+    # reason       | TEXT
+    # attempts     | INT UNSIGNED
+    # last_attempt | TIMESTAMP
+    try:
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {tablename}_quarantine (
+                filename VARCHAR(255) NOT NULL,
+                directory VARCHAR(255) NOT NULL,
+                filesize BIGINT UNSIGNED NOT NULL DEFAULT 0,
+                filedate TIMESTAMP DEFAULT 0,
+                reason TEXT DEFAULT "",
+                attempts INT UNSIGNED NOT NULL DEFAULT 0,
+                last_attempt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (directory, filename))
+            """
+        )
+    except mariadb.OperationalError:
+        pass
+    return key_added
 
 
 def main():
     # read target directories from json file.
-    config = {}
-    config_file = Path(environ["XDG_CONFIG_HOME"]) / "mp4indexer.json"
-    try:
-        with open(config_file, encoding="utf-8") as f:
-            config = json.load(f)
-    except FileNotFoundError:
-        pass
-    if (db_host := config.get("db_host")) is None:
-        db_host = "192.168.10.4"
-    if (db_user := config.get("db_user")) is None:
-        db_user = "username"
-    if (db_pass := config.get("db_pass")) is None:
-        db_pass = "password"
+    config = load_config()
+    tablename = config["table_name"]
     if (target_dirs := config.get("target_dirs")) is None:
         target_dirs = [Path.cwd()]
     if (log_dir := config.get("log_dir")) is None:
         log_dir = environ["XDG_DATA_HOME"] + "/mp4indexer"
-    if (db_name := config.get("db_name")) is None:
-        db_name = "mp4index.db"
-    if (tablename := config.get("table_name")) is None:
-        tablename = "videolist"
+    if (probe_timeout := config.get("probe_timeout")) is None:
+        probe_timeout = probe.DEFAULT_TIMEOUT
     # log_dir は $XDG_STATE_HOME が Ver.0.8から標準になった
     # $XDG_STATE_HOME がない場合は ~/.local/state が使われる
     log_name = Path(log_dir).joinpath(time.strftime("mp4index-%Y-%m-%d.log"))
@@ -605,6 +706,33 @@ def main():
         default=False,
         help="remove video files of which 'keep' flag is 2",
     )
+    parser.add_argument(
+        "--rebuild-trigram",
+        action="store_true",
+        default=False,
+        help="rebuild search keys and trigram index for name search",
+    )
+    parser.add_argument(
+        "-Q",
+        "--quarantine",
+        action="store_true",
+        default=False,
+        help="list files quarantined because of probe failures",
+    )
+    parser.add_argument(
+        "-R",
+        "--retry",
+        action="store_true",
+        default=False,
+        help="probe quarantined files (under dir if given) again",
+    )
+    parser.add_argument(
+        "-T",
+        "--timeout",
+        type=float,
+        default=probe_timeout,
+        help=f"timeout in seconds for probing one file (default: {probe_timeout})",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -639,15 +767,20 @@ def main():
 
     if args.DB:
         logger.info(f"DB name: {args.DB}")
-        db_name = args.DB
+        config["db_name"] = str(args.DB)
 
     logger.debug(args)
-    logger.debug("db_host:{0}, db_user:{1}, db_pass:{2}, db_name:{3}".format(db_host, db_user, db_pass, db_name))
-    conn = mariadb.connect(
-        host=db_host, user=db_user, password=db_pass, database=db_name
-    )
+    logger.debug("db_host:{0}, db_user:{1}, db_pass:{2}, db_name:{3}".format(
+        config["db_host"], config["db_user"], config["db_pass"], config["db_name"]))
+    conn = connect(config)
     cur = conn.cursor(dictionary=True)
-    create_table(cur, tablename)
+    key_added = create_table(cur, tablename)
+    # トライグラムのテーブルや search_key を新しく作ったときは、既存のレコードの索引も作る
+    if trigram.create_table(cur, tablename) or key_added or args.rebuild_trigram:
+        logger.info("building search keys and trigram index")
+        result = trigram.rebuild(conn, cur, tablename)
+        logger.info(f"{result} records were indexed.")
+    load_quarantine(cur, tablename)
 
     dirs = args.directories
     time_start = time.perf_counter()
@@ -659,16 +792,44 @@ def main():
     elif args.remove:
         result = remove(conn, cur, tablename)
         logger.info(f"{result} files were removed.")
+    elif args.quarantine:
+        result = list_quarantine(cur, tablename)
+        logger.info(f"{result} files are quarantined.")
     else:
-        for d in dirs:
-            p = Path(d)
-            if not p.exists():
-                logger.info("%s is not exist", p)
+        worker = probe.ProbeWorker(timeout=args.timeout)
+        try:
+            if args.retry:
+                # ディレクトリの指定がないときは隔離リスト全体が対象
+                retry_dirs = [] if dirs is target_dirs else dirs
+                result = retry_quarantine(conn, cur, tablename, worker, retry_dirs)
+                logger.info(f"{result} quarantined files were retried.")
             else:
-                try:
-                    index_files(p, conn, cur, tablename)
-                except FileNotFoundError:
-                    logger.error(f"{d} does not exist. Skipping.")
+                for d in dirs:
+                    p = Path(d)
+                    if not p.exists():
+                        logger.info("%s is not exist", p)
+                    else:
+                        try:
+                            index_files(p, conn, cur, tablename, worker)
+                        except FileNotFoundError:
+                            logger.error(f"{d} does not exist. Skipping.")
+        finally:
+            worker.close()
+        logger.info(
+            "probe: %s, worker restarts: %d",
+            ", ".join(f"{k}={v}" for k, v in sorted(probe_stats.items())),
+            worker.restarts,
+        )
+
+    if not args.quarantine and (snapshot_path := config["snapshot_path"]):
+        # mp4find が DB なしで名前を検索できるようにスナップショットを書き出す
+        try:
+            result = snapshot.write_from_db(
+                cur, tablename, snapshot_path, search.encoded_video_ext
+            )
+            logger.info(f"{result} names were written to {snapshot_path}")
+        except (OSError, snapshot.SnapshotError) as e:
+            logger.warning(f"couldn't write name snapshot: {e}")
 
     time_end = time.perf_counter()
     time_diff = time_end - time_start
@@ -0,0 +1,75 @@
+# vim:fenc=utf-8 ff=unix ft=python ts=4 sw=4 sts=4 si et fdm fdl=99:
+# vim:cinw=if,elif,else,for,while,try,except,finally,def,class:
+"""
+test_snapshot.py:
+スナップショットの続きのページ（after）が DB の照合順序のとおりに進むかのテスト
+
+    python -m pytest test_snapshot.py
+"""
+
+from datetime import datetime
+
+from mp4core import snapshot
+from mp4core.nameindex import NameIndex
+
+# utf8mb4_general_ci の ORDER BY directory, filename の順（英字は大文字の重みで比べるので "_" より前）
+NAMES = [
+    ("/v", "aa.mp4"),
+    ("/v", "ab.mp4"),
+    ("/v", "abcd.mp4"),
+    ("/v", "abc_x.mp4"),
+    ("/v", "ac.mp4"),
+    # directory と filename をつなぐと同じバイト列になる行
+    ("/v", "xa.mp4"),
+    ("/vx", "a.mp4"),
+]
+
+
+def _rows():
+    return [
+        {
+            "directory": d,
+            "filename": f,
+            "filetype": "mp4",
+            "width": 1920,
+            "height": 1080,
+            "length": "00:30:00.000",
+            "filesize": 1 << 30,
+            "fourcc": "avc1",
+            "filedate": datetime(2026, 10, 1),
+            "keep_flag": 0,
+        }
+        for d, f in NAMES
+    ]
+
+
+def _pages(position_after, search):
+    """1件ずつのページを最後までたどった名前の列"""
+    names = []
+    after = None
+    while True:
+        start = position_after(after) if after else 0
+        page = search(start)[:1]
+        if not page:
+            return names
+        after = (page[0]["directory"], page[0]["filename"])
+        names.append(after)
+
+
+def test_snapshot_position_after(tmp_path):
+    path = tmp_path / "names.snapshot"
+    snapshot.write(_rows(), path)
+    with snapshot.NameSnapshot(path) as snap:
+        for i, name in enumerate(NAMES):
+            assert snap.position_after(name) == i + 1
+        assert snap.position_after(("/v", "abc.mp4")) is None
+        assert snap.position_after(("/v", "AA.mp4")) is None
+        assert _pages(snap.position_after, lambda start: list(snap.search(["a"], start))) == NAMES
+
+
+def test_nameindex_position_after():
+    index = NameIndex(_rows())
+    for i, name in enumerate(NAMES):
+        assert index.position_after(name) == i + 1
+    assert index.position_after(("/v", "abc.mp4")) is None
+    assert _pages(index.position_after, lambda start: index.search(["a"], start)) == NAMES
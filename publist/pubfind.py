@@ -16,16 +16,27 @@ import sqlite3
 import json
 import re
 import logging
+import time
+from datetime import datetime
+from functools import lru_cache
 from sys import exec_prefix
 from ctypes import windll, wintypes, byref
 from os import environ
 from pathlib import Path
-from tqdm import tqdm
-
-import cmigemo
 
 
 migemo_dict = "c:/Apps/bin/dict/base-dict"
+pattern_cache_file = (
+    Path(environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "publist" / "migemo.json"
+)
+pattern_cache_size = 1000
+# この時間（ミリ秒）以上かかった検索は実行計画と一緒に slow_query_log に書く
+slow_query_ms = 1000
+slow_query_log = (
+    Path(environ.get("XDG_STATE_HOME", Path.home() / ".local" / "state"))
+    / "publist"
+    / "slow_query.log"
+)
 BRIGHT_RED = "\033[91m"
 BRIGHT_GREEN = "\033[92m"
 BRIGHT_YELLOW = "\033[93m"
@@ -57,34 +68,134 @@ def color_console_enable():
     return True
 
 
+_migemo = None
+
+
+def get_migemo():
+    """Migemo のインスタンスを返す（辞書の読み込みはプロセス内で一度だけ）"""
+    global _migemo
+    if _migemo is None:
+        # cmigemoのインポートは重いので、使うときにインポートする
+        import cmigemo
+
+        _migemo = cmigemo.Migemo(migemo_dict)
+    return _migemo
+
+
+def load_pattern_cache():
+    """前回までに展開した 検索語 -> 正規表現 を読み込む（辞書が更新されていたら捨てる）"""
+    try:
+        with open(pattern_cache_file, encoding="utf-8") as f:
+            data = json.load(f)
+        if data["dict_mtime"] == Path(migemo_dict).stat().st_mtime:
+            return data["patterns"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def save_pattern_cache(patterns: dict):
+    try:
+        pattern_cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(pattern_cache_file, "w", encoding="utf-8") as f:
+            json.dump(
+                {"dict_mtime": Path(migemo_dict).stat().st_mtime, "patterns": patterns},
+                f,
+                ensure_ascii=False,
+            )
+    except OSError as e:
+        logger.warning(f"couldn't save pattern cache: {e}")
+
+
+@lru_cache(maxsize=256)
 def compile_pattern(S: str):
     logger.debug("Compiling pattern: %s", S)
-    m = cmigemo.Migemo(migemo_dict)
-    ret = m.query(S)
+    patterns = load_pattern_cache()
+    if (ret := patterns.get(S)) is None:
+        ret = get_migemo().query(S)
+        # 新しいものを末尾に追加し、古いものから捨てる
+        patterns[S] = ret
+        save_pattern_cache(dict(list(patterns.items())[-pattern_cache_size:]))
     logger.debug("regex = %s", ret)
     # return ret
     return re.compile(ret, re.IGNORECASE)
 
 
-def search_files(cur: sqlite3.Cursor, pattern: re.Pattern):
+def build_search_sql(pattern: re.Pattern):
+    """検索の SQL とパラメータ"""
     # talbe filelist
     # ----------------------
     # filename    | TEXT
     # directory   | TEXT
     # filesize    | INTEGER
     # datetime    | TEXT
-    SQL = f"""SELECT * FROM filelist 
-        WHERE filename REGEXP "{pattern.pattern}"
-        OR directory REGEXP "{pattern.pattern}"
+    SQL = """SELECT * FROM filelist
+        WHERE filename REGEXP ?
+        OR directory REGEXP ?
     """
-    cur.execute(SQL)
+    return SQL, [pattern.pattern, pattern.pattern]
+
+
+def explain(cur: sqlite3.Cursor, SQL: str, params=()) -> list:
+    """EXPLAIN QUERY PLAN の結果"""
+    cur.execute(f"EXPLAIN QUERY PLAN {SQL}", params)
+    return [dict(d) for d in cur.fetchall()]
+
+
+def log_slow_query(cur: sqlite3.Cursor, SQL: str, params, elapsed: float, plan=None):
+    """slow_query_ms 以上かかったクエリを実行計画と一緒に slow_query_log に追記する"""
+    if elapsed * 1000 < slow_query_ms:
+        return False
+    if plan is None:
+        plan = explain(cur, SQL, params)
+    logger.warning("slow query: %.1f ms (logged to %s)", elapsed * 1000, slow_query_log)
+    try:
+        slow_query_log.parent.mkdir(parents=True, exist_ok=True)
+        with open(slow_query_log, "a", encoding="utf-8") as f:
+            record = {
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "elapsed_ms": round(elapsed * 1000, 1),
+                "sql": " ".join(SQL.split()),
+                "params": list(params),
+                "plan": plan,
+            }
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        logger.warning(f"couldn't write slow query log: {e}")
+    return True
+
+
+def search_files(cur: sqlite3.Cursor, pattern: re.Pattern):
+    SQL, params = build_search_sql(pattern)
+    time_start = time.perf_counter()
+    cur.execute(SQL, params)
     data = cur.fetchall()
+    log_slow_query(cur, SQL, params, time.perf_counter() - time_start)
     result = [dict(d) for d in data]
     logger.debug(result)
     return result
 
 
+def profile_query(cur: sqlite3.Cursor, SQL: str, params=()):
+    """SQL を実行して件数と実行時間、実行計画（EXPLAIN QUERY PLAN）を表示する"""
+    print(" ".join(SQL.split()))
+    if params:
+        print(f"params: {params}")
+    plan = explain(cur, SQL, params)
+    time_start = time.perf_counter()
+    cur.execute(SQL, params)
+    rows = cur.fetchall()
+    elapsed = time.perf_counter() - time_start
+    logger.info("%d rows in %.1f ms", len(rows), elapsed * 1000)
+    print("EXPLAIN QUERY PLAN:")
+    for p in plan:
+        print(f'{p["id"]}\t{p["parent"]}\t{p["detail"]}')
+    log_slow_query(cur, SQL, params, elapsed, plan)
+
+
 def find_duplicates(cur: sqlite3.Cursor):
+    from tqdm import tqdm
+
     SQL = f"""SELECT *, COUNT(filename) FROM filelist
         GROUP BY filename, filesize
         HAVING COUNT(filename) > 1
@@ -135,6 +246,7 @@ def main():
     # log_dir は $XDG_STATE_HOME が Ver.0.8から標準になった
     # $XDG_STATE_HOME がない場合は ~/.local/state が使われる
     db_name = Path("publist.db")
+    json_obj = {}
     try:
         with open(config, encoding="utf-8") as f:
             json_obj = json.load(f)
@@ -168,7 +280,15 @@ def main():
         default=False,
         help="invert match",
     )
-    parser.add_argument("-q", "--query", type=str, help="SQL query")
+    parser.add_argument(
+        "-q",
+        "--query",
+        type=str,
+        nargs="?",
+        const="",
+        metavar="SQL",
+        help="run SQL (or the SQL for the keyword if omitted) with timing and show the plan",
+    )
     parser.add_argument(
         "-t",
         "--type",
@@ -204,6 +324,10 @@ def main():
     )
     args = parser.parse_args()
 
+    global slow_query_ms
+    if json_obj.get("slow_query_ms") is not None:
+        slow_query_ms = json_obj["slow_query_ms"]
+
     if args.debug:
         logger.setLevel(logging.DEBUG)
         print(args)
@@ -219,8 +343,13 @@ def main():
     conn.load_extension(exec_prefix + "/DLLs/regexp.dll")
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
-    if args.query:
-        pass
+    if args.query is not None:
+        if args.query:
+            profile_query(cur, args.query)
+        elif args.keyword:
+            profile_query(cur, *build_search_sql(compile_pattern(args.keyword[0])))
+        else:
+            parser.error("-q needs SQL or keyword")
     elif args.DUP:
         find_duplicates(cur)
     else: